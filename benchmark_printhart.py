@@ -0,0 +1,409 @@
+# Benchmark de PrinThart System.
+#
+# Llena una base PostgreSQL local o un archivo SQLite con datos sintéticos
+# (pedidos con sus materiales, inventario, bajas y suplidores) y dibuja cada
+# página de la app sin navegador con el AppTest de Streamlit. Por página y
+# tamaño mide tiempo, viajes a la base de datos y memoria pico, y guarda todo
+# en JSON para poder comparar corridas.
+#
+# ¡OJO! Borra todos los datos de la base indicada. Usar solo con una base local.
+#
+#   python benchmark_printhart.py --dsn postgresql://postgres@localhost/bench \
+#       --tamanos 1000,10000,100000,1000000 --salida benchmark_resultados.json
+#
+# Con SQLite no hace falta servidor: el archivo se crea de nuevo para cada tamaño.
+#
+#   python benchmark_printhart.py --dsn sqlite:///bench.db --tamanos 1000,10000
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+PREFIJO_SQLITE = "sqlite:///"
+PAGINAS = ["Entregas", "Nuevo pedido", "Inventario", "Suplidores", "Estados", "Reportes"]
+ESTADOS = ["Por confirmar", "Sin diseñar", "Diseños listos", "Listos para entregar"]
+APP_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "printhart_supabase.py")
+
+# --- CONTEO DE VIAJES A LA BASE DE DATOS ---
+# La app abre sus conexiones con psycopg2.connect dentro del mismo proceso, así
+# que basta con cambiar la fábrica de conexiones para contar cada sentencia,
+# cada lote leído de un cursor con nombre y cada commit/rollback.
+viajes = {"total": 0}
+
+# Se mezcla con la fábrica de cursores que ya use la conexión (la app mide sus
+# consultas con la suya) para que contar no le quite la instrumentación.
+class CursorContado:
+    def execute(self, *args, **kwargs):
+        viajes["total"] += 1
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, query, params):
+        params = list(params)
+        viajes["total"] += len(params)
+        return super().executemany(query, params)
+
+    def copy_expert(self, *args, **kwargs):
+        viajes["total"] += 1
+        return super().copy_expert(*args, **kwargs)
+
+    # En un cursor con nombre cada lectura es un FETCH al servidor
+    def fetchmany(self, *args, **kwargs):
+        if self.name:
+            viajes["total"] += 1
+        return super().fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        if self.name:
+            viajes["total"] += 1
+        return super().fetchall()
+
+_fabricas_contadas = {}
+
+def _fabrica_contada(base):
+    if base not in _fabricas_contadas:
+        _fabricas_contadas[base] = type(f"Contado{base.__name__}", (CursorContado, base), {})
+    return _fabricas_contadas[base]
+
+class ConexionContada(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _fabrica_contada(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        viajes["total"] += 1
+        return super().commit()
+
+    def rollback(self):
+        viajes["total"] += 1
+        return super().rollback()
+
+_connect_original = psycopg2.connect
+
+def _connect_contado(*args, **kwargs):
+    kwargs.setdefault("connection_factory", ConexionContada)
+    return _connect_original(*args, **kwargs)
+
+psycopg2.connect = _connect_contado
+
+# En SQLite cada sentencia es una llamada a la biblioteca dentro del proceso;
+# se cuentan igual para comparar con PostgreSQL. Connection.execute (BEGIN,
+# COMMIT, PRAGMA) también pasa por cursor().
+class CursorSQLiteContado(sqlite3.Cursor):
+    def execute(self, *args, **kwargs):
+        viajes["total"] += 1
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        viajes["total"] += 1
+        return super().executemany(*args, **kwargs)
+
+class ConexionSQLiteContada(sqlite3.Connection):
+    def cursor(self, factory=CursorSQLiteContado):
+        return super().cursor(factory)
+
+_connect_sqlite_original = sqlite3.connect
+
+def _connect_sqlite_contado(*args, **kwargs):
+    kwargs.setdefault("factory", ConexionSQLiteContada)
+    return _connect_sqlite_original(*args, **kwargs)
+
+sqlite3.connect = _connect_sqlite_contado
+
+# --- DATOS SINTÉTICOS ---
+# Todo se genera en el servidor con generate_series. Los triggers del libro de
+# finanzas, del stock reservado, de los resúmenes y de las bajas por material
+# se apagan durante la carga y todo se recalcula al final.
+TABLAS_CON_TRIGGERS = ["pedidos", "pedido_materiales", "inventario", "bajas_material"]
+
+def generar_datos(dsn, pedidos, materiales, suplidores):
+    if dsn.startswith(PREFIJO_SQLITE):
+        return generar_datos_sqlite(dsn[len(PREFIJO_SQLITE):], pedidos, materiales, suplidores)
+    conn = _connect_original(dsn)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("TRUNCATE pedido_materiales, pedidos, inventario, bajas_material, suplidores RESTART IDENTITY")
+            for tabla in TABLAS_CON_TRIGGERS:
+                cur.execute(f"ALTER TABLE {tabla} DISABLE TRIGGER USER")
+            cur.execute('''
+                INSERT INTO inventario (material, cantidad, detalle, precio_compra, precio_venta)
+                SELECT 'Material ' || lpad(g::text, 5, '0'), 50 + g %% 500, 'Material sintético ' || g,
+                       2 + g %% 15, 5 + g %% 20
+                FROM generate_series(1, %s) g
+            ''', (materiales,))
+            # Cada pedido usa de 1 a 4 materiales distintos (materiales >= 50)
+            cur.execute('''
+                CREATE TEMP TABLE lineas_bench ON COMMIT DROP AS
+                SELECT g AS pedido_id,
+                       'Material ' || lpad(((g * 7 + j * 13) %% %(m)s + 1)::text, 5, '0') AS material,
+                       1 + (g + j) %% 5 AS cantidad,
+                       5 + ((g * 7 + j * 13) %% %(m)s + 1) %% 20 AS precio
+                FROM generate_series(1, %(p)s) g, generate_series(0, 3) j
+                WHERE j <= g %% 4
+            ''', {"m": materiales, "p": pedidos})
+            cur.execute('''
+                INSERT INTO pedidos (id, fecha, cliente, detalle, cantidad, precio_unidad, total, estado,
+                                     materiales_usados, pagado, inventario_descontado)
+                SELECT id, fecha, cliente, detalle, cantidad, total / cantidad, total, estado, materiales,
+                       id %% 3 <> 0, estado IN ('Listos para entregar', 'Entregado')
+                FROM (
+                    SELECT l.pedido_id AS id,
+                           DATE '2023-01-01' + l.pedido_id %% 730 AS fecha,
+                           'Cliente ' || l.pedido_id %% 5000 AS cliente,
+                           'Pedido sintético ' || l.pedido_id AS detalle,
+                           SUM(l.cantidad) AS cantidad,
+                           SUM(l.cantidad * l.precio) AS total,
+                           CASE WHEN l.pedido_id %% 10 < 8 THEN 'Entregado'
+                                ELSE (%s::text[])[1 + l.pedido_id %% 4] END AS estado,
+                           json_agg(json_build_object('material', l.material, 'cantidad', l.cantidad,
+                                                      'precio', l.precio) ORDER BY l.material)::text AS materiales
+                    FROM lineas_bench l
+                    GROUP BY l.pedido_id
+                ) p
+            ''', (ESTADOS,))
+            cur.execute("SELECT setval(pg_get_serial_sequence('pedidos', 'id'), GREATEST(%s, 1))", (pedidos,))
+            cur.execute('''
+                INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+                SELECT pedido_id, material, cantidad, precio FROM lineas_bench
+            ''')
+            cur.execute('''
+                INSERT INTO bajas_material (material, cantidad, fecha, motivo, costo_unitario, costo_total)
+                SELECT 'Material ' || lpad((g %% %s + 1)::text, 5, '0'), 1 + g %% 3,
+                       DATE '2023-01-01' + g %% 730, 'Dañado', 3, 3 * (1 + g %% 3)
+                FROM generate_series(1, %s) g
+            ''', (materiales, max(pedidos // 20, 1)))
+            cur.execute('''
+                INSERT INTO suplidores (nombre, whatsapp, sitio, producto)
+                SELECT 'Suplidor ' || g, '809555' || lpad(g::text, 4, '0'), 'https://suplidor' || g || '.example',
+                       'Materiales varios'
+                FROM generate_series(1, %s) g
+            ''', (suplidores,))
+            cur.execute('''
+                INSERT INTO migraciones_datos (nombre, completada) VALUES ('pedido_materiales', TRUE)
+                ON CONFLICT (nombre) DO UPDATE SET completada = TRUE
+            ''')
+            for tabla in TABLAS_CON_TRIGGERS:
+                cur.execute(f"ALTER TABLE {tabla} ENABLE TRIGGER USER")
+            cur.execute("SELECT finanzas_recalcular()")
+            cur.execute("SELECT reservas_recalcular()")
+            cur.execute("SELECT resumenes_recalcular()")
+            cur.execute("SELECT bajas_por_material_recalcular()")
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE")
+    finally:
+        conn.close()
+
+# Los mismos datos en SQLite, con CTE recursivos en lugar de generate_series.
+# El archivo es nuevo (ver borrar_sqlite) y los triggers del libro de
+# finanzas, del stock reservado, de los resúmenes y de las bajas por material
+# lo mantienen durante la carga.
+def borrar_sqlite(ruta):
+    for sufijo in ("", "-wal", "-shm"):
+        if os.path.exists(ruta + sufijo):
+            os.remove(ruta + sufijo)
+
+def generar_datos_sqlite(ruta, pedidos, materiales, suplidores):
+    conn = _connect_sqlite_original(ruta, isolation_level=None)
+    try:
+        cur = conn.cursor()
+        cur.execute("PRAGMA foreign_keys = ON")
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute('''
+            INSERT INTO inventario (material, cantidad, detalle, precio_compra, precio_venta)
+            WITH RECURSIVE g(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM g WHERE x < :m)
+            SELECT 'Material ' || printf('%05d', x), 50 + x % 500, 'Material sintético ' || x,
+                   2 + x % 15, 5 + x % 20
+            FROM g
+        ''', {"m": materiales})
+        # Cada pedido usa de 1 a 4 materiales distintos (materiales >= 50)
+        cur.execute('''
+            CREATE TEMP TABLE lineas_bench AS
+            WITH RECURSIVE g(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM g WHERE x < :p),
+                 j(y) AS (VALUES (0), (1), (2), (3))
+            SELECT x AS pedido_id,
+                   'Material ' || printf('%05d', (x * 7 + y * 13) % :m + 1) AS material,
+                   1 + (x + y) % 5 AS cantidad,
+                   5 + ((x * 7 + y * 13) % :m + 1) % 20 AS precio
+            FROM g, j
+            WHERE y <= x % 4
+        ''', {"m": materiales, "p": pedidos})
+        cur.execute('''
+            INSERT INTO pedidos (id, fecha, cliente, detalle, cantidad, precio_unidad, total, estado,
+                                 materiales_usados, pagado, inventario_descontado)
+            SELECT id, fecha, cliente, detalle, cantidad, total / cantidad, total, estado, materiales,
+                   id % 3 <> 0, estado IN ('Listos para entregar', 'Entregado')
+            FROM (
+                SELECT l.pedido_id AS id,
+                       date('2023-01-01', '+' || (l.pedido_id % 730) || ' days') AS fecha,
+                       'Cliente ' || l.pedido_id % 5000 AS cliente,
+                       'Pedido sintético ' || l.pedido_id AS detalle,
+                       SUM(l.cantidad) AS cantidad,
+                       SUM(l.cantidad * l.precio) AS total,
+                       CASE WHEN l.pedido_id % 10 < 8 THEN 'Entregado'
+                            ELSE json_extract(:estados, '$[' || (l.pedido_id % 4) || ']') END AS estado,
+                       json_group_array(json_object('material', l.material, 'cantidad', l.cantidad,
+                                                    'precio', l.precio)) AS materiales
+                FROM (SELECT * FROM lineas_bench ORDER BY pedido_id, material) l
+                GROUP BY l.pedido_id
+            )
+            ORDER BY id
+        ''', {"estados": json.dumps(ESTADOS)})
+        cur.execute('''
+            INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+            SELECT pedido_id, material, cantidad, precio FROM lineas_bench ORDER BY pedido_id, material
+        ''')
+        cur.execute('''
+            INSERT INTO bajas_material (material, cantidad, fecha, motivo, costo_unitario, costo_total)
+            WITH RECURSIVE g(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM g WHERE x < :b)
+            SELECT 'Material ' || printf('%05d', x % :m + 1), 1 + x % 3,
+                   date('2023-01-01', '+' || (x % 730) || ' days'), 'Dañado', 3, 3 * (1 + x % 3)
+            FROM g
+        ''', {"m": materiales, "b": max(pedidos // 20, 1)})
+        cur.execute('''
+            INSERT INTO suplidores (nombre, whatsapp, sitio, producto)
+            WITH RECURSIVE g(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM g WHERE x < :s)
+            SELECT 'Suplidor ' || x, '809555' || printf('%04d', x), 'https://suplidor' || x || '.example',
+                   'Materiales varios'
+            FROM g
+        ''', {"s": suplidores})
+        cur.execute('''
+            INSERT INTO migraciones_datos (nombre, completada) VALUES ('pedido_materiales', TRUE)
+            ON CONFLICT (nombre) DO UPDATE SET completada = TRUE
+        ''')
+        cur.execute("COMMIT")
+        cur.execute("ANALYZE")
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+# --- DIBUJO DE PÁGINAS ---
+def nueva_sesion(app, dsn, timeout, pagina=None):
+    at = AppTest.from_file(app, default_timeout=timeout)
+    at.secrets["DATABASE_URL"] = dsn
+    at.session_state["autenticado"] = True
+    at.session_state["usuario_actual"] = "benchmark"
+    if pagina:
+        at.session_state["menu"] = pagina
+    return at
+
+def revisar(at, pagina):
+    if at.exception:
+        raise RuntimeError(f"La página {pagina} falló: {[e.message for e in at.exception]}")
+
+def medir_pagina(app, dsn, pagina, repeticiones, timeout):
+    # Primera visita: como un servidor recién iniciado, con todas las cachés vacías
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    at = nueva_sesion(app, dsn, timeout, pagina)
+    viajes["total"] = 0
+    inicio = time.perf_counter()
+    at.run()
+    primera = time.perf_counter() - inicio
+    viajes_primera = viajes["total"]
+    revisar(at, pagina)
+
+    # Visitas repetidas: reruns de la misma página con las cachés llenas
+    tiempos, viajes_repetida = [], []
+    for _ in range(repeticiones):
+        viajes["total"] = 0
+        inicio = time.perf_counter()
+        at.run()
+        tiempos.append(time.perf_counter() - inicio)
+        viajes_repetida.append(viajes["total"])
+        revisar(at, pagina)
+
+    # Memoria en una corrida aparte: tracemalloc hace más lento el script
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    at = nueva_sesion(app, dsn, timeout, pagina)
+    tracemalloc.start()
+    try:
+        at.run()
+        pico = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    revisar(at, pagina)
+
+    return {
+        "pagina": pagina,
+        "primera_s": round(primera, 4),
+        "repetida_mediana_s": round(statistics.median(tiempos), 4) if tiempos else None,
+        "viajes_primera": viajes_primera,
+        "viajes_repetida": max(viajes_repetida) if viajes_repetida else None,
+        "memoria_pico_mb": round(pico / (1024 * 1024), 2),
+    }
+
+def preparar_esquema(app, dsn, timeout):
+    # Un primer run de la app aplica las migraciones en una base vacía
+    st.cache_resource.clear()
+    at = nueva_sesion(app, dsn, timeout)
+    at.run()
+    revisar(at, "inicio")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de las páginas de PrinThart System")
+    parser.add_argument("--dsn", default=os.environ.get("BENCH_DATABASE_URL"),
+                        help="Base PostgreSQL de pruebas o sqlite:///archivo.db (se borra). "
+                             "También BENCH_DATABASE_URL.")
+    parser.add_argument("--tamanos", default="1000,10000,100000,1000000",
+                        help="Cantidades de pedidos separadas por coma")
+    parser.add_argument("--materiales", type=int, default=500)
+    parser.add_argument("--suplidores", type=int, default=100)
+    parser.add_argument("--paginas", default=",".join(PAGINAS))
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--app", default=APP_POR_DEFECTO)
+    parser.add_argument("--salida", default="benchmark_resultados.json")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("falta --dsn o BENCH_DATABASE_URL")
+    if args.materiales < 50:
+        parser.error("--materiales debe ser al menos 50")
+
+    paginas = [p.strip() for p in args.paginas.split(",") if p.strip()]
+    desconocidas = set(paginas) - set(PAGINAS)
+    if desconocidas:
+        parser.error(f"páginas desconocidas: {', '.join(sorted(desconocidas))}")
+
+    sqlite = args.dsn.startswith(PREFIJO_SQLITE)
+    if not sqlite:
+        preparar_esquema(args.app, args.dsn, args.timeout)
+    resultados = []
+    for tamano in (int(t) for t in args.tamanos.split(",")):
+        inicio = time.perf_counter()
+        if sqlite:
+            borrar_sqlite(args.dsn[len(PREFIJO_SQLITE):])
+            preparar_esquema(args.app, args.dsn, args.timeout)
+        generar_datos(args.dsn, tamano, args.materiales, args.suplidores)
+        generacion = time.perf_counter() - inicio
+        print(f"== {tamano:,} pedidos (datos generados en {generacion:.1f} s)", file=sys.stderr)
+        for pagina in paginas:
+            fila = {"pedidos": tamano, **medir_pagina(args.app, args.dsn, pagina, args.repeticiones, args.timeout)}
+            resultados.append(fila)
+            print(f"   {pagina:<13} primera {fila['primera_s']:>8.3f} s · repetida {fila['repetida_mediana_s']:>8.3f} s"
+                  f" · viajes {fila['viajes_primera']:>4}/{fila['viajes_repetida']:<4}"
+                  f" · memoria {fila['memoria_pico_mb']:>8.2f} MB", file=sys.stderr)
+
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump({
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "app": os.path.abspath(args.app),
+            "parametros": {"materiales": args.materiales, "suplidores": args.suplidores,
+                           "repeticiones": args.repeticiones},
+            "resultados": resultados,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"Resultados guardados en {args.salida}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
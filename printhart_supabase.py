@@ -1,10 +1,29 @@
 import streamlit as st
 import pandas as pd
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN, parse_dsn
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import bisect
+import csv
+import hashlib
+import heapq
+import io
 import json
+import os
+import re
+import select
+import sqlite3
+import tempfile
 import time
-from datetime import date
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import date, timedelta
 
 # --- SISTEMA DE LOGIN ---
 USUARIOS = {
@@ -38,6 +57,9 @@ if not st.session_state["autenticado"]:
     login()
     st.stop()
 
+# Las consultas de cada rerun se anotan desde cero
+st.session_state["consultas_rerun"] = []
+
 # --- SISTEMA DE FONDOS PERSONALIZADOS ---
 if "fondo_activo" not in st.session_state:
     st.session_state.fondo_activo = "default"
@@ -112,24 +134,797 @@ if st.session_state.fondo_activo != "default":
             """
             st.markdown(fondo_css, unsafe_allow_html=True)
 
+# --- INSTRUMENTACIÓN DE CONSULTAS ---
+# Todas las conexiones del pool usan CursorMedido: cada sentencia queda
+# anotada con su huella (el SQL sin espacios de más), cuántos parámetros
+# llevó, las filas, la latencia y lo que se esperó por la conexión. El
+# registro se comparte en el proceso y guarda las consultas más lentas; las
+# de cada rerun se juntan en la sesión para el panel de diagnóstico.
+ADMINISTRADORES = set(st.secrets.get("ADMINS", ["XNecromurlocX"]))
+
+class RegistroConsultas:
+    def __init__(self, top=20, umbral_lento=0.5, archivo_lento=None):
+        self.top = top
+        self.umbral_lento = umbral_lento    # segundos a partir de los que una consulta es lenta
+        self.archivo_lento = archivo_lento  # JSON lines con las consultas lentas (opcional)
+        self._lentas = []                   # montículo [(segundos, orden, medicion)]
+        self._orden = 0
+        self._candado = threading.Lock()
+        self._hilo = threading.local()
+
+    def anotar_espera(self, espera):
+        # La espera por la conexión se carga a la primera consulta que la usa
+        self._hilo.espera = getattr(self._hilo, "espera", 0.0) + espera
+
+    def registrar(self, query, params, filas, segundos):
+        espera = getattr(self._hilo, "espera", 0.0)
+        self._hilo.espera = 0.0
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        texto = " ".join(str(query).split())
+        medicion = {
+            "huella": hashlib.sha1(texto.encode("utf-8")).hexdigest()[:10],
+            "sql": texto[:300],
+            "parametros": contar_parametros(params),
+            "filas": max(filas, 0),
+            "segundos": segundos,
+            "espera": espera,
+            "momento": time.time(),
+        }
+        with self._candado:
+            self._orden += 1
+            entrada = (segundos, self._orden, medicion)
+            if len(self._lentas) < self.top:
+                heapq.heappush(self._lentas, entrada)
+            elif segundos > self._lentas[0][0]:
+                heapq.heapreplace(self._lentas, entrada)
+            if self.archivo_lento and segundos >= self.umbral_lento:
+                try:
+                    with open(self.archivo_lento, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(medicion, ensure_ascii=False) + "\n")
+                except OSError:
+                    pass
+        return medicion
+
+    def mas_lentas(self):
+        with self._candado:
+            return [m for _, _, m in sorted(self._lentas, key=lambda e: e[:2], reverse=True)]
+
+    def limpiar(self):
+        with self._candado:
+            self._lentas = []
+
+@st.cache_resource
+def get_registro_consultas():
+    return RegistroConsultas(
+        top=int(st.secrets.get("SLOW_QUERY_TOP", 20)),
+        umbral_lento=float(st.secrets.get("SLOW_QUERY_MS", 500)) / 1000,
+        archivo_lento=st.secrets.get("SLOW_QUERY_LOG"),
+    )
+
+def contar_parametros(params):
+    if params is None:
+        return 0
+    if isinstance(params, (list, tuple, dict)):
+        return len(params)
+    return 1
+
+def _anotar_consulta(query, params, filas, segundos):
+    medicion = get_registro_consultas().registrar(query, params, filas, segundos)
+    # Solo las consultas hechas desde el script de una sesión cuentan para su rerun
+    if get_script_run_ctx() is not None:
+        st.session_state.setdefault("consultas_rerun", []).append(medicion)
+    return medicion
+
+class CursorMedido(psycopg2.extensions.cursor):
+    def execute(self, query, params=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, params)
+        finally:
+            _anotar_consulta(query, params, self.rowcount, time.perf_counter() - inicio)
+
+    def executemany(self, query, params_lista):
+        params_lista = list(params_lista)
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, params_lista)
+        finally:
+            # Los parámetros de todas las filas del lote
+            total = sum(contar_parametros(p) for p in params_lista)
+            _anotar_consulta(query, [None] * total, self.rowcount, time.perf_counter() - inicio)
+
+    def copy_expert(self, sql, archivo, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return super().copy_expert(sql, archivo, *args, **kwargs)
+        finally:
+            _anotar_consulta(sql, None, self.rowcount, time.perf_counter() - inicio)
+
 # --- CONEXIÓN BASE DE DATOS SUPABASE (PostgreSQL) ---
+# Pool de conexiones compartido por todas las sesiones del servidor. Cada
+# consulta toma una conexión, la usa y la devuelve, así varios usuarios pueden
+# trabajar a la vez sin esperar a que termine la consulta del otro.
+class PoolAgotado(Exception):
+    pass
+
+class PoolConexiones:
+    def __init__(self, dsn, minimo=1, maximo=10, espera_max=15.0, probar_tras=30.0, registro=None):
+        self.dsn = dsn
+        self.registro = registro          # RegistroConsultas que recibe la espera de cada préstamo
+        self.minimo = minimo
+        self.maximo = maximo
+        self.espera_max = espera_max      # segundos máximos esperando una conexión libre
+        self.probar_tras = probar_tras    # segundos de inactividad antes de verificar la conexión
+        self._libres = []                 # [(conexion, ultimo_uso)]
+        self._abiertas = 0
+        self._cond = threading.Condition()
+        self.metricas = {
+            "prestamos": 0,
+            "espera_total": 0.0,
+            "espera_max": 0.0,
+            "timeouts": 0,
+            "reemplazadas": 0,
+        }
+        for _ in range(minimo):
+            self._libres.append((self._nueva(), time.monotonic()))
+            self._abiertas += 1
+
+    def _nueva(self):
+        nueva = psycopg2.connect(self.dsn, cursor_factory=CursorMedido)
+        # Cada sentencia suelta se confirma sola (un viaje al servidor);
+        # las escrituras de varias sentencias usan transaccion()
+        nueva.autocommit = True
+        return nueva
+
+    def _esta_viva(self, conexion, ultimo_uso):
+        if conexion.closed:
+            return False
+        if conexion.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - ultimo_uso < self.probar_tras:
+            return True
+        try:
+            with conexion.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _cerrar(self, conexion):
+        try:
+            conexion.close()
+        except Exception:
+            pass
+
+    def tomar(self):
+        inicio = time.perf_counter()
+        limite = time.monotonic() + self.espera_max
+        with self._cond:
+            while not self._libres and self._abiertas >= self.maximo:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self.metricas["timeouts"] += 1
+                    raise PoolAgotado(f"No hay conexiones libres después de {self.espera_max:.0f} s")
+                self._cond.wait(restante)
+            if self._libres:
+                conexion, ultimo_uso = self._libres.pop()
+            else:
+                conexion, ultimo_uso = None, None
+                self._abiertas += 1
+            espera = time.perf_counter() - inicio
+            self.metricas["prestamos"] += 1
+            self.metricas["espera_total"] += espera
+            self.metricas["espera_max"] = max(self.metricas["espera_max"], espera)
+        if self.registro is not None:
+            self.registro.anotar_espera(espera)
+
+        # Verificar o abrir la conexión fuera del candado para no frenar a los demás
+        try:
+            if conexion is not None and not self._esta_viva(conexion, ultimo_uso):
+                self._cerrar(conexion)
+                conexion = None
+                with self._cond:
+                    self.metricas["reemplazadas"] += 1
+            if conexion is None:
+                conexion = self._nueva()
+        except Exception:
+            with self._cond:
+                self._abiertas -= 1
+                self._cond.notify()
+            raise
+        return conexion
+
+    def devolver(self, conexion):
+        rota = bool(conexion.closed)
+        if not rota:
+            try:
+                if conexion.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+                    rota = True
+                elif conexion.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    conexion.rollback()
+                if not rota and not conexion.autocommit:
+                    conexion.autocommit = True
+            except psycopg2.Error:
+                rota = True
+        with self._cond:
+            if rota:
+                self._cerrar(conexion)
+                self._abiertas -= 1
+            else:
+                self._libres.append((conexion, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def conexion(self):
+        conexion = self.tomar()
+        try:
+            yield conexion
+        finally:
+            self.devolver(conexion)
+
+    def estado(self):
+        with self._cond:
+            prestamos = self.metricas["prestamos"]
+            return {
+                **self.metricas,
+                "abiertas": self._abiertas,
+                "libres": len(self._libres),
+                "en_uso": self._abiertas - len(self._libres),
+                "espera_promedio": self.metricas["espera_total"] / prestamos if prestamos else 0.0,
+            }
+
+@st.cache_resource
+def get_pool():
+    return PoolConexiones(
+        st.secrets["DATABASE_URL"],
+        minimo=int(st.secrets.get("DB_POOL_MIN", 1)),
+        maximo=int(st.secrets.get("DB_POOL_MAX", 10)),
+        espera_max=float(st.secrets.get("DB_POOL_TIMEOUT", 15)),
+        registro=get_registro_consultas(),
+    )
+
+# --- ALMACENAMIENTO ---
+# Toda la app llega a la base de datos a través del almacén elegido en la
+# configuración: PostgreSQL (Supabase) o un archivo SQLite local para las
+# instalaciones de una sola máquina, donde cada consulta tarda menos de un
+# milisegundo porque no sale del proceso. Con DATABASE_URL = "sqlite:///printhart.db"
+# se usa SQLite. Las consultas se escriben con los parámetros de psycopg2
+# (%s y %(nombre)s) y el almacén SQLite las traduce; las sentencias que no se
+# pueden escribir igual en los dos motores se guardan como
+# {"postgresql": ..., "sqlite": ...} y se eligen con sql_del_motor.
+PREFIJO_SQLITE = "sqlite:///"
+
+class AlmacenPostgres:
+    dialecto = "postgresql"
+    nombre = "PostgreSQL"
+    errores_conexion = (psycopg2.OperationalError, psycopg2.InterfaceError)
+    bloqueo_filas = " FOR UPDATE"
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def es_tabla_inexistente(self, error):
+        return isinstance(error, psycopg2.errors.UndefinedTable)
+
+    def conexion(self):
+        return self.pool.conexion()
+
+    @contextmanager
+    def transaccion(self):
+        with self.pool.conexion() as conn:
+            conn.autocommit = False
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def bloquear_migraciones(self, cur):
+        # Candado de PostgreSQL para que dos servidores no migren al mismo tiempo
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (LLAVE_MIGRACIONES,))
+
+    @contextmanager
+    def cursor_lotes(self, tamano):
+        # Cursor del lado del servidor: el resultado llega en trozos de `tamano` filas
+        with self.transaccion() as conn:
+            cur = conn.cursor(name=f"lotes_{uuid.uuid4().hex}")
+            cur.itersize = tamano
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def crear_temporal(self, cur, tabla, columnas):
+        cur.execute(f"CREATE TEMP TABLE {tabla} ({columnas}) ON COMMIT DROP")
+
+    def cargar_filas(self, cur, tabla, columnas, df):
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {tabla} ({columnas}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    def copiar_csv(self, query, params, destino):
+        # COPY (SELECT ...) TO STDOUT: PostgreSQL manda el CSV por partes
+        with self.conexion() as conn:
+            with conn.cursor() as cur:
+                consulta = cur.mogrify(query, params).decode("utf-8")
+                cur.copy_expert(f"COPY ({consulta}) TO STDOUT WITH (FORMAT csv, HEADER)", destino)
+
+    def estado(self):
+        return {**self.pool.estado(), "maximo": self.pool.maximo}
+
+# Parámetros de psycopg2 a los de sqlite3. "= ANY(lista)" pasa a un IN sobre
+# json_each: la lista viaja como un solo parámetro JSON, igual que el arreglo
+# en PostgreSQL, y la sentencia no cambia con el largo de la lista.
+PATRON_PARAMETRO = re.compile(r"=\s*ANY\s*\(\s*%(?:\((\w+)\))?s\s*\)|%\((\w+)\)s|%s|%%|\bILIKE\b", re.IGNORECASE)
+# Las consultas se arman con filtros y listas variables: se recuerdan las
+# traducciones más usadas, no todas las que se hayan visto
+TRADUCCIONES_SQLITE = 1024
+
+@lru_cache(maxsize=TRADUCCIONES_SQLITE)
+def traducir_sqlite(query):
+    def reemplazo(m):
+        texto = m.group(0)
+        if texto.startswith("="):
+            return f"IN (SELECT value FROM json_each({':' + m.group(1) if m.group(1) else '?'}))"
+        if m.group(2):
+            return f":{m.group(2)}"
+        return {"%s": "?", "%%": "%"}.get(texto, "LIKE")
+    return PATRON_PARAMETRO.sub(reemplazo, query)
+
+def parametros_sqlite(params):
+    def valor(v):
+        return json.dumps(list(v)) if isinstance(v, (list, tuple)) else v
+    if params is None:
+        return ()
+    if isinstance(params, dict):
+        return {k: valor(v) for k, v in params.items()}
+    return tuple(valor(v) for v in params)
+
+class CursorSQLite:
+    # Cursor de sqlite3 con la misma forma de uso que el de psycopg2 y la
+    # misma instrumentación que CursorMedido. SQLite no sabe cuántas filas
+    # devuelve un SELECT hasta leerlas, así que se suman al leerlas.
+    def __init__(self, cursor):
+        self._cur = cursor
+        self._medicion = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def execute(self, query, params=None):
+        inicio = time.perf_counter()
+        try:
+            self._cur.execute(traducir_sqlite(query), parametros_sqlite(params))
+        finally:
+            self._medicion = _anotar_consulta(query, params, self._cur.rowcount, time.perf_counter() - inicio)
+        return self
+
+    def executemany(self, query, params_lista):
+        params_lista = [parametros_sqlite(p) for p in params_lista]
+        inicio = time.perf_counter()
+        try:
+            self._cur.executemany(traducir_sqlite(query), params_lista)
+        finally:
+            total = sum(contar_parametros(p) for p in params_lista)
+            self._medicion = _anotar_consulta(query, [None] * total, self._cur.rowcount,
+                                              time.perf_counter() - inicio)
+        return self
+
+    def _leidas(self, filas):
+        if self._medicion is not None:
+            self._medicion["filas"] += len(filas)
+        return filas
+
+    def fetchone(self):
+        fila = self._cur.fetchone()
+        if fila is not None:
+            self._leidas([fila])
+        return fila
+
+    def fetchmany(self, tamano):
+        return self._leidas(self._cur.fetchmany(tamano))
+
+    def fetchall(self):
+        return self._leidas(self._cur.fetchall())
+
+    def close(self):
+        self._cur.close()
+
+class ConexionSQLite:
+    def __init__(self, conexion):
+        self.sqlite = conexion
+
+    def cursor(self):
+        return CursorSQLite(self.sqlite.cursor())
+
+class AlmacenSQLite:
+    dialecto = "sqlite"
+    nombre = "SQLite"
+    errores_conexion = ()   # el archivo es local: no hay conexión que se caiga
+    bloqueo_filas = ""      # BEGIN IMMEDIATE ya toma el candado de escritura
+
+    def __init__(self, ruta, espera_max=15.0):
+        self.ruta = ruta
+        self.espera_max = espera_max      # segundos esperando a que termine otra escritura
+        self._libres = []
+        self._abiertas = 0
+        self._candado = threading.Lock()
+        self.prestamos = 0
+
+    def es_tabla_inexistente(self, error):
+        # OperationalError también cubre "database is locked", errores de
+        # disco y de sintaxis: esos no se toman como una base sin migrar
+        return isinstance(error, sqlite3.OperationalError) and str(error).startswith("no such table")
+
+    def _nueva(self):
+        nueva = sqlite3.connect(self.ruta, timeout=self.espera_max, isolation_level=None,
+                                detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        # WAL: las lecturas no esperan a las escrituras. Con WAL, synchronous
+        # NORMAL no arriesga la integridad del archivo, solo la última
+        # transacción si se va la luz.
+        nueva.execute("PRAGMA journal_mode = WAL")
+        nueva.execute("PRAGMA synchronous = NORMAL")
+        nueva.execute("PRAGMA foreign_keys = ON")
+        return nueva
+
+    @contextmanager
+    def conexion(self):
+        # Cada conexión la usa un solo hilo a la vez; se reutilizan entre reruns
+        with self._candado:
+            conexion = self._libres.pop() if self._libres else None
+            if conexion is None:
+                self._abiertas += 1
+            self.prestamos += 1
+        try:
+            if conexion is None:
+                conexion = self._nueva()
+        except Exception:
+            with self._candado:
+                self._abiertas -= 1
+            raise
+        try:
+            yield ConexionSQLite(conexion)
+        finally:
+            if conexion.in_transaction:
+                conexion.rollback()
+            with self._candado:
+                self._libres.append(conexion)
+
+    @contextmanager
+    def transaccion(self):
+        # BEGIN IMMEDIATE toma el candado de escritura al empezar, así dos
+        # escrituras no chocan a mitad de la transacción
+        with self.conexion() as conn:
+            conn.sqlite.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.sqlite.execute("COMMIT")
+            except Exception:
+                conn.sqlite.execute("ROLLBACK")
+                raise
+
+    def bloquear_migraciones(self, cur):
+        pass
+
+    @contextmanager
+    def cursor_lotes(self, tamano):
+        with self.conexion() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def crear_temporal(self, cur, tabla, columnas):
+        cur.execute(f"DROP TABLE IF EXISTS temp.{tabla}")
+        cur.execute(f"CREATE TEMP TABLE {tabla} ({columnas})")
+
+    def cargar_filas(self, cur, tabla, columnas, df):
+        marcas = ", ".join(["%s"] * len(df.columns))
+        filas = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        cur.executemany(f"INSERT INTO {tabla} ({columnas}) VALUES ({marcas})", filas)
+
+    def copiar_csv(self, query, params, destino, tamano=5000):
+        # El CSV se escribe por bloques de filas, sin tener todo el resultado en memoria
+        texto = io.StringIO()
+        escritor = csv.writer(texto, lineterminator="\n")
+        with self.conexion() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                escritor.writerow([desc[0] for desc in cur.description])
+                while True:
+                    filas = cur.fetchmany(tamano)
+                    escritor.writerows(filas)
+                    destino.write(texto.getvalue().encode("utf-8"))
+                    texto.seek(0)
+                    texto.truncate()
+                    if not filas:
+                        break
+
+    def estado(self):
+        with self._candado:
+            return {
+                "prestamos": self.prestamos,
+                "abiertas": self._abiertas,
+                "libres": len(self._libres),
+                "en_uso": self._abiertas - len(self._libres),
+            }
+
+# Fechas y booleanos de SQLite vuelven con los mismos tipos que da psycopg2
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_converter("DATE", lambda valor: date.fromisoformat(valor.decode()) if valor else None)
+sqlite3.register_converter("BOOLEAN", lambda valor: bool(int(valor)))
+
 @st.cache_resource
-def get_connection():
-    return psycopg2.connect(st.secrets["DATABASE_URL"], cursor_factory=RealDictCursor)
+def get_almacen():
+    url = st.secrets["DATABASE_URL"]
+    if url.startswith(PREFIJO_SQLITE):
+        return AlmacenSQLite(url[len(PREFIJO_SQLITE):],
+                             espera_max=float(st.secrets.get("DB_POOL_TIMEOUT", 15)))
+    return AlmacenPostgres(get_pool())
+
+def sql_del_motor(variantes):
+    if isinstance(variantes, dict):
+        return variantes[get_almacen().dialecto]
+    return variantes
+
+def ejecutar_sentencias(cur, sentencias, params=None):
+    # Una sentencia, o la lista que la reemplaza en un motor, con los mismos
+    # parámetros; devuelve las filas de la última que devolvió columnas
+    filas = None
+    for sentencia in ([sentencias] if isinstance(sentencias, str) else sentencias):
+        if params:
+            cur.execute(sentencia, params)
+        else:
+            cur.execute(sentencia)
+        if cur.description is not None:
+            filas = cur.fetchall()
+    return filas
 
-conn = get_connection()
+def transaccion():
+    # Varias sentencias que se confirman juntas o no se confirman
+    return get_almacen().transaccion()
 
-def get_cursor():
+# Los NUMERIC llegan como float: en la app los montos se manejan como float
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, "DEC2FLOAT",
+    lambda valor, cur: float(valor) if valor is not None else None)
+psycopg2.extensions.register_type(DEC2FLOAT)
+
+# --- VERSIONES DE DATOS ---
+# Contador por tabla compartido por todas las sesiones. Cada escritura sube la
+# versión de las tablas que toca y lo calculado en caché para una versión
+# anterior deja de usarse solo.
+class VersionesDatos:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versiones = {}
+
+    def version(self, *tablas):
+        with self._lock:
+            return tuple(self._versiones.get(t, 0) for t in tablas)
+
+    def subir(self, *tablas):
+        with self._lock:
+            for t in tablas:
+                self._versiones[t] = self._versiones.get(t, 0) + 1
+
+@st.cache_resource
+def get_versiones():
+    return VersionesDatos()
+
+PATRON_ESCRITURA = re.compile(r"\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+# Tablas que cambian por cascada cuando se escribe en otra
+TABLAS_CASCADA = {
+    # Los triggers del libro de finanzas (migración 7), del stock reservado
+    # (migración 10), de los resúmenes (migración 11) y de las bajas por
+    # material (migración 12) los ajustan al escribir en estas tablas
+    "pedidos": ("pedido_materiales", "finanzas", "reservas", "resumen_diario", "resumen_mensual",
+                "resumen_materiales_diario", "resumen_materiales_mensual"),
+    "pedido_materiales": ("finanzas", "reservas", "resumen_materiales_diario", "resumen_materiales_mensual"),
+    "inventario": ("finanzas",),
+    "bajas_material": ("finanzas", "resumen_diario", "resumen_mensual", "bajas_por_material"),
+}
+
+def con_cascada(tablas):
+    resultado = set()
+    for t in tablas:
+        resultado.add(t)
+        resultado.update(TABLAS_CASCADA.get(t, ()))
+    return resultado
+
+def tablas_escritas(query):
+    if not isinstance(query, str):
+        query = "\n".join(query)
+    return con_cascada(t.lower() for t in PATRON_ESCRITURA.findall(query))
+
+# --- AVISOS DE CAMBIOS ENTRE SERVIDORES ---
+# Las versiones de datos solo ven lo que se escribe en este proceso. Con
+# PostgreSQL, los triggers de la migración 8 avisan por NOTIFY qué tabla
+# cambió y un hilo por proceso escucha el canal con su propia conexión: sube la
+# versión de esas tablas y las cachés dejan de servir datos que cambió otro
+# servidor, sin consultar nada ni esperar al TTL. Los avisos de nuestras propias
+# escrituras también llegan y suben otra vez versiones que safe_query ya subió:
+# no se filtran por proceso del servidor porque detrás de un pooler ese proceso
+# lo comparten otros clientes y se perderían avisos de otros servidores.
+#
+# LISTEN necesita una sesión propia en el servidor: detrás de un pooler en modo
+# transacción (el de Supabase en el puerto 6543) los avisos nunca llegan. En ese
+# caso LISTEN_DATABASE_URL debe apuntar a una conexión directa o al pooler en
+# modo sesión; si no está, el oyente no arranca y las cachés se apoyan en el
+# TTL.
+CANAL_CAMBIOS = "printhart_cambios"
+PUERTO_POOLER_TRANSACCION = 6543
+TABLAS_AVISADAS = ("pedidos", "pedido_materiales", "inventario", "bajas_material", "suplidores", "finanzas")
+
+def es_pooler_transaccion(dsn):
     try:
-        conn.isolation_level  # chequea si sigue viva
+        return int(parse_dsn(dsn).get("port", 0)) == PUERTO_POOLER_TRANSACCION
     except Exception:
-        conn = get_connection()
-    return conn.cursor()
+        return False
+
+class OyenteCambios:
+    def __init__(self, dsn, versiones, reintentar_tras=5.0):
+        self.dsn = dsn
+        self.versiones = versiones
+        self.reintentar_tras = reintentar_tras
+        self.escuchando = False
+        self.avisos = 0          # avisos aplicados
+        self.reconexiones = 0
+        self._hilo = threading.Thread(target=self._escuchar, name="printhart-avisos", daemon=True)
+        self._hilo.start()
 
-# --- CREAR TABLAS SI NO EXISTEN ---
-def crear_tablas():
-    cur = get_cursor()
-    cur.execute('''
+    def _escuchar(self):
+        while True:
+            conexion = None
+            try:
+                conexion = psycopg2.connect(self.dsn)
+                conexion.autocommit = True
+                with conexion.cursor() as cur:
+                    cur.execute(f"LISTEN {CANAL_CAMBIOS}")
+                # Al reconectar: lo que cambió mientras no escuchábamos no llegó como aviso
+                if self.reconexiones:
+                    self.versiones.subir(*con_cascada(TABLAS_AVISADAS))
+                self.escuchando = True
+                while True:
+                    if not select.select([conexion], [], [], self.reintentar_tras)[0]:
+                        continue
+                    conexion.poll()
+                    tablas = set()
+                    while conexion.notifies:
+                        tablas.add(conexion.notifies.pop(0).payload)
+                        self.avisos += 1
+                    if tablas:
+                        # Las tablas que ajustan los triggers sin avisar (reservas) van por cascada
+                        self.versiones.subir(*con_cascada(tablas))
+            except Exception:
+                self.escuchando = False
+                self.reconexiones += 1
+                if conexion is not None:
+                    conexion.close()
+                time.sleep(self.reintentar_tras)
+
+    def estado(self):
+        return {
+            "escuchando": self.escuchando,
+            "avisos": self.avisos,
+            "reconexiones": self.reconexiones,
+        }
+
+# --- MIGRACIONES DEL ESQUEMA ---
+# Lista ordenada de cambios al esquema. Cada migración corre en su propia
+# transacción y queda anotada en schema_version; al iniciar solo se aplican
+# las que faltan. Para cambiar el esquema se agrega una migración nueva al
+# final, nunca se edita una que ya se aplicó.
+# Stock reservado (migración 10): se recalcula desde los pedidos abiertos y la
+# vista resta la reserva del stock. Son las mismas sentencias en los dos motores
+SENTENCIAS_RECALCULAR_RESERVAS = [
+    "DELETE FROM reservas",
+    '''
+    INSERT INTO reservas (material, reservado)
+        SELECT pm.material, SUM(pm.cantidad)
+        FROM pedido_materiales pm
+        JOIN pedidos p ON p.id = pm.pedido_id
+        WHERE COALESCE(p.estado NOT IN ('Listos para entregar', 'Entregado'), TRUE)
+        GROUP BY pm.material
+    ''',
+]
+CONSULTA_DISPONIBLE = '''
+    SELECT i.material, i.cantidad, COALESCE(r.reservado, 0) AS reservado,
+           i.cantidad - COALESCE(r.reservado, 0) AS disponible, i.precio_compra, i.precio_venta
+    FROM inventario i
+    LEFT JOIN reservas r ON r.material = i.material
+'''
+
+# Valoración del inventario (migración 12): las bajas acumuladas por material
+# las llevan triggers, así la vista une cada material con una sola fila y su
+# costo no depende de cuántas bajas haya. Mismas sentencias en los dos motores
+SENTENCIAS_RECALCULAR_BAJAS_POR_MATERIAL = [
+    "DELETE FROM bajas_por_material",
+    '''
+    INSERT INTO bajas_por_material (material, cantidad, costo)
+        SELECT material, COALESCE(SUM(cantidad), 0), COALESCE(SUM(costo_total), 0)
+        FROM bajas_material
+        WHERE material IS NOT NULL
+        GROUP BY material
+    ''',
+]
+CONSULTA_VALORACION = '''
+    SELECT i.material, i.cantidad, i.detalle, i.precio_compra, i.precio_venta, i.version,
+           COALESCE(i.precio_venta, 0) - COALESCE(i.precio_compra, 0) AS ganancia_unitaria,
+           COALESCE(b.cantidad, 0) AS cantidad_baja, COALESCE(b.costo, 0) AS costo_baja,
+           COALESCE(i.cantidad, 0) * COALESCE(i.precio_compra, 0) AS inversion_total,
+           COALESCE(i.cantidad, 0) * (COALESCE(i.precio_venta, 0) - COALESCE(i.precio_compra, 0)) AS ganancia_total
+    FROM inventario i
+    LEFT JOIN bajas_por_material b ON b.material = i.material
+'''
+
+# Resúmenes por día y por mes (migración 11). Los costos no se guardan: como en
+# el libro de finanzas usan el precio de compra actual, así que se guarda
+# cuánto de cada material llevan los pedidos entregados y pagados de cada
+# periodo y el reporte lo valoriza al leer.
+TABLAS_RESUMEN = ("resumen_diario", "resumen_mensual", "resumen_materiales_diario", "resumen_materiales_mensual")
+# Primer día del mes de la columna `dia` en cada motor
+SQL_MES_DE_DIA = {"postgresql": "CAST(date_trunc('month', dia) AS DATE)", "sqlite": "date(dia, 'start of month')"}
+
+def sentencias_recalcular_resumenes(motor):
+    # Reconstruye los cuatro resúmenes desde pedidos, pedido_materiales y bajas_material;
+    # los mensuales salen de los diarios
+    mes = SQL_MES_DE_DIA[motor]
+    return [
+        "DELETE FROM resumen_diario",
+        '''
+        INSERT INTO resumen_diario (dia, pedidos, entregas, pagados, ventas_pagadas, ventas_sin_pagar, gastos_baja)
+        SELECT dia, SUM(pedidos), SUM(entregas), SUM(pagados), SUM(ventas_pagadas), SUM(ventas_sin_pagar), SUM(gastos_baja)
+        FROM (
+            SELECT fecha AS dia, 1 AS pedidos,
+                   CASE WHEN estado = 'Entregado' THEN 1 ELSE 0 END AS entregas,
+                   CASE WHEN estado = 'Entregado' AND pagado IS TRUE THEN 1 ELSE 0 END AS pagados,
+                   CASE WHEN estado = 'Entregado' AND pagado IS TRUE THEN COALESCE(total, 0) ELSE 0 END AS ventas_pagadas,
+                   CASE WHEN estado = 'Entregado' AND pagado IS NOT TRUE THEN COALESCE(total, 0) ELSE 0 END AS ventas_sin_pagar,
+                   0 AS gastos_baja
+            FROM pedidos WHERE fecha IS NOT NULL
+            UNION ALL
+            SELECT fecha, 0, 0, 0, 0, 0, COALESCE(costo_total, 0) FROM bajas_material WHERE fecha IS NOT NULL
+        ) movimientos
+        GROUP BY dia
+        ''',
+        "DELETE FROM resumen_mensual",
+        f'''
+        INSERT INTO resumen_mensual (mes, pedidos, entregas, pagados, ventas_pagadas, ventas_sin_pagar, gastos_baja)
+        SELECT {mes}, SUM(pedidos), SUM(entregas), SUM(pagados), SUM(ventas_pagadas), SUM(ventas_sin_pagar), SUM(gastos_baja)
+        FROM resumen_diario GROUP BY {mes}
+        ''',
+        "DELETE FROM resumen_materiales_diario",
+        '''
+        INSERT INTO resumen_materiales_diario (dia, material, cantidad_pagada)
+        SELECT p.fecha, pm.material, SUM(pm.cantidad)
+        FROM pedido_materiales pm
+        JOIN pedidos p ON p.id = pm.pedido_id
+        WHERE p.estado = 'Entregado' AND p.pagado IS TRUE AND p.fecha IS NOT NULL
+        GROUP BY p.fecha, pm.material
+        ''',
+        "DELETE FROM resumen_materiales_mensual",
+        f'''
+        INSERT INTO resumen_materiales_mensual (mes, material, cantidad_pagada)
+        SELECT {mes}, material, SUM(cantidad_pagada) FROM resumen_materiales_diario GROUP BY {mes}, material
+        ''',
+    ]
+
+MIGRACIONES = [
+    (1, "Tablas iniciales", [
+        '''
         CREATE TABLE IF NOT EXISTS pedidos (
             id SERIAL PRIMARY KEY,
             fecha TEXT,
@@ -143,8 +938,8 @@ def crear_tablas():
             pagado BOOLEAN DEFAULT FALSE,
             inventario_descontado BOOLEAN DEFAULT FALSE
         )
-    ''')
-    cur.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS inventario (
             material TEXT PRIMARY KEY,
             cantidad INTEGER,
@@ -152,8 +947,8 @@ def crear_tablas():
             precio_compra REAL DEFAULT 0.0,
             precio_venta REAL DEFAULT 0.0
         )
-    ''')
-    cur.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS bajas_material (
             id SERIAL PRIMARY KEY,
             material TEXT,
@@ -163,8 +958,8 @@ def crear_tablas():
             costo_unitario REAL,
             costo_total REAL
         )
-    ''')
-    cur.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS suplidores (
             id SERIAL PRIMARY KEY,
             nombre TEXT,
@@ -172,90 +967,2610 @@ def crear_tablas():
             sitio TEXT,
             producto TEXT
         )
-    ''')
-    conn.commit()
-    cur.close()
+        ''',
+    ]),
+    # Bases creadas antes de que existieran estas columnas
+    (2, "Columnas pagado e inventario_descontado", [
+        "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS pagado BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS inventario_descontado BOOLEAN DEFAULT FALSE",
+    ]),
+    # Materiales de cada pedido, una fila por (pedido, material).
+    # Sin llave foránea a inventario: un material se puede eliminar del
+    # inventario y los pedidos viejos deben conservar su historial.
+    (3, "Tabla pedido_materiales", [
+        '''
+        CREATE TABLE IF NOT EXISTS pedido_materiales (
+            pedido_id INTEGER NOT NULL REFERENCES pedidos(id) ON DELETE CASCADE,
+            material TEXT NOT NULL,
+            cantidad INTEGER NOT NULL,
+            precio REAL DEFAULT 0.0,
+            PRIMARY KEY (pedido_id, material)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS pedido_materiales_material_idx ON pedido_materiales (material)",
+        '''
+        CREATE TABLE IF NOT EXISTS migraciones_datos (
+            nombre TEXT PRIMARY KEY,
+            ultimo_id INTEGER DEFAULT 0,
+            completada BOOLEAN DEFAULT FALSE
+        )
+        ''',
+    ]),
+    (4, "fecha como DATE", [
+        "ALTER TABLE pedidos ALTER COLUMN fecha TYPE DATE USING NULLIF(fecha::text, '')::date",
+        "ALTER TABLE bajas_material ALTER COLUMN fecha TYPE DATE USING NULLIF(fecha::text, '')::date",
+    ]),
+    # REAL solo guarda ~7 dígitos; los montos pasan a NUMERIC exacto
+    (5, "Montos como NUMERIC", [
+        '''
+        ALTER TABLE pedidos
+            ALTER COLUMN precio_unidad TYPE NUMERIC(12, 2),
+            ALTER COLUMN total TYPE NUMERIC(12, 2)
+        ''',
+        '''
+        ALTER TABLE inventario
+            ALTER COLUMN precio_compra TYPE NUMERIC(12, 2),
+            ALTER COLUMN precio_venta TYPE NUMERIC(12, 2)
+        ''',
+        '''
+        ALTER TABLE bajas_material
+            ALTER COLUMN costo_unitario TYPE NUMERIC(12, 2),
+            ALTER COLUMN costo_total TYPE NUMERIC(12, 2)
+        ''',
+        "ALTER TABLE pedido_materiales ALTER COLUMN precio TYPE NUMERIC(12, 2)",
+    ]),
+    (6, "Índices de búsqueda", [
+        "CREATE INDEX IF NOT EXISTS pedidos_estado_idx ON pedidos (estado)",
+        "CREATE INDEX IF NOT EXISTS pedidos_estado_pagado_idx ON pedidos (estado, pagado)",
+        "CREATE INDEX IF NOT EXISTS pedidos_fecha_idx ON pedidos (fecha)",
+        "CREATE INDEX IF NOT EXISTS bajas_material_material_idx ON bajas_material (material)",
+        "CREATE INDEX IF NOT EXISTS inventario_material_upper_idx ON inventario (UPPER(material))",
+        "CREATE INDEX IF NOT EXISTS suplidores_nombre_upper_idx ON suplidores (UPPER(nombre))",
+    ]),
+    # Libro de finanzas: una sola fila con los totales de entregas que los
+    # triggers ajustan en la misma transacción de cada escritura. Los costos
+    # usan el precio de compra actual, por eso finanzas_materiales guarda
+    # cuánto de cada material llevan los pedidos entregados y pagados.
+    (7, "Libro de finanzas", [
+        '''
+        CREATE TABLE IF NOT EXISTS finanzas (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            ingresos NUMERIC(14,2) NOT NULL DEFAULT 0,
+            costos NUMERIC(14,2) NOT NULL DEFAULT 0,
+            gastos_baja NUMERIC(14,2) NOT NULL DEFAULT 0,
+            entregas BIGINT NOT NULL DEFAULT 0,
+            pagados BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS finanzas_materiales (
+            material TEXT PRIMARY KEY,
+            cantidad_pagada BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION finanzas_recalcular() RETURNS void AS $$
+            DELETE FROM finanzas_materiales;
+            INSERT INTO finanzas_materiales (material, cantidad_pagada)
+                SELECT pm.material, SUM(pm.cantidad)
+                FROM pedido_materiales pm
+                JOIN pedidos p ON p.id = pm.pedido_id
+                WHERE p.estado = 'Entregado' AND p.pagado IS TRUE
+                GROUP BY pm.material;
+            INSERT INTO finanzas (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
+            UPDATE finanzas SET
+                ingresos = (SELECT COALESCE(SUM(total), 0) FROM pedidos
+                            WHERE estado = 'Entregado' AND pagado IS TRUE),
+                costos = (SELECT COALESCE(SUM(f.cantidad_pagada * i.precio_compra), 0)
+                          FROM finanzas_materiales f JOIN inventario i ON i.material = f.material),
+                gastos_baja = (SELECT COALESCE(SUM(costo_total), 0) FROM bajas_material),
+                entregas = (SELECT COUNT(*) FROM pedidos WHERE estado = 'Entregado'),
+                pagados = (SELECT COUNT(*) FROM pedidos WHERE estado = 'Entregado' AND pagado IS TRUE);
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION finanzas_mover(p_material TEXT, p_cantidad BIGINT) RETURNS void AS $$
+            INSERT INTO finanzas_materiales (material, cantidad_pagada) VALUES (p_material, p_cantidad)
+            ON CONFLICT (material) DO UPDATE
+            SET cantidad_pagada = finanzas_materiales.cantidad_pagada + EXCLUDED.cantidad_pagada;
+            UPDATE finanzas
+            SET costos = costos + p_cantidad * COALESCE(
+                (SELECT precio_compra FROM inventario WHERE material = p_material), 0);
+        $$ LANGUAGE sql
+        ''',
+        # Las líneas de un pedido nuevo las suma el trigger de pedido_materiales;
+        # el de pedidos mueve las líneas solo cuando un pedido existente cambia
+        # de pagado o se elimina (BEFORE DELETE: antes de que la cascada las borre)
+        '''
+        CREATE OR REPLACE FUNCTION finanzas_pedidos() RETURNS trigger AS $$
+        DECLARE
+            entregado_antes BOOLEAN := FALSE;
+            pagado_antes BOOLEAN := FALSE;
+            total_antes NUMERIC := 0;
+            entregado_despues BOOLEAN := FALSE;
+            pagado_despues BOOLEAN := FALSE;
+            total_despues NUMERIC := 0;
+            signo INTEGER := 0;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                entregado_antes := COALESCE(OLD.estado = 'Entregado', FALSE);
+                pagado_antes := entregado_antes AND COALESCE(OLD.pagado, FALSE);
+                total_antes := COALESCE(OLD.total, 0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                entregado_despues := COALESCE(NEW.estado = 'Entregado', FALSE);
+                pagado_despues := entregado_despues AND COALESCE(NEW.pagado, FALSE);
+                total_despues := COALESCE(NEW.total, 0);
+            END IF;
+            UPDATE finanzas SET
+                entregas = entregas + entregado_despues::int - entregado_antes::int,
+                pagados = pagados + pagado_despues::int - pagado_antes::int,
+                ingresos = ingresos + CASE WHEN pagado_despues THEN total_despues ELSE 0 END
+                                    - CASE WHEN pagado_antes THEN total_antes ELSE 0 END;
+            IF TG_OP = 'UPDATE' AND pagado_antes <> pagado_despues THEN
+                signo := CASE WHEN pagado_despues THEN 1 ELSE -1 END;
+            ELSIF TG_OP = 'DELETE' AND pagado_antes THEN
+                signo := -1;
+            END IF;
+            IF signo <> 0 THEN
+                PERFORM finanzas_mover(material, signo * SUM(cantidad))
+                FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION finanzas_pedido_materiales() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND EXISTS (
+                SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND estado = 'Entregado' AND pagado IS TRUE
+            ) THEN
+                PERFORM finanzas_mover(OLD.material, -OLD.cantidad);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND EXISTS (
+                SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND estado = 'Entregado' AND pagado IS TRUE
+            ) THEN
+                PERFORM finanzas_mover(NEW.material, NEW.cantidad);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION finanzas_inventario() RETURNS trigger AS $$
+        DECLARE
+            delta NUMERIC := 0;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                delta := delta - COALESCE(OLD.precio_compra, 0) * COALESCE(
+                    (SELECT cantidad_pagada FROM finanzas_materiales WHERE material = OLD.material), 0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                delta := delta + COALESCE(NEW.precio_compra, 0) * COALESCE(
+                    (SELECT cantidad_pagada FROM finanzas_materiales WHERE material = NEW.material), 0);
+            END IF;
+            IF delta <> 0 THEN
+                UPDATE finanzas SET costos = costos + delta;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION finanzas_bajas() RETURNS trigger AS $$
+        DECLARE
+            delta NUMERIC := 0;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                delta := delta - COALESCE(OLD.costo_total, 0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                delta := delta + COALESCE(NEW.costo_total, 0);
+            END IF;
+            IF delta <> 0 THEN
+                UPDATE finanzas SET gastos_baja = gastos_baja + delta;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS finanzas_pedidos_cambios ON pedidos",
+        '''
+        CREATE TRIGGER finanzas_pedidos_cambios AFTER INSERT OR UPDATE ON pedidos
+        FOR EACH ROW EXECUTE FUNCTION finanzas_pedidos()
+        ''',
+        "DROP TRIGGER IF EXISTS finanzas_pedidos_borrado ON pedidos",
+        '''
+        CREATE TRIGGER finanzas_pedidos_borrado BEFORE DELETE ON pedidos
+        FOR EACH ROW EXECUTE FUNCTION finanzas_pedidos()
+        ''',
+        "DROP TRIGGER IF EXISTS finanzas_pedido_materiales ON pedido_materiales",
+        '''
+        CREATE TRIGGER finanzas_pedido_materiales AFTER INSERT OR UPDATE OR DELETE ON pedido_materiales
+        FOR EACH ROW EXECUTE FUNCTION finanzas_pedido_materiales()
+        ''',
+        "DROP TRIGGER IF EXISTS finanzas_inventario ON inventario",
+        '''
+        CREATE TRIGGER finanzas_inventario AFTER INSERT OR DELETE OR UPDATE OF material, precio_compra ON inventario
+        FOR EACH ROW EXECUTE FUNCTION finanzas_inventario()
+        ''',
+        "DROP TRIGGER IF EXISTS finanzas_bajas ON bajas_material",
+        '''
+        CREATE TRIGGER finanzas_bajas AFTER INSERT OR UPDATE OR DELETE ON bajas_material
+        FOR EACH ROW EXECUTE FUNCTION finanzas_bajas()
+        ''',
+        "SELECT finanzas_recalcular()",
+    ]),
+    (8, "Avisos de cambios entre servidores", [
+        # Un NOTIFY por sentencia con el nombre de la tabla. PostgreSQL junta los
+        # avisos iguales de una transacción: una importación de miles de filas
+        # manda un solo aviso por tabla
+        f'''
+        CREATE OR REPLACE FUNCTION avisar_cambio() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CANAL_CAMBIOS}', TG_TABLE_NAME);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+    ] + [
+        sentencia
+        for tabla in TABLAS_AVISADAS
+        for sentencia in (
+            f"DROP TRIGGER IF EXISTS avisar_cambio ON {tabla}",
+            f"CREATE TRIGGER avisar_cambio AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {tabla} "
+            "FOR EACH STATEMENT EXECUTE FUNCTION avisar_cambio()",
+        )
+    ]),
+    (9, "Versión de fila en inventario y pedidos", [
+        # Cada UPDATE sube la versión de la fila, venga de donde venga: una
+        # edición que se preparó con una versión vieja ya no encuentra su fila
+        "ALTER TABLE inventario ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+        '''
+        CREATE OR REPLACE FUNCTION subir_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := OLD.version + 1;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS subir_version ON inventario",
+        "CREATE TRIGGER subir_version BEFORE UPDATE ON inventario FOR EACH ROW EXECUTE FUNCTION subir_version()",
+        "DROP TRIGGER IF EXISTS subir_version ON pedidos",
+        "CREATE TRIGGER subir_version BEFORE UPDATE ON pedidos FOR EACH ROW EXECUTE FUNCTION subir_version()",
+    ]),
+    # Stock reservado: lo que piden los pedidos abiertos (los que todavía no
+    # descontaron inventario). Los triggers lo ajustan igual que el libro de
+    # finanzas y la vista inventario_disponible resta la reserva del stock.
+    (10, "Stock reservado por pedidos abiertos", [
+        '''
+        CREATE TABLE IF NOT EXISTS reservas (
+            material TEXT PRIMARY KEY,
+            reservado BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        f'''
+        CREATE OR REPLACE FUNCTION reservas_recalcular() RETURNS void AS $$
+            {"; ".join(SENTENCIAS_RECALCULAR_RESERVAS)};
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION reservas_mover(p_material TEXT, p_cantidad BIGINT) RETURNS void AS $$
+            INSERT INTO reservas (material, reservado) VALUES (p_material, p_cantidad)
+            ON CONFLICT (material) DO UPDATE SET reservado = reservas.reservado + EXCLUDED.reservado;
+        $$ LANGUAGE sql
+        ''',
+        # Como en finanzas: las líneas de un pedido nuevo las suma el trigger de
+        # pedido_materiales; el de pedidos las mueve cuando el pedido se abre o
+        # se cierra, o se elimina (BEFORE DELETE: antes de que la cascada las borre)
+        '''
+        CREATE OR REPLACE FUNCTION reservas_pedidos() RETURNS trigger AS $$
+        DECLARE
+            abierto_antes BOOLEAN := COALESCE(OLD.estado NOT IN ('Listos para entregar', 'Entregado'), TRUE);
+            signo INTEGER := 0;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                IF abierto_antes THEN
+                    signo := -1;
+                END IF;
+            ELSIF abierto_antes <> COALESCE(NEW.estado NOT IN ('Listos para entregar', 'Entregado'), TRUE) THEN
+                signo := CASE WHEN abierto_antes THEN -1 ELSE 1 END;
+            END IF;
+            IF signo <> 0 THEN
+                PERFORM reservas_mover(material, signo * SUM(cantidad))
+                FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION reservas_pedido_materiales() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND EXISTS (
+                SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND COALESCE(estado NOT IN ('Listos para entregar', 'Entregado'), TRUE)
+            ) THEN
+                PERFORM reservas_mover(OLD.material, -OLD.cantidad);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND EXISTS (
+                SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND COALESCE(estado NOT IN ('Listos para entregar', 'Entregado'), TRUE)
+            ) THEN
+                PERFORM reservas_mover(NEW.material, NEW.cantidad);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS reservas_pedidos_estado ON pedidos",
+        '''
+        CREATE TRIGGER reservas_pedidos_estado AFTER UPDATE OF estado ON pedidos
+        FOR EACH ROW EXECUTE FUNCTION reservas_pedidos()
+        ''',
+        "DROP TRIGGER IF EXISTS reservas_pedidos_borrado ON pedidos",
+        '''
+        CREATE TRIGGER reservas_pedidos_borrado BEFORE DELETE ON pedidos
+        FOR EACH ROW EXECUTE FUNCTION reservas_pedidos()
+        ''',
+        "DROP TRIGGER IF EXISTS reservas_pedido_materiales ON pedido_materiales",
+        '''
+        CREATE TRIGGER reservas_pedido_materiales AFTER INSERT OR UPDATE OR DELETE ON pedido_materiales
+        FOR EACH ROW EXECUTE FUNCTION reservas_pedido_materiales()
+        ''',
+        "CREATE OR REPLACE VIEW inventario_disponible AS" + CONSULTA_DISPONIBLE,
+        "SELECT reservas_recalcular()",
+    ]),
+    # Resúmenes por día y por mes para los reportes. Los triggers los ajustan
+    # en la misma transacción de cada escritura, como el libro de finanzas
+    (11, "Resúmenes diarios y mensuales", [
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_diario (
+            dia DATE PRIMARY KEY,
+            pedidos BIGINT NOT NULL DEFAULT 0,
+            entregas BIGINT NOT NULL DEFAULT 0,
+            pagados BIGINT NOT NULL DEFAULT 0,
+            ventas_pagadas NUMERIC(14,2) NOT NULL DEFAULT 0,
+            ventas_sin_pagar NUMERIC(14,2) NOT NULL DEFAULT 0,
+            gastos_baja NUMERIC(14,2) NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_mensual (
+            mes DATE PRIMARY KEY,
+            pedidos BIGINT NOT NULL DEFAULT 0,
+            entregas BIGINT NOT NULL DEFAULT 0,
+            pagados BIGINT NOT NULL DEFAULT 0,
+            ventas_pagadas NUMERIC(14,2) NOT NULL DEFAULT 0,
+            ventas_sin_pagar NUMERIC(14,2) NOT NULL DEFAULT 0,
+            gastos_baja NUMERIC(14,2) NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_materiales_diario (
+            dia DATE,
+            material TEXT,
+            cantidad_pagada BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, material)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_materiales_mensual (
+            mes DATE,
+            material TEXT,
+            cantidad_pagada BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (mes, material)
+        )
+        ''',
+        f'''
+        CREATE OR REPLACE FUNCTION resumenes_recalcular() RETURNS void AS $$
+            {"; ".join(sentencias_recalcular_resumenes("postgresql"))};
+        $$ LANGUAGE sql
+        ''',
+        # Suma un movimiento al día y a su mes (nada si el día es NULL)
+        '''
+        CREATE OR REPLACE FUNCTION resumen_mover(p_dia DATE, p_pedidos INTEGER, p_entregas INTEGER,
+                                                 p_pagados INTEGER, p_ventas_pagadas NUMERIC,
+                                                 p_ventas_sin_pagar NUMERIC, p_gastos_baja NUMERIC) RETURNS void AS $$
+            INSERT INTO resumen_diario (dia, pedidos, entregas, pagados, ventas_pagadas, ventas_sin_pagar, gastos_baja)
+            SELECT p_dia, p_pedidos, p_entregas, p_pagados, p_ventas_pagadas, p_ventas_sin_pagar, p_gastos_baja
+            WHERE p_dia IS NOT NULL
+            ON CONFLICT (dia) DO UPDATE SET
+                pedidos = resumen_diario.pedidos + EXCLUDED.pedidos,
+                entregas = resumen_diario.entregas + EXCLUDED.entregas,
+                pagados = resumen_diario.pagados + EXCLUDED.pagados,
+                ventas_pagadas = resumen_diario.ventas_pagadas + EXCLUDED.ventas_pagadas,
+                ventas_sin_pagar = resumen_diario.ventas_sin_pagar + EXCLUDED.ventas_sin_pagar,
+                gastos_baja = resumen_diario.gastos_baja + EXCLUDED.gastos_baja;
+            INSERT INTO resumen_mensual (mes, pedidos, entregas, pagados, ventas_pagadas, ventas_sin_pagar, gastos_baja)
+            SELECT CAST(date_trunc('month', p_dia) AS DATE), p_pedidos, p_entregas, p_pagados,
+                   p_ventas_pagadas, p_ventas_sin_pagar, p_gastos_baja
+            WHERE p_dia IS NOT NULL
+            ON CONFLICT (mes) DO UPDATE SET
+                pedidos = resumen_mensual.pedidos + EXCLUDED.pedidos,
+                entregas = resumen_mensual.entregas + EXCLUDED.entregas,
+                pagados = resumen_mensual.pagados + EXCLUDED.pagados,
+                ventas_pagadas = resumen_mensual.ventas_pagadas + EXCLUDED.ventas_pagadas,
+                ventas_sin_pagar = resumen_mensual.ventas_sin_pagar + EXCLUDED.ventas_sin_pagar,
+                gastos_baja = resumen_mensual.gastos_baja + EXCLUDED.gastos_baja;
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION resumen_mover_material(p_dia DATE, p_material TEXT, p_cantidad BIGINT) RETURNS void AS $$
+            INSERT INTO resumen_materiales_diario (dia, material, cantidad_pagada)
+            SELECT p_dia, p_material, p_cantidad WHERE p_dia IS NOT NULL
+            ON CONFLICT (dia, material) DO UPDATE
+            SET cantidad_pagada = resumen_materiales_diario.cantidad_pagada + EXCLUDED.cantidad_pagada;
+            INSERT INTO resumen_materiales_mensual (mes, material, cantidad_pagada)
+            SELECT CAST(date_trunc('month', p_dia) AS DATE), p_material, p_cantidad WHERE p_dia IS NOT NULL
+            ON CONFLICT (mes, material) DO UPDATE
+            SET cantidad_pagada = resumen_materiales_mensual.cantidad_pagada + EXCLUDED.cantidad_pagada;
+        $$ LANGUAGE sql
+        ''',
+        # Un pedido resta lo que aportaba con sus valores viejos y suma lo que
+        # aporta con los nuevos. Sus líneas se mueven cuando entra o sale de
+        # "entregado y pagado" o cambia de fecha siéndolo (BEFORE DELETE: antes
+        # de que la cascada las borre)
+        '''
+        CREATE OR REPLACE FUNCTION resumen_pedidos() RETURNS trigger AS $$
+        DECLARE
+            pagado_antes BOOLEAN := FALSE;
+            pagado_despues BOOLEAN := FALSE;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                pagado_antes := COALESCE(OLD.estado = 'Entregado' AND OLD.pagado, FALSE);
+                PERFORM resumen_mover(
+                    OLD.fecha, -1, -COALESCE(OLD.estado = 'Entregado', FALSE)::int, -pagado_antes::int,
+                    CASE WHEN pagado_antes THEN -COALESCE(OLD.total, 0) ELSE 0 END,
+                    CASE WHEN OLD.estado = 'Entregado' AND NOT pagado_antes THEN -COALESCE(OLD.total, 0) ELSE 0 END,
+                    0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                pagado_despues := COALESCE(NEW.estado = 'Entregado' AND NEW.pagado, FALSE);
+                PERFORM resumen_mover(
+                    NEW.fecha, 1, COALESCE(NEW.estado = 'Entregado', FALSE)::int, pagado_despues::int,
+                    CASE WHEN pagado_despues THEN COALESCE(NEW.total, 0) ELSE 0 END,
+                    CASE WHEN NEW.estado = 'Entregado' AND NOT pagado_despues THEN COALESCE(NEW.total, 0) ELSE 0 END,
+                    0);
+            END IF;
+            IF TG_OP = 'DELETE' OR pagado_antes <> pagado_despues
+               OR (pagado_antes AND OLD.fecha IS DISTINCT FROM NEW.fecha) THEN
+                IF pagado_antes THEN
+                    PERFORM resumen_mover_material(OLD.fecha, material, -SUM(cantidad))
+                    FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material;
+                END IF;
+                IF pagado_despues THEN
+                    PERFORM resumen_mover_material(NEW.fecha, material, SUM(cantidad))
+                    FROM pedido_materiales WHERE pedido_id = NEW.id GROUP BY material;
+                END IF;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION resumen_pedido_materiales() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM resumen_mover_material(p.fecha, OLD.material, -OLD.cantidad)
+                FROM pedidos p WHERE p.id = OLD.pedido_id AND p.estado = 'Entregado' AND p.pagado IS TRUE;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM resumen_mover_material(p.fecha, NEW.material, NEW.cantidad)
+                FROM pedidos p WHERE p.id = NEW.pedido_id AND p.estado = 'Entregado' AND p.pagado IS TRUE;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION resumen_bajas() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM resumen_mover(OLD.fecha, 0, 0, 0, 0, 0, -COALESCE(OLD.costo_total, 0));
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM resumen_mover(NEW.fecha, 0, 0, 0, 0, 0, COALESCE(NEW.costo_total, 0));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS resumen_pedidos_cambios ON pedidos",
+        '''
+        CREATE TRIGGER resumen_pedidos_cambios AFTER INSERT OR UPDATE OF fecha, estado, pagado, total ON pedidos
+        FOR EACH ROW EXECUTE FUNCTION resumen_pedidos()
+        ''',
+        "DROP TRIGGER IF EXISTS resumen_pedidos_borrado ON pedidos",
+        '''
+        CREATE TRIGGER resumen_pedidos_borrado BEFORE DELETE ON pedidos
+        FOR EACH ROW EXECUTE FUNCTION resumen_pedidos()
+        ''',
+        "DROP TRIGGER IF EXISTS resumen_pedido_materiales ON pedido_materiales",
+        '''
+        CREATE TRIGGER resumen_pedido_materiales AFTER INSERT OR UPDATE OR DELETE ON pedido_materiales
+        FOR EACH ROW EXECUTE FUNCTION resumen_pedido_materiales()
+        ''',
+        "DROP TRIGGER IF EXISTS resumen_bajas ON bajas_material",
+        '''
+        CREATE TRIGGER resumen_bajas AFTER INSERT OR UPDATE OR DELETE ON bajas_material
+        FOR EACH ROW EXECUTE FUNCTION resumen_bajas()
+        ''',
+        "SELECT resumenes_recalcular()",
+    ]),
+    # Valoración del inventario: bajas acumuladas por material y la vista que
+    # calcula inversión y ganancia de cada material en la base de datos.
+    (12, "Valoración del inventario", [
+        '''
+        CREATE TABLE IF NOT EXISTS bajas_por_material (
+            material TEXT PRIMARY KEY,
+            cantidad BIGINT NOT NULL DEFAULT 0,
+            costo NUMERIC(14, 2) NOT NULL DEFAULT 0
+        )
+        ''',
+        f'''
+        CREATE OR REPLACE FUNCTION bajas_por_material_recalcular() RETURNS void AS $$
+            {"; ".join(SENTENCIAS_RECALCULAR_BAJAS_POR_MATERIAL)};
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION bajas_por_material_mover(p_material TEXT, p_cantidad BIGINT, p_costo NUMERIC)
+        RETURNS void AS $$
+            INSERT INTO bajas_por_material (material, cantidad, costo)
+            SELECT p_material, COALESCE(p_cantidad, 0), COALESCE(p_costo, 0) WHERE p_material IS NOT NULL
+            ON CONFLICT (material) DO UPDATE SET
+                cantidad = bajas_por_material.cantidad + EXCLUDED.cantidad,
+                costo = bajas_por_material.costo + EXCLUDED.costo;
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION bajas_por_material() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM bajas_por_material_mover(OLD.material, -OLD.cantidad, -OLD.costo_total);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM bajas_por_material_mover(NEW.material, NEW.cantidad, NEW.costo_total);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS bajas_por_material ON bajas_material",
+        '''
+        CREATE TRIGGER bajas_por_material AFTER INSERT OR UPDATE OR DELETE ON bajas_material
+        FOR EACH ROW EXECUTE FUNCTION bajas_por_material()
+        ''',
+        "CREATE OR REPLACE VIEW inventario_valoracion AS" + CONSULTA_VALORACION,
+        "SELECT bajas_por_material_recalcular()",
+    ]),
+    # resumen_pedidos() de la migración 11 también movía las líneas al insertar
+    # un pedido entregado y pagado, y las que llegan en la misma sentencia
+    # (importación) se contaban dos veces. Se corrige y se rehacen los resúmenes.
+    (13, "Líneas de pedidos nuevos en los resúmenes", [
+        '''
+        CREATE OR REPLACE FUNCTION resumen_pedidos() RETURNS trigger AS $$
+        DECLARE
+            pagado_antes BOOLEAN := FALSE;
+            pagado_despues BOOLEAN := FALSE;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                pagado_antes := COALESCE(OLD.estado = 'Entregado' AND OLD.pagado, FALSE);
+                PERFORM resumen_mover(
+                    OLD.fecha, -1, -COALESCE(OLD.estado = 'Entregado', FALSE)::int, -pagado_antes::int,
+                    CASE WHEN pagado_antes THEN -COALESCE(OLD.total, 0) ELSE 0 END,
+                    CASE WHEN OLD.estado = 'Entregado' AND NOT pagado_antes THEN -COALESCE(OLD.total, 0) ELSE 0 END,
+                    0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                pagado_despues := COALESCE(NEW.estado = 'Entregado' AND NEW.pagado, FALSE);
+                PERFORM resumen_mover(
+                    NEW.fecha, 1, COALESCE(NEW.estado = 'Entregado', FALSE)::int, pagado_despues::int,
+                    CASE WHEN pagado_despues THEN COALESCE(NEW.total, 0) ELSE 0 END,
+                    CASE WHEN NEW.estado = 'Entregado' AND NOT pagado_despues THEN COALESCE(NEW.total, 0) ELSE 0 END,
+                    0);
+            END IF;
+            -- En un INSERT las líneas las suma el trigger de pedido_materiales:
+            -- la importación inserta pedidos y líneas en una sola sentencia y
+            -- este trigger ya las vería, así que contarlas aquí las duplicaría
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND (pagado_antes <> pagado_despues
+               OR (pagado_antes AND OLD.fecha IS DISTINCT FROM NEW.fecha))) THEN
+                IF pagado_antes THEN
+                    PERFORM resumen_mover_material(OLD.fecha, material, -SUM(cantidad))
+                    FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material;
+                END IF;
+                IF pagado_despues THEN
+                    PERFORM resumen_mover_material(NEW.fecha, material, SUM(cantidad))
+                    FROM pedido_materiales WHERE pedido_id = NEW.id GROUP BY material;
+                END IF;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "SELECT resumenes_recalcular()",
+    ]),
+]
 
-crear_tablas()
+# Recalcular el libro de finanzas desde el historial. En PostgreSQL es la
+# función finanzas_recalcular(); SQLite no tiene funciones en SQL, así que
+# corre las mismas sentencias una tras otra.
+SENTENCIAS_RECALCULAR_FINANZAS = [
+    "DELETE FROM finanzas_materiales",
+    '''
+    INSERT INTO finanzas_materiales (material, cantidad_pagada)
+        SELECT pm.material, SUM(pm.cantidad)
+        FROM pedido_materiales pm
+        JOIN pedidos p ON p.id = pm.pedido_id
+        WHERE p.estado = 'Entregado' AND p.pagado IS TRUE
+        GROUP BY pm.material
+    ''',
+    "INSERT INTO finanzas (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING",
+    '''
+    UPDATE finanzas SET
+        ingresos = (SELECT COALESCE(SUM(total), 0) FROM pedidos
+                    WHERE estado = 'Entregado' AND pagado IS TRUE),
+        costos = (SELECT COALESCE(SUM(f.cantidad_pagada * i.precio_compra), 0)
+                  FROM finanzas_materiales f JOIN inventario i ON i.material = f.material),
+        gastos_baja = (SELECT COALESCE(SUM(costo_total), 0) FROM bajas_material),
+        entregas = (SELECT COUNT(*) FROM pedidos WHERE estado = 'Entregado'),
+        pagados = (SELECT COUNT(*) FROM pedidos WHERE estado = 'Entregado' AND pagado IS TRUE)
+    ''',
+]
+SQL_RECALCULAR_FINANZAS = {
+    "postgresql": "SELECT finanzas_recalcular()",
+    "sqlite": SENTENCIAS_RECALCULAR_FINANZAS,
+}
+SQL_RECALCULAR_RESUMENES = {
+    "postgresql": "SELECT resumenes_recalcular()",
+    "sqlite": sentencias_recalcular_resumenes("sqlite"),
+}
 
-# Migración: agregar columna 'pagado' si no existe
-try:
-    cur = get_cursor()
-    cur.execute("ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS pagado BOOLEAN DEFAULT FALSE")
-    conn.commit()
-    cur.close()
-except:
-    pass
+# Los triggers de resúmenes en SQLite suman filas (dia, ...) al día y a su mes
+# con un upsert por tabla; estas funciones arman los dos upserts a partir de
+# un SELECT que devuelve esas columnas.
+def _sqlite_sumar_resumen(filas):
+    return [
+        f'''
+            INSERT INTO {tabla} ({llave}, pedidos, entregas, pagados, ventas_pagadas, ventas_sin_pagar, gastos_baja)
+            SELECT {periodo}, pedidos, entregas, pagados, ventas_pagadas, ventas_sin_pagar, gastos_baja
+            FROM ({filas}) WHERE dia IS NOT NULL
+            ON CONFLICT ({llave}) DO UPDATE SET
+                pedidos = pedidos + excluded.pedidos,
+                entregas = entregas + excluded.entregas,
+                pagados = pagados + excluded.pagados,
+                ventas_pagadas = ventas_pagadas + excluded.ventas_pagadas,
+                ventas_sin_pagar = ventas_sin_pagar + excluded.ventas_sin_pagar,
+                gastos_baja = gastos_baja + excluded.gastos_baja;'''
+        for tabla, llave, periodo in (("resumen_diario", "dia", "dia"),
+                                      ("resumen_mensual", "mes", SQL_MES_DE_DIA["sqlite"]))
+    ]
 
-# Migración: agregar columna 'inventario_descontado' si no existe
-try:
-    cur = get_cursor()
-    cur.execute("ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS inventario_descontado BOOLEAN DEFAULT FALSE")
-    conn.commit()
-    cur.close()
-except:
-    pass
+def _sqlite_sumar_materiales(filas):
+    return [
+        f'''
+            INSERT INTO {tabla} ({llave}, material, cantidad_pagada)
+            SELECT {periodo}, material, cantidad FROM ({filas}) WHERE dia IS NOT NULL
+            ON CONFLICT ({llave}, material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;'''
+        for tabla, llave, periodo in (("resumen_materiales_diario", "dia", "dia"),
+                                      ("resumen_materiales_mensual", "mes", SQL_MES_DE_DIA["sqlite"]))
+    ]
+
+def _sqlite_aporte_pedido(fila, signo):
+    # Lo que un pedido (NEW u OLD) aporta a su día, con signo
+    return f'''SELECT {fila}.fecha AS dia, {signo} AS pedidos,
+                   {signo} * COALESCE({fila}.estado = 'Entregado', 0) AS entregas,
+                   {signo} * COALESCE({fila}.estado = 'Entregado' AND {fila}.pagado, 0) AS pagados,
+                   CASE WHEN {fila}.estado = 'Entregado' AND {fila}.pagado
+                        THEN {signo} * COALESCE({fila}.total, 0) ELSE 0 END AS ventas_pagadas,
+                   CASE WHEN {fila}.estado = 'Entregado' AND NOT COALESCE({fila}.pagado, 0)
+                        THEN {signo} * COALESCE({fila}.total, 0) ELSE 0 END AS ventas_sin_pagar,
+                   0 AS gastos_baja'''
+
+def _sqlite_aporte_lineas(fila, signo):
+    # Las líneas de un pedido entregado y pagado, en su día
+    return (f"SELECT {fila}.fecha AS dia, material, {signo} * SUM(cantidad) AS cantidad "
+            f"FROM pedido_materiales WHERE pedido_id = {fila}.id "
+            f"AND {fila}.estado = 'Entregado' AND {fila}.pagado GROUP BY material")
+
+def _sqlite_aporte_linea(fila, signo):
+    # Una línea de pedido_materiales (NEW u OLD) si su pedido está entregado y pagado
+    return (f"SELECT p.fecha AS dia, {fila}.material AS material, {signo} * {fila}.cantidad AS cantidad "
+            f"FROM pedidos p WHERE p.id = {fila}.pedido_id AND p.estado = 'Entregado' AND p.pagado IS TRUE")
+
+def _sqlite_aporte_baja(fila, signo):
+    return (f"SELECT {fila}.fecha AS dia, 0 AS pedidos, 0 AS entregas, 0 AS pagados, 0 AS ventas_pagadas, "
+            f"0 AS ventas_sin_pagar, {signo} * COALESCE({fila}.costo_total, 0) AS gastos_baja")
+
+def _sqlite_trigger(nombre, evento, sentencias, cuando=None):
+    return (f"CREATE TRIGGER IF NOT EXISTS {nombre} {evento}"
+            + (f"\n        WHEN {cuando}" if cuando else "")
+            + "\n        BEGIN" + "".join(sentencias) + "\n        END")
+
+# Esquema de SQLite. Una base SQLite nueva empieza con el esquema completo de
+# las migraciones 1 a 7 de PostgreSQL, así las migraciones siguientes llevan
+# el mismo número en los dos motores. Los triggers del libro hacen lo mismo que
+# las funciones de PostgreSQL: SQLite pide un trigger por evento y no tiene
+# variables, por eso las condiciones se repiten en cada sentencia.
+MIGRACIONES_SQLITE = [
+    (7, "Esquema inicial", [
+        '''
+        CREATE TABLE IF NOT EXISTS pedidos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha DATE,
+            cliente TEXT,
+            detalle TEXT,
+            cantidad INTEGER,
+            precio_unidad REAL DEFAULT 0.0,
+            total REAL,
+            estado TEXT,
+            materiales_usados TEXT,
+            pagado BOOLEAN DEFAULT FALSE,
+            inventario_descontado BOOLEAN DEFAULT FALSE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS inventario (
+            material TEXT PRIMARY KEY,
+            cantidad INTEGER,
+            detalle TEXT,
+            precio_compra REAL DEFAULT 0.0,
+            precio_venta REAL DEFAULT 0.0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bajas_material (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            material TEXT,
+            cantidad INTEGER,
+            fecha DATE,
+            motivo TEXT,
+            costo_unitario REAL,
+            costo_total REAL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS suplidores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT,
+            whatsapp TEXT,
+            sitio TEXT,
+            producto TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS pedido_materiales (
+            pedido_id INTEGER NOT NULL REFERENCES pedidos(id) ON DELETE CASCADE,
+            material TEXT NOT NULL,
+            cantidad INTEGER NOT NULL,
+            precio REAL DEFAULT 0.0,
+            PRIMARY KEY (pedido_id, material)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS migraciones_datos (
+            nombre TEXT PRIMARY KEY,
+            ultimo_id INTEGER DEFAULT 0,
+            completada BOOLEAN DEFAULT FALSE
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS pedido_materiales_material_idx ON pedido_materiales (material)",
+        "CREATE INDEX IF NOT EXISTS pedidos_estado_idx ON pedidos (estado)",
+        "CREATE INDEX IF NOT EXISTS pedidos_estado_pagado_idx ON pedidos (estado, pagado)",
+        "CREATE INDEX IF NOT EXISTS pedidos_fecha_idx ON pedidos (fecha)",
+        "CREATE INDEX IF NOT EXISTS bajas_material_material_idx ON bajas_material (material)",
+        "CREATE INDEX IF NOT EXISTS inventario_material_upper_idx ON inventario (UPPER(material))",
+        "CREATE INDEX IF NOT EXISTS suplidores_nombre_upper_idx ON suplidores (UPPER(nombre))",
+        '''
+        CREATE TABLE IF NOT EXISTS finanzas (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            ingresos REAL NOT NULL DEFAULT 0,
+            costos REAL NOT NULL DEFAULT 0,
+            gastos_baja REAL NOT NULL DEFAULT 0,
+            entregas INTEGER NOT NULL DEFAULT 0,
+            pagados INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS finanzas_materiales (
+            material TEXT PRIMARY KEY,
+            cantidad_pagada INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedidos_alta AFTER INSERT ON pedidos
+        BEGIN
+            UPDATE finanzas SET
+                entregas = entregas + COALESCE(NEW.estado = 'Entregado', 0),
+                pagados = pagados + (COALESCE(NEW.estado = 'Entregado', 0) AND COALESCE(NEW.pagado, 0)),
+                ingresos = ingresos + CASE WHEN NEW.estado = 'Entregado' AND NEW.pagado
+                                           THEN COALESCE(NEW.total, 0) ELSE 0 END;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedidos_cambios AFTER UPDATE ON pedidos
+        BEGIN
+            UPDATE finanzas SET
+                entregas = entregas + COALESCE(NEW.estado = 'Entregado', 0)
+                                    - COALESCE(OLD.estado = 'Entregado', 0),
+                pagados = pagados + (COALESCE(NEW.estado = 'Entregado', 0) AND COALESCE(NEW.pagado, 0))
+                                  - (COALESCE(OLD.estado = 'Entregado', 0) AND COALESCE(OLD.pagado, 0)),
+                ingresos = ingresos + CASE WHEN NEW.estado = 'Entregado' AND NEW.pagado
+                                           THEN COALESCE(NEW.total, 0) ELSE 0 END
+                                    - CASE WHEN OLD.estado = 'Entregado' AND OLD.pagado
+                                           THEN COALESCE(OLD.total, 0) ELSE 0 END;
+        END
+        ''',
+        # Un pedido que entra o sale de "entregado y pagado" mueve sus líneas en el libro
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedidos_pago AFTER UPDATE ON pedidos
+        WHEN (COALESCE(NEW.estado = 'Entregado', 0) AND COALESCE(NEW.pagado, 0))
+          <> (COALESCE(OLD.estado = 'Entregado', 0) AND COALESCE(OLD.pagado, 0))
+        BEGIN
+            INSERT INTO finanzas_materiales (material, cantidad_pagada)
+                SELECT material, CASE WHEN NEW.estado = 'Entregado' AND NEW.pagado THEN SUM(cantidad) ELSE -SUM(cantidad) END
+                FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material
+                ON CONFLICT (material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;
+            UPDATE finanzas SET costos = costos + CASE WHEN NEW.estado = 'Entregado' AND NEW.pagado THEN 1 ELSE -1 END * (
+                SELECT COALESCE(SUM(pm.cantidad * i.precio_compra), 0)
+                FROM pedido_materiales pm JOIN inventario i ON i.material = pm.material
+                WHERE pm.pedido_id = OLD.id);
+        END
+        ''',
+        # BEFORE DELETE: antes de que la cascada borre las líneas
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedidos_borrado BEFORE DELETE ON pedidos
+        BEGIN
+            UPDATE finanzas SET
+                entregas = entregas - COALESCE(OLD.estado = 'Entregado', 0),
+                pagados = pagados - (COALESCE(OLD.estado = 'Entregado', 0) AND COALESCE(OLD.pagado, 0)),
+                ingresos = ingresos - CASE WHEN OLD.estado = 'Entregado' AND OLD.pagado
+                                           THEN COALESCE(OLD.total, 0) ELSE 0 END;
+            INSERT INTO finanzas_materiales (material, cantidad_pagada)
+                SELECT material, -SUM(cantidad)
+                FROM pedido_materiales WHERE pedido_id = OLD.id AND OLD.estado = 'Entregado' AND OLD.pagado
+                GROUP BY material
+                ON CONFLICT (material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;
+            UPDATE finanzas SET costos = costos - (
+                SELECT COALESCE(SUM(pm.cantidad * i.precio_compra), 0)
+                FROM pedido_materiales pm JOIN inventario i ON i.material = pm.material
+                WHERE pm.pedido_id = OLD.id)
+            WHERE OLD.estado = 'Entregado' AND OLD.pagado;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedido_materiales_alta AFTER INSERT ON pedido_materiales
+        WHEN EXISTS (SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND estado = 'Entregado' AND pagado IS TRUE)
+        BEGIN
+            INSERT INTO finanzas_materiales (material, cantidad_pagada) VALUES (NEW.material, NEW.cantidad)
+                ON CONFLICT (material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;
+            UPDATE finanzas SET costos = costos + NEW.cantidad * COALESCE(
+                (SELECT precio_compra FROM inventario WHERE material = NEW.material), 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedido_materiales_baja AFTER DELETE ON pedido_materiales
+        WHEN EXISTS (SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND estado = 'Entregado' AND pagado IS TRUE)
+        BEGIN
+            INSERT INTO finanzas_materiales (material, cantidad_pagada) VALUES (OLD.material, -OLD.cantidad)
+                ON CONFLICT (material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;
+            UPDATE finanzas SET costos = costos - OLD.cantidad * COALESCE(
+                (SELECT precio_compra FROM inventario WHERE material = OLD.material), 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_pedido_materiales_cambios AFTER UPDATE ON pedido_materiales
+        BEGIN
+            INSERT INTO finanzas_materiales (material, cantidad_pagada)
+                SELECT OLD.material, -OLD.cantidad
+                WHERE EXISTS (SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND estado = 'Entregado' AND pagado IS TRUE)
+                ON CONFLICT (material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;
+            UPDATE finanzas SET costos = costos - OLD.cantidad * COALESCE(
+                (SELECT precio_compra FROM inventario WHERE material = OLD.material), 0)
+            WHERE EXISTS (SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND estado = 'Entregado' AND pagado IS TRUE);
+            INSERT INTO finanzas_materiales (material, cantidad_pagada)
+                SELECT NEW.material, NEW.cantidad
+                WHERE EXISTS (SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND estado = 'Entregado' AND pagado IS TRUE)
+                ON CONFLICT (material) DO UPDATE SET cantidad_pagada = cantidad_pagada + excluded.cantidad_pagada;
+            UPDATE finanzas SET costos = costos + NEW.cantidad * COALESCE(
+                (SELECT precio_compra FROM inventario WHERE material = NEW.material), 0)
+            WHERE EXISTS (SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND estado = 'Entregado' AND pagado IS TRUE);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_inventario_alta AFTER INSERT ON inventario
+        BEGIN
+            UPDATE finanzas SET costos = costos + COALESCE(NEW.precio_compra, 0) * COALESCE(
+                (SELECT cantidad_pagada FROM finanzas_materiales WHERE material = NEW.material), 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_inventario_baja AFTER DELETE ON inventario
+        BEGIN
+            UPDATE finanzas SET costos = costos - COALESCE(OLD.precio_compra, 0) * COALESCE(
+                (SELECT cantidad_pagada FROM finanzas_materiales WHERE material = OLD.material), 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_inventario_cambios AFTER UPDATE OF material, precio_compra ON inventario
+        BEGIN
+            UPDATE finanzas SET costos = costos
+                - COALESCE(OLD.precio_compra, 0) * COALESCE(
+                    (SELECT cantidad_pagada FROM finanzas_materiales WHERE material = OLD.material), 0)
+                + COALESCE(NEW.precio_compra, 0) * COALESCE(
+                    (SELECT cantidad_pagada FROM finanzas_materiales WHERE material = NEW.material), 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_bajas_alta AFTER INSERT ON bajas_material
+        BEGIN
+            UPDATE finanzas SET gastos_baja = gastos_baja + COALESCE(NEW.costo_total, 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_bajas_baja AFTER DELETE ON bajas_material
+        BEGIN
+            UPDATE finanzas SET gastos_baja = gastos_baja - COALESCE(OLD.costo_total, 0);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS finanzas_bajas_cambios AFTER UPDATE ON bajas_material
+        BEGIN
+            UPDATE finanzas SET gastos_baja = gastos_baja - COALESCE(OLD.costo_total, 0)
+                                                          + COALESCE(NEW.costo_total, 0);
+        END
+        ''',
+        *SENTENCIAS_RECALCULAR_FINANZAS,
+    ]),
+    # SQLite no tiene NOTIFY: los cambios llegan a las demás sesiones del mismo
+    # proceso por las versiones de datos. La migración queda para que los
+    # números sigan iguales en los dos motores
+    (8, "Avisos de cambios entre servidores", []),
+    (9, "Versión de fila en inventario y pedidos", [
+        "ALTER TABLE inventario ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE pedidos ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+        # SQLite no cambia NEW en un trigger: la versión se sube con otro UPDATE
+        # (que no vuelve a disparar el trigger porque ya cambió la versión)
+        '''
+        CREATE TRIGGER IF NOT EXISTS subir_version_inventario AFTER UPDATE ON inventario
+        FOR EACH ROW WHEN NEW.version = OLD.version
+        BEGIN
+            UPDATE inventario SET version = OLD.version + 1 WHERE material = NEW.material;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS subir_version_pedidos AFTER UPDATE ON pedidos
+        FOR EACH ROW WHEN NEW.version = OLD.version
+        BEGIN
+            UPDATE pedidos SET version = OLD.version + 1 WHERE id = NEW.id;
+        END
+        ''',
+    ]),
+    (10, "Stock reservado por pedidos abiertos", [
+        '''
+        CREATE TABLE IF NOT EXISTS reservas (
+            material TEXT PRIMARY KEY,
+            reservado INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reservas_pedidos_estado AFTER UPDATE OF estado ON pedidos
+        WHEN COALESCE(NEW.estado NOT IN ('Listos para entregar', 'Entregado'), 1) <> COALESCE(OLD.estado NOT IN ('Listos para entregar', 'Entregado'), 1)
+        BEGIN
+            INSERT INTO reservas (material, reservado)
+                SELECT material, CASE WHEN COALESCE(NEW.estado NOT IN ('Listos para entregar', 'Entregado'), 1)
+                                      THEN SUM(cantidad) ELSE -SUM(cantidad) END
+                FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material
+                ON CONFLICT (material) DO UPDATE SET reservado = reservado + excluded.reservado;
+        END
+        ''',
+        # BEFORE DELETE: antes de que la cascada borre las líneas
+        '''
+        CREATE TRIGGER IF NOT EXISTS reservas_pedidos_borrado BEFORE DELETE ON pedidos
+        WHEN COALESCE(OLD.estado NOT IN ('Listos para entregar', 'Entregado'), 1)
+        BEGIN
+            INSERT INTO reservas (material, reservado)
+                SELECT material, -SUM(cantidad) FROM pedido_materiales WHERE pedido_id = OLD.id GROUP BY material
+                ON CONFLICT (material) DO UPDATE SET reservado = reservado + excluded.reservado;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reservas_pedido_materiales_alta AFTER INSERT ON pedido_materiales
+        WHEN EXISTS (SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND COALESCE(estado NOT IN ('Listos para entregar', 'Entregado'), 1))
+        BEGIN
+            INSERT INTO reservas (material, reservado) VALUES (NEW.material, NEW.cantidad)
+                ON CONFLICT (material) DO UPDATE SET reservado = reservado + excluded.reservado;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reservas_pedido_materiales_baja AFTER DELETE ON pedido_materiales
+        WHEN EXISTS (SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND COALESCE(estado NOT IN ('Listos para entregar', 'Entregado'), 1))
+        BEGIN
+            INSERT INTO reservas (material, reservado) VALUES (OLD.material, -OLD.cantidad)
+                ON CONFLICT (material) DO UPDATE SET reservado = reservado + excluded.reservado;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reservas_pedido_materiales_cambios AFTER UPDATE ON pedido_materiales
+        BEGIN
+            INSERT INTO reservas (material, reservado)
+                SELECT OLD.material, -OLD.cantidad
+                WHERE EXISTS (SELECT 1 FROM pedidos WHERE id = OLD.pedido_id AND COALESCE(estado NOT IN ('Listos para entregar', 'Entregado'), 1))
+                ON CONFLICT (material) DO UPDATE SET reservado = reservado + excluded.reservado;
+            INSERT INTO reservas (material, reservado)
+                SELECT NEW.material, NEW.cantidad
+                WHERE EXISTS (SELECT 1 FROM pedidos WHERE id = NEW.pedido_id AND COALESCE(estado NOT IN ('Listos para entregar', 'Entregado'), 1))
+                ON CONFLICT (material) DO UPDATE SET reservado = reservado + excluded.reservado;
+        END
+        ''',
+        "CREATE VIEW IF NOT EXISTS inventario_disponible AS" + CONSULTA_DISPONIBLE,
+    ] + SENTENCIAS_RECALCULAR_RESERVAS),
+    (11, "Resúmenes diarios y mensuales", [
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_diario (
+            dia DATE PRIMARY KEY,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            entregas INTEGER NOT NULL DEFAULT 0,
+            pagados INTEGER NOT NULL DEFAULT 0,
+            ventas_pagadas REAL NOT NULL DEFAULT 0,
+            ventas_sin_pagar REAL NOT NULL DEFAULT 0,
+            gastos_baja REAL NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_mensual (
+            mes DATE PRIMARY KEY,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            entregas INTEGER NOT NULL DEFAULT 0,
+            pagados INTEGER NOT NULL DEFAULT 0,
+            ventas_pagadas REAL NOT NULL DEFAULT 0,
+            ventas_sin_pagar REAL NOT NULL DEFAULT 0,
+            gastos_baja REAL NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_materiales_diario (
+            dia DATE,
+            material TEXT,
+            cantidad_pagada INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, material)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS resumen_materiales_mensual (
+            mes DATE,
+            material TEXT,
+            cantidad_pagada INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (mes, material)
+        )
+        ''',
+        _sqlite_trigger("resumen_pedidos_alta", "AFTER INSERT ON pedidos",
+                        _sqlite_sumar_resumen(_sqlite_aporte_pedido("NEW", 1))),
+        _sqlite_trigger("resumen_pedidos_cambios", "AFTER UPDATE OF fecha, estado, pagado, total ON pedidos",
+                        _sqlite_sumar_resumen(_sqlite_aporte_pedido("OLD", -1))
+                        + _sqlite_sumar_resumen(_sqlite_aporte_pedido("NEW", 1))),
+        # Las líneas se mueven si el pedido entra o sale de "entregado y pagado" o cambia de fecha siéndolo
+        _sqlite_trigger("resumen_pedidos_lineas", "AFTER UPDATE OF fecha, estado, pagado ON pedidos",
+                        _sqlite_sumar_materiales(_sqlite_aporte_lineas("OLD", -1))
+                        + _sqlite_sumar_materiales(_sqlite_aporte_lineas("NEW", 1)),
+                        cuando="COALESCE(OLD.estado = 'Entregado' AND OLD.pagado, 0) "
+                               "<> COALESCE(NEW.estado = 'Entregado' AND NEW.pagado, 0) "
+                               "OR (COALESCE(OLD.estado = 'Entregado' AND OLD.pagado, 0) AND OLD.fecha IS NOT NEW.fecha)"),
+        # BEFORE DELETE: antes de que la cascada borre las líneas
+        _sqlite_trigger("resumen_pedidos_borrado", "BEFORE DELETE ON pedidos",
+                        _sqlite_sumar_resumen(_sqlite_aporte_pedido("OLD", -1))
+                        + _sqlite_sumar_materiales(_sqlite_aporte_lineas("OLD", -1))),
+        _sqlite_trigger("resumen_pedido_materiales_alta", "AFTER INSERT ON pedido_materiales",
+                        _sqlite_sumar_materiales(_sqlite_aporte_linea("NEW", 1))),
+        _sqlite_trigger("resumen_pedido_materiales_baja", "AFTER DELETE ON pedido_materiales",
+                        _sqlite_sumar_materiales(_sqlite_aporte_linea("OLD", -1))),
+        _sqlite_trigger("resumen_pedido_materiales_cambios", "AFTER UPDATE ON pedido_materiales",
+                        _sqlite_sumar_materiales(_sqlite_aporte_linea("OLD", -1))
+                        + _sqlite_sumar_materiales(_sqlite_aporte_linea("NEW", 1))),
+        _sqlite_trigger("resumen_bajas_alta", "AFTER INSERT ON bajas_material",
+                        _sqlite_sumar_resumen(_sqlite_aporte_baja("NEW", 1))),
+        _sqlite_trigger("resumen_bajas_baja", "AFTER DELETE ON bajas_material",
+                        _sqlite_sumar_resumen(_sqlite_aporte_baja("OLD", -1))),
+        _sqlite_trigger("resumen_bajas_cambios", "AFTER UPDATE ON bajas_material",
+                        _sqlite_sumar_resumen(_sqlite_aporte_baja("OLD", -1))
+                        + _sqlite_sumar_resumen(_sqlite_aporte_baja("NEW", 1))),
+    ] + sentencias_recalcular_resumenes("sqlite")),
+    (12, "Valoración del inventario", [
+        '''
+        CREATE TABLE IF NOT EXISTS bajas_por_material (
+            material TEXT PRIMARY KEY,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            costo REAL NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS bajas_por_material_alta AFTER INSERT ON bajas_material
+        WHEN NEW.material IS NOT NULL
+        BEGIN
+            INSERT INTO bajas_por_material (material, cantidad, costo)
+                VALUES (NEW.material, COALESCE(NEW.cantidad, 0), COALESCE(NEW.costo_total, 0))
+                ON CONFLICT (material) DO UPDATE SET cantidad = cantidad + excluded.cantidad, costo = costo + excluded.costo;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS bajas_por_material_baja AFTER DELETE ON bajas_material
+        WHEN OLD.material IS NOT NULL
+        BEGIN
+            INSERT INTO bajas_por_material (material, cantidad, costo)
+                VALUES (OLD.material, -COALESCE(OLD.cantidad, 0), -COALESCE(OLD.costo_total, 0))
+                ON CONFLICT (material) DO UPDATE SET cantidad = cantidad + excluded.cantidad, costo = costo + excluded.costo;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS bajas_por_material_cambios AFTER UPDATE ON bajas_material
+        BEGIN
+            INSERT INTO bajas_por_material (material, cantidad, costo)
+                SELECT OLD.material, -COALESCE(OLD.cantidad, 0), -COALESCE(OLD.costo_total, 0)
+                WHERE OLD.material IS NOT NULL
+                ON CONFLICT (material) DO UPDATE SET cantidad = cantidad + excluded.cantidad, costo = costo + excluded.costo;
+            INSERT INTO bajas_por_material (material, cantidad, costo)
+                SELECT NEW.material, COALESCE(NEW.cantidad, 0), COALESCE(NEW.costo_total, 0)
+                WHERE NEW.material IS NOT NULL
+                ON CONFLICT (material) DO UPDATE SET cantidad = cantidad + excluded.cantidad, costo = costo + excluded.costo;
+        END
+        ''',
+        "CREATE VIEW IF NOT EXISTS inventario_valoracion AS" + CONSULTA_VALORACION,
+    ] + SENTENCIAS_RECALCULAR_BAJAS_POR_MATERIAL),
+    # Los triggers de SQLite no mueven líneas al insertar un pedido: nada que corregir
+    (13, "Líneas de pedidos nuevos en los resúmenes", []),
+]
+
+MIGRACIONES_POR_MOTOR = {"postgresql": MIGRACIONES, "sqlite": MIGRACIONES_SQLITE}
+
+# Candado de PostgreSQL para que dos servidores no migren al mismo tiempo
+LLAVE_MIGRACIONES = 7274278
+
+def aplicar_migraciones():
+    almacen = get_almacen()
+    with almacen.conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    descripcion TEXT,
+                    aplicada_en TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_huella (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    huella TEXT,
+                    actualizada_en TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            actual = cur.fetchone()[0]
+    aplicadas = []
+    for version, descripcion, sentencias in MIGRACIONES_POR_MOTOR[almacen.dialecto]:
+        if version <= actual:
+            continue
+        with transaccion() as conn:
+            with conn.cursor() as cur:
+                almacen.bloquear_migraciones(cur)
+                # Otro servidor pudo aplicarla mientras esperábamos el candado
+                cur.execute("SELECT 1 FROM schema_version WHERE version = %s", (version,))
+                if cur.fetchone():
+                    continue
+                for sentencia in sentencias:
+                    cur.execute(sentencia)
+                cur.execute("INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)",
+                            (version, descripcion))
+        aplicadas.append(version)
+    if aplicadas:
+        # Los resultados en caché pueden tener tipos o columnas viejas
+        get_cache_consultas().limpiar()
+        st.cache_data.clear()
+    return aplicadas
+
+# Migración: copiar el JSON de pedidos.materiales_usados a pedido_materiales.
+# Se hace por lotes y cada lote se confirma junto con su avance, así si se
+# interrumpe continúa desde el último pedido copiado.
+SQL_MIGRAR_LOTE = {
+    "postgresql": '''
+        WITH lote AS (
+            SELECT id, materiales_usados FROM pedidos
+            WHERE id > %(desde)s ORDER BY id LIMIT %(lote)s
+        ),
+        copiados AS (
+            INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+            SELECT l.id, m.item->>'material', SUM((m.item->>'cantidad')::int),
+                   MAX(COALESCE((m.item->>'precio')::numeric, 0))
+            FROM lote l
+            CROSS JOIN LATERAL jsonb_array_elements(NULLIF(l.materiales_usados, '')::jsonb) AS m(item)
+            GROUP BY l.id, m.item->>'material'
+            ON CONFLICT (pedido_id, material) DO NOTHING
+        )
+        SELECT MAX(id) AS hasta FROM lote
+    ''',
+    "sqlite": [
+        '''
+        INSERT OR IGNORE INTO pedido_materiales (pedido_id, material, cantidad, precio)
+        SELECT l.id, json_extract(m.value, '$.material'), SUM(json_extract(m.value, '$.cantidad')),
+               MAX(COALESCE(json_extract(m.value, '$.precio'), 0))
+        FROM (SELECT id, materiales_usados FROM pedidos WHERE id > %(desde)s ORDER BY id LIMIT %(lote)s) l,
+             json_each(NULLIF(l.materiales_usados, '')) m
+        GROUP BY l.id, json_extract(m.value, '$.material')
+        ''',
+        "SELECT MAX(id) AS hasta FROM (SELECT id FROM pedidos WHERE id > %(desde)s ORDER BY id LIMIT %(lote)s)",
+    ],
+}
+
+def migrar_materiales_usados(lote=500):
+    with get_almacen().conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO migraciones_datos (nombre) VALUES ('pedido_materiales') ON CONFLICT (nombre) DO NOTHING")
+            cur.execute("SELECT ultimo_id, completada FROM migraciones_datos WHERE nombre = 'pedido_materiales'")
+            ultimo_id, completada = cur.fetchone()
+    if completada:
+        return
+    ultimo_id = ultimo_id or 0
+    while True:
+        with transaccion() as conn:
+            with conn.cursor() as cur:
+                hasta = ejecutar_sentencias(cur, sql_del_motor(SQL_MIGRAR_LOTE),
+                                            {"desde": ultimo_id, "lote": lote})[0][0]
+                if hasta is None:
+                    cur.execute("UPDATE migraciones_datos SET completada = TRUE WHERE nombre = 'pedido_materiales'")
+                    break
+                cur.execute("UPDATE migraciones_datos SET ultimo_id = %s WHERE nombre = 'pedido_materiales'", (hasta,))
+                ultimo_id = hasta
+    get_versiones().subir("pedido_materiales")
+
+# --- TIPOS DE COLUMNAS ---
+# Tipo de pandas de cada columna por tabla. Los DataFrames se arman columna por
+# columna desde las tuplas del cursor, sin crear un dict por fila.
+# Las columnas booleanas toman NULL como FALSE (es su valor por defecto).
+TIPOS_POR_TABLA = {
+    "pedidos": {
+        "id": "Int64", "cantidad": "Int64", "precio_unidad": "float64", "total": "float64",
+        "estado": "category", "pagado": "bool", "inventario_descontado": "bool", "version": "Int64",
+    },
+    "pedido_materiales": {
+        "pedido_id": "Int64", "cantidad": "Int64", "precio": "float64",
+    },
+    "inventario": {
+        "cantidad": "Int64", "precio_compra": "float64", "precio_venta": "float64", "version": "Int64",
+    },
+    "bajas_material": {
+        "id": "Int64", "cantidad": "Int64", "costo_unitario": "float64", "costo_total": "float64",
+    },
+    "suplidores": {
+        "id": "Int64",
+    },
+    "inventario_disponible": {
+        "cantidad": "Int64", "reservado": "Int64", "disponible": "Int64",
+        "precio_compra": "float64", "precio_venta": "float64",
+    },
+    "inventario_valoracion": {
+        "cantidad": "Int64", "precio_compra": "float64", "precio_venta": "float64", "version": "Int64",
+        "ganancia_unitaria": "float64", "cantidad_baja": "Int64", "costo_baja": "float64",
+        "inversion_total": "float64", "ganancia_total": "float64",
+    },
+    "resumen_diario": {
+        "pedidos": "Int64", "entregas": "Int64", "pagados": "Int64",
+        "ventas_pagadas": "float64", "ventas_sin_pagar": "float64", "gastos_baja": "float64",
+    },
+    "resumen_mensual": {
+        "pedidos": "Int64", "entregas": "Int64", "pagados": "Int64",
+        "ventas_pagadas": "float64", "ventas_sin_pagar": "float64", "gastos_baja": "float64",
+    },
+}
+
+def tipos_para(query):
+    tipos = {}
+    for tabla in tablas_leidas(query):
+        for columna, tipo in TIPOS_POR_TABLA.get(tabla, {}).items():
+            tipos.setdefault(columna, tipo)
+    return tipos
+
+def _serie(valores, tipo):
+    if tipo == "bool":
+        return pd.Series([bool(v) for v in valores], dtype="bool")
+    if tipo is None:
+        return pd.Series(valores, dtype="object")
+    return pd.Series(valores, dtype=tipo)
+
+def armar_df(filas, columnas, tipos):
+    if not filas:
+        return pd.DataFrame({c: _serie([], tipos.get(c)) for c in columnas})
+    valores = zip(*filas)
+    return pd.DataFrame({c: _serie(v, tipos.get(c)) for c, v in zip(columnas, valores)})
+
+# Lectura por lotes con un cursor del lado del servidor: la consulta se recorre
+# en trozos de `tamano` filas y nunca se tiene todo el resultado en memoria,
+# siempre que quien la usa procese cada lote y lo suelte en vez de juntarlos.
+def leer_por_lotes(query, params=None, tamano=5000):
+    tipos = tipos_para(query)
+    with get_almacen().cursor_lotes(tamano) as cur:
+        cur.execute(query, params)
+        while True:
+            filas = cur.fetchmany(tamano)
+            if not filas:
+                break
+            yield armar_df(filas, [desc[0] for desc in cur.description], tipos)
+
+# --- CACHÉ DE CONSULTAS ---
+# Resultados de read_df compartidos por todas las sesiones. La llave lleva la
+# versión de cada tabla leída, así que una escritura hecha con safe_query
+# invalida al instante todo lo que dependía de esa tabla. El TTL acota lo que
+# otro proceso pudiera cambiar en la base de datos sin pasar por aquí.
+PATRON_LECTURA = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+# Leer una vista depende de las tablas que la forman
+TABLAS_DE_VISTA = {
+    "inventario_disponible": ("inventario", "reservas"),
+    "inventario_valoracion": ("inventario", "bajas_por_material"),
+}
+
+def tablas_leidas(query):
+    tablas = {t.lower() for t in PATRON_LECTURA.findall(query)}
+    for vista in tablas & TABLAS_DE_VISTA.keys():
+        tablas.update(TABLAS_DE_VISTA[vista])
+    return tuple(sorted(tablas))
+
+class CacheConsultas:
+    def __init__(self, max_entradas=256, ttl=300.0):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos = OrderedDict()   # llave -> (DataFrame, guardado_en)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def obtener(self, llave):
+        with self._lock:
+            entrada = self._datos.get(llave)
+            if entrada is not None and time.monotonic() - entrada[1] > self.ttl:
+                del self._datos[llave]
+                entrada = None
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._datos.move_to_end(llave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def guardar(self, llave, df):
+        if self.max_entradas <= 0:
+            return
+        with self._lock:
+            self._datos[llave] = (df, time.monotonic())
+            self._datos.move_to_end(llave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                self.expulsiones += 1
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+    def estado(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._datos),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "tasa_aciertos": self.aciertos / consultas * 100 if consultas else 0.0,
+            }
+
+@st.cache_resource
+def get_cache_consultas():
+    return CacheConsultas(
+        max_entradas=int(st.secrets.get("QUERY_CACHE_SIZE", 256)),
+        ttl=float(st.secrets.get("QUERY_CACHE_TTL", 300)),
+    )
+
+def _leer_df(query, params=None, usar_cache=True):
+    # Igual que read_df pero deja pasar los errores (para funciones en caché,
+    # que no deben guardar un resultado fallido)
+    llave = None
+    if usar_cache:
+        # La versión se toma ANTES de consultar: si otra sesión escribe mientras
+        # tanto, el resultado queda guardado con la versión vieja y no se reutiliza
+        tablas = tablas_leidas(query)
+        llave = (query, repr(params), tablas, get_versiones().version(*tablas))
+        df = get_cache_consultas().obtener(llave)
+        if df is not None:
+            return df.copy()
+    # Una sola ejecución: las columnas salen de cursor.description aunque no haya filas.
+    # Si se cayó la conexión, la consulta se reintenta una vez con otra del pool
+    almacen = get_almacen()
+    for intento in range(2):
+        try:
+            with almacen.conexion() as conn:
+                cur = conn.cursor()
+                if params:
+                    cur.execute(query, params)
+                else:
+                    cur.execute(query)
+                rows = cur.fetchall()
+                cols = [desc[0] for desc in cur.description]
+                cur.close()
+            break
+        except almacen.errores_conexion:
+            if intento == 0:
+                continue
+            raise
+    df = armar_df(rows, cols, tipos_para(query))
+    if llave is not None:
+        get_cache_consultas().guardar(llave, df)
+        return df.copy()
+    return df
 
-# --- FUNCIÓN LEER DATOS ---
 def read_df(query, params=None):
     try:
-        cur = get_cursor()
-        if params:
-            cur.execute(query, params)
-        else:
-            cur.execute(query)
-        rows = cur.fetchall()
-        cur.close()
-        if rows:
-            return pd.DataFrame([dict(r) for r in rows])
-        else:
-            # Devolver DataFrame vacío con columnas correctas
-            cur2 = get_cursor()
-            if params:
-                cur2.execute(query, params)
-            else:
-                cur2.execute(query)
-            cols = [desc[0] for desc in cur2.description]
-            cur2.close()
-            return pd.DataFrame(columns=cols)
+        return _leer_df(query, params)
     except Exception as e:
         st.error(f"Error leyendo datos: {e}")
         return pd.DataFrame()
 
+# --- PREPARAR BASE DE DATOS ---
+# Streamlit vuelve a correr todo el script en cada clic, así que la
+# preparación del esquema se hace una sola vez por proceso. La huella resume
+# las migraciones conocidas: si la base ya tiene la misma huella no se
+# ejecuta ningún DDL, basta con una consulta al arrancar el proceso.
+HUELLA_ESQUEMA = hashlib.sha256(
+    repr(MIGRACIONES_POR_MOTOR[get_almacen().dialecto]).encode("utf-8")).hexdigest()[:16]
+
+def huella_guardada():
+    try:
+        with get_almacen().conexion() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT huella FROM schema_huella")
+                fila = cur.fetchone()
+        return fila[0] if fila else None
+    except Exception as e:
+        if get_almacen().es_tabla_inexistente(e):
+            return None
+        raise
+
+def guardar_huella(huella):
+    with get_almacen().conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO schema_huella (id, huella) VALUES (TRUE, %s)
+                ON CONFLICT (id) DO UPDATE SET huella = EXCLUDED.huella, actualizada_en = CURRENT_TIMESTAMP
+            ''', (huella,))
+
+@st.cache_resource
+def _candado_esquema():
+    return threading.Lock()
+
+@st.cache_resource(show_spinner="Preparando base de datos...")
+def preparar_base_datos(huella):
+    with _candado_esquema():
+        if huella_guardada() == huella:
+            return []
+        aplicadas = aplicar_migraciones()
+        migrar_materiales_usados()
+        guardar_huella(huella)
+        return aplicadas
+
+try:
+    preparar_base_datos(HUELLA_ESQUEMA)
+except Exception as e:
+    st.error(f"No se pudo actualizar la base de datos: {e}")
+    st.stop()
+
+# Un oyente por proceso, ya con los triggers de avisos creados. SQLite no
+# tiene NOTIFY; ahí alcanza con las versiones de datos del proceso
+@st.cache_resource
+def get_oyente_cambios():
+    almacen = get_almacen()
+    if almacen.dialecto != "postgresql":
+        return None
+    dsn_avisos = st.secrets.get("LISTEN_DATABASE_URL")
+    if dsn_avisos:
+        return OyenteCambios(dsn_avisos, get_versiones())
+    if es_pooler_transaccion(almacen.pool.dsn):
+        return None
+    return OyenteCambios(almacen.pool.dsn, get_versiones())
+
+get_oyente_cambios()
+
 # --- FUNCIONES AUXILIARES ---
-def mostrar_feedback(tipo, mensaje, tiempo=2):
-    if tipo == "exito":
-        st.success(mensaje)
-        st.balloons()
-        time.sleep(tiempo)
-        st.rerun()
-    elif tipo == "advertencia":
-        st.warning(mensaje)
-        time.sleep(tiempo)
+# Los avisos de éxito y advertencia quedan en la sesión y se muestran como
+# toast en el run siguiente: el rerun es inmediato y ningún hilo del servidor
+# se queda esperando
+ICONOS_AVISO = {"exito": "✅", "advertencia": "⚠️"}
+
+def mostrar_feedback(tipo, mensaje):
+    if tipo in ICONOS_AVISO:
+        st.session_state.setdefault("avisos_pendientes", []).append((tipo, mensaje))
         st.rerun()
     elif tipo == "error":
         st.error(mensaje)
     elif tipo == "info":
         st.info(mensaje)
 
+def mostrar_avisos_pendientes():
+    avisos = st.session_state.pop("avisos_pendientes", [])
+    for tipo, mensaje in avisos:
+        st.toast(mensaje, icon=ICONOS_AVISO[tipo])
+    if any(tipo == "exito" for tipo, _ in avisos):
+        st.balloons()
+
+mostrar_avisos_pendientes()
+
 def safe_query(query, params=None, many=False):
+    # `query` también puede ser la lista de sentencias de sql_del_motor: se
+    # ejecutan juntas en una transacción
     try:
-        cur = get_cursor()
-        if params:
-            if many:
-                cur.executemany(query, params)
-            else:
-                cur.execute(query, params)
+        if params and many:
+            with transaccion() as conn:
+                with conn.cursor() as cur:
+                    cur.executemany(query, params)
+        elif not isinstance(query, str):
+            with transaccion() as conn:
+                with conn.cursor() as cur:
+                    ejecutar_sentencias(cur, query, params)
         else:
-            cur.execute(query)
-        conn.commit()
-        cur.close()
+            with get_almacen().conexion() as conn:
+                with conn.cursor() as cur:
+                    if params:
+                        cur.execute(query, params)
+                    else:
+                        cur.execute(query)
+        get_versiones().subir(*tablas_escritas(query))
         return True
     except Exception as e:
-        conn.rollback()
         mostrar_feedback("error", f"Ocurrió un error en la base de datos: {e}")
         return False
 
+def safe_query_filas(query, params=None):
+    # Como safe_query, pero para sentencias con RETURNING: corre en una sola
+    # transacción y devuelve las filas resultantes (None si falló)
+    try:
+        with transaccion() as conn:
+            with conn.cursor() as cur:
+                filas = ejecutar_sentencias(cur, query, params)
+        get_versiones().subir(*tablas_escritas(query))
+        return filas
+    except Exception as e:
+        mostrar_feedback("error", f"Ocurrió un error en la base de datos: {e}")
+        return None
+
+# --- MATERIALES DE LOS PEDIDOS ---
+# Los textos y costos por pedido solo hacen falta para la página que se
+# muestra: se leen las líneas de esos ids (WHERE pedido_id = ANY) y el costo de
+# cada página no crece con el historial. El uso por material sí abarca todo el
+# historial y recorre pedido_materiales por lotes con leer_por_lotes: cada lote
+# se agrupa y se suelta, y solo se guardan los resultados parciales (uno por
+# material), nunca todas las líneas juntas. Todo queda en caché por versión de
+# datos y se comparte entre páginas.
+CONSULTA_LINEAS_DE_PEDIDOS = '''
+    SELECT pm.pedido_id, pm.material, pm.cantidad, i.precio_compra
+    FROM pedido_materiales pm
+    LEFT JOIN inventario i ON i.material = pm.material
+    WHERE pm.pedido_id = ANY(%s)
+    ORDER BY pm.pedido_id, pm.material
+'''
+
+def _lineas_de_pedidos(ids):
+    # read_df guarda el resultado por ids y versión: artículos y costo de la
+    # misma página comparten una sola lectura
+    ids = [int(i) for i in ids]
+    return read_df(CONSULTA_LINEAS_DE_PEDIDOS, (ids,)) if ids else pd.DataFrame()
+
+def articulos_por_pedido(ids):
+    # pedido_id -> "Material(cantidad), ..." de los pedidos indicados
+    lineas = _lineas_de_pedidos(ids)
+    if lineas.empty:
+        return pd.Series(dtype='object')
+    texto = lineas['material'] + '(' + lineas['cantidad'].astype(str) + ')'
+    return texto.groupby(lineas['pedido_id']).agg(', '.join)
+
+def costo_por_pedido(ids):
+    # pedido_id -> costo de los materiales al precio de compra actual
+    lineas = _lineas_de_pedidos(ids)
+    if lineas.empty:
+        return pd.Series(dtype='float64')
+    costo = lineas['cantidad'] * lineas['precio_compra'].astype('float64').fillna(0)
+    return costo.groupby(lineas['pedido_id']).sum()
+
+CONSULTA_LINEAS = "SELECT pedido_id, material, cantidad FROM pedido_materiales ORDER BY pedido_id, material"
+
+def _lotes_por_pedido():
+    # Las líneas vienen ordenadas por pedido: las del último pedido de cada
+    # lote pueden seguir en el siguiente, así que pasan a ese lote y ningún
+    # pedido queda partido entre dos
+    resto = None
+    for lineas in leer_por_lotes(CONSULTA_LINEAS):
+        if resto is not None:
+            lineas = pd.concat([resto, lineas], ignore_index=True)
+        ultimo = lineas['pedido_id'].iloc[-1]
+        completo = lineas['pedido_id'] != ultimo
+        resto = lineas[~completo]
+        if completo.any():
+            yield lineas[completo]
+    if resto is not None and not resto.empty:
+        yield resto
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _uso_por_material(version):
+    partes = []
+    for lineas in _lotes_por_pedido():
+        partes.append(lineas.groupby('material').agg(cantidad_usada=('cantidad', 'sum'), pedidos=('pedido_id', 'nunique')))
+    if not partes:
+        return pd.DataFrame(columns=['cantidad_usada', 'pedidos'])
+    # Cada pedido está en un solo lote: sumar los parciales por material cuenta bien los pedidos
+    return pd.concat(partes).groupby(level=0).sum()
+
+def _cargar_lineas(funcion, tablas, vacio):
+    try:
+        return funcion(get_versiones().version(*tablas))
+    except Exception as e:
+        st.error(f"Error leyendo materiales de pedidos: {e}")
+        return vacio
+
+def uso_por_material():
+    # material -> cantidad_usada y número de pedidos que lo usan
+    return _cargar_lineas(_uso_por_material, ("pedido_materiales",),
+                          pd.DataFrame(columns=['cantidad_usada', 'pedidos']))
+
+def valoracion_inventario():
+    # Una fila por material con sus bajas acumuladas, inversión y ganancia,
+    # calculadas en la base de datos (vista inventario_valoracion)
+    return read_df("SELECT * FROM inventario_valoracion ORDER BY material")
+
+# --- CATÁLOGO DE MATERIALES ---
+# Materiales con stock disponible para armar pedidos (lo que queda después de
+# lo reservado por pedidos abiertos), construido una vez por versión del
+# inventario y de las reservas y compartido por todas las sesiones. Stock y precio se buscan en
+# diccionarios y los nombres quedan ordenados para buscar por prefijo con
+# bisect, así cada fila del pedido cuesta lo mismo sin importar cuántas haya.
+LIMITE_OPCIONES = 50
+
+class CatalogoMateriales:
+    def __init__(self, materiales, cantidades, precios):
+        self.stock = dict(zip(materiales, (int(c) for c in cantidades)))
+        self.precio = dict(zip(materiales, (int(p or 0) for p in precios)))
+        self._orden = sorted((m.upper(), m) for m in self.stock)
+        self._claves = [clave for clave, _ in self._orden]
+
+    def __len__(self):
+        return len(self._orden)
+
+    def __contains__(self, material):
+        return material in self.stock
+
+    def buscar(self, prefijo="", excluir=(), limite=LIMITE_OPCIONES):
+        # Hasta `limite` materiales cuyo nombre empieza con `prefijo`, sin los de `excluir`
+        prefijo = prefijo.strip().upper()
+        resultados = []
+        for i in range(bisect.bisect_left(self._claves, prefijo), len(self._orden)):
+            clave, material = self._orden[i]
+            if not clave.startswith(prefijo) or len(resultados) >= limite:
+                break
+            if material not in excluir:
+                resultados.append(material)
+        return resultados
+
+    def primero_libre(self, excluir):
+        libres = self.buscar(excluir=excluir, limite=1)
+        return libres[0] if libres else None
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _catalogo_materiales(version):
+    df = _leer_df("SELECT material, disponible, precio_venta FROM inventario_disponible WHERE disponible > 0",
+                  usar_cache=False)
+    return CatalogoMateriales(df['material'].tolist(), df['disponible'].tolist(), df['precio_venta'].fillna(0).tolist())
+
+def catalogo_materiales():
+    try:
+        return _catalogo_materiales(get_versiones().version("inventario", "reservas"))
+    except Exception as e:
+        st.error(f"Error leyendo inventario: {e}")
+        return CatalogoMateriales([], [], [])
+
+# --- MOVIMIENTOS DE INVENTARIO POR PEDIDO ---
+# Cambiar de estado o eliminar pedidos ajusta el inventario en una sola
+# sentencia: los CTE actualizan los pedidos, suman las líneas de
+# pedido_materiales por material y aplican el ajuste al inventario, todo en
+# la misma transacción. El costo no depende de cuántos materiales tenga el
+# pedido y un fallo no deja el inventario a medio ajustar.
+# Un descuento nunca deja stock negativo: si a un material no le alcanza, la
+# sentencia lo devuelve en la última columna (material, stock, pedido) y
+# _movimiento deshace toda la transacción.
+ESTADOS_CON_DESCUENTO = ("Listos para entregar", "Entregado")
+
+SQL_CAMBIAR_ESTADO = {"postgresql": '''
+    WITH objetivo AS (
+        SELECT id, COALESCE(inventario_descontado, FALSE) AS antes
+        FROM pedidos
+        WHERE id = ANY(%(ids)s)
+        FOR UPDATE
+    ),
+    actualizados AS (
+        UPDATE pedidos p
+        SET estado = %(estado)s, inventario_descontado = %(descuenta)s
+        FROM objetivo o
+        WHERE p.id = o.id
+        RETURNING p.id, o.antes
+    ),
+    movimientos AS (
+        SELECT pm.material,
+               SUM(CASE WHEN %(descuenta)s THEN -pm.cantidad ELSE pm.cantidad END) AS delta
+        FROM actualizados a
+        JOIN pedido_materiales pm ON pm.pedido_id = a.id
+        WHERE a.antes <> %(descuenta)s
+        GROUP BY pm.material
+    ),
+    stock AS (
+        -- La condición se vuelve a evaluar sobre la fila bloqueada: si otra
+        -- sesión descontó antes, la fila queda fuera y sale como faltante
+        UPDATE inventario i
+        SET cantidad = i.cantidad + m.delta
+        FROM movimientos m
+        WHERE i.material = m.material AND (m.delta >= 0 OR i.cantidad >= -m.delta)
+        RETURNING i.material, i.cantidad
+    )
+    SELECT
+        (SELECT COUNT(*) FROM actualizados),
+        (SELECT COUNT(*) FROM actualizados WHERE antes <> %(descuenta)s),
+        (SELECT COALESCE(json_agg(json_build_array(material, cantidad) ORDER BY material), '[]') FROM stock),
+        (SELECT COALESCE(json_agg(json_build_array(m.material, i.cantidad, -m.delta) ORDER BY m.material), '[]')
+         FROM movimientos m JOIN inventario i ON i.material = m.material
+         WHERE m.material NOT IN (SELECT material FROM stock))
+''', "sqlite": [
+    # SQLite no permite escrituras dentro de un WITH: los pedidos objetivo y
+    # el movimiento por material se guardan en tablas temporales y las
+    # escrituras corren una tras otra en la misma transacción
+    "DROP TABLE IF EXISTS temp.objetivo",
+    '''
+    CREATE TEMP TABLE objetivo AS
+    SELECT id, COALESCE(inventario_descontado, FALSE) AS antes FROM pedidos WHERE id = ANY(%(ids)s)
+    ''',
+    "DROP TABLE IF EXISTS temp.movimientos",
+    '''
+    CREATE TEMP TABLE movimientos AS
+    SELECT pm.material, SUM(CASE WHEN %(descuenta)s THEN -pm.cantidad ELSE pm.cantidad END) AS delta
+    FROM objetivo o
+    JOIN pedido_materiales pm ON pm.pedido_id = o.id
+    WHERE o.antes <> %(descuenta)s
+    GROUP BY pm.material
+    ''',
+    # BEGIN IMMEDIATE ya reservó la escritura: nadie cambia el stock entre
+    # esta revisión y los UPDATE
+    "DROP TABLE IF EXISTS temp.faltantes",
+    '''
+    CREATE TEMP TABLE faltantes AS
+    SELECT m.material, i.cantidad AS stock, -m.delta AS pedido
+    FROM movimientos m JOIN inventario i ON i.material = m.material
+    WHERE m.delta < 0 AND i.cantidad < -m.delta
+    ''',
+    '''
+    UPDATE pedidos SET estado = %(estado)s, inventario_descontado = %(descuenta)s
+    WHERE id IN (SELECT id FROM objetivo)
+    ''',
+    '''
+    UPDATE inventario SET cantidad = inventario.cantidad + m.delta
+    FROM movimientos m
+    WHERE inventario.material = m.material
+    ''',
+    '''
+    SELECT
+        (SELECT COUNT(*) FROM objetivo),
+        (SELECT COUNT(*) FROM objetivo WHERE antes <> %(descuenta)s),
+        (SELECT json_group_array(json_array(material, cantidad)) FROM (
+            SELECT i.material, i.cantidad FROM inventario i JOIN movimientos m ON m.material = i.material
+            ORDER BY i.material)),
+        (SELECT json_group_array(json_array(material, stock, pedido)) FROM (
+            SELECT * FROM faltantes ORDER BY material))
+    ''',
+]}
+
+SQL_ELIMINAR_PEDIDOS = {"postgresql": '''
+    WITH borrados AS (
+        DELETE FROM pedidos
+        WHERE id = ANY(%(ids)s)
+        RETURNING id, COALESCE(inventario_descontado, FALSE) AS descontado
+    ),
+    movimientos AS (
+        SELECT pm.material, SUM(pm.cantidad) AS delta
+        FROM borrados b
+        JOIN pedido_materiales pm ON pm.pedido_id = b.id
+        WHERE b.descontado
+        GROUP BY pm.material
+    ),
+    stock AS (
+        UPDATE inventario i
+        SET cantidad = i.cantidad + m.delta
+        FROM movimientos m
+        WHERE i.material = m.material
+        RETURNING i.material, i.cantidad
+    )
+    SELECT
+        (SELECT COUNT(*) FROM borrados),
+        (SELECT COUNT(*) FROM borrados WHERE descontado),
+        (SELECT COALESCE(json_agg(json_build_array(material, cantidad) ORDER BY material), '[]') FROM stock),
+        '[]'::json
+''', "sqlite": [
+    "DROP TABLE IF EXISTS temp.objetivo",
+    '''
+    CREATE TEMP TABLE objetivo AS
+    SELECT id, COALESCE(inventario_descontado, FALSE) AS antes FROM pedidos WHERE id = ANY(%(ids)s)
+    ''',
+    # Las líneas se suman antes de borrar: la cascada las elimina con el pedido
+    "DROP TABLE IF EXISTS temp.movimientos",
+    '''
+    CREATE TEMP TABLE movimientos AS
+    SELECT pm.material, SUM(pm.cantidad) AS delta
+    FROM objetivo o
+    JOIN pedido_materiales pm ON pm.pedido_id = o.id
+    WHERE o.antes
+    GROUP BY pm.material
+    ''',
+    "DELETE FROM pedidos WHERE id IN (SELECT id FROM objetivo)",
+    '''
+    UPDATE inventario SET cantidad = inventario.cantidad + m.delta
+    FROM movimientos m
+    WHERE inventario.material = m.material
+    ''',
+    '''
+    SELECT
+        (SELECT COUNT(*) FROM objetivo),
+        (SELECT COUNT(*) FROM objetivo WHERE antes),
+        (SELECT json_group_array(json_array(material, cantidad)) FROM (
+            SELECT i.material, i.cantidad FROM inventario i JOIN movimientos m ON m.material = i.material
+            ORDER BY i.material)),
+        '[]'
+    ''',
+]}
+
+# Un pedido nuevo y sus líneas de pedido_materiales en una sola transacción.
+# Lo pedido se compara con inventario_disponible dentro de la misma
+# transacción, no con el catálogo en caché: la sentencia devuelve los
+# faltantes (material, disponible, pedido) como SQL_CAMBIAR_ESTADO y
+# crear_pedido deshace todo si hay alguno.
+SQL_CREAR_PEDIDO = {"postgresql": [
+    # Bloquea las filas de inventario de esos materiales: otro pedido que pida
+    # lo mismo espera aquí y la sentencia siguiente ya ve su reserva
+    '''
+    SELECT COUNT(*) FROM (
+        SELECT 1 FROM inventario
+        WHERE material IN (SELECT m.material FROM jsonb_to_recordset(%(materiales)s::jsonb) AS m(material TEXT))
+        ORDER BY material
+        FOR UPDATE) bloqueadas
+    ''',
+    '''
+    WITH nuevo AS (
+        INSERT INTO pedidos (fecha, cliente, detalle, cantidad, precio_unidad, total, estado, materiales_usados, pagado, inventario_descontado)
+        VALUES (%(fecha)s, %(cliente)s, %(detalle)s, %(cantidad)s, %(precio_unidad)s, %(total)s, %(estado)s, %(materiales)s, FALSE, FALSE)
+        RETURNING id
+    ),
+    lineas AS (
+        INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+        SELECT nuevo.id, m.material, m.cantidad, m.precio
+        FROM nuevo, jsonb_to_recordset(%(materiales)s::jsonb) AS m(material TEXT, cantidad INTEGER, precio NUMERIC)
+        RETURNING material, cantidad
+    ),
+    pedido AS (
+        SELECT material, SUM(cantidad) AS cantidad FROM lineas GROUP BY material
+    )
+    -- La vista todavía no ve la reserva de este pedido: es lo disponible antes de él
+    SELECT COALESCE(json_agg(json_build_array(p.material, COALESCE(d.disponible, 0), p.cantidad) ORDER BY p.material), '[]')
+    FROM pedido p
+    LEFT JOIN inventario_disponible d ON d.material = p.material
+    WHERE p.cantidad > COALESCE(d.disponible, 0)
+    ''',
+], "sqlite": [
+    # BEGIN IMMEDIATE ya reservó la escritura; los faltantes se calculan antes
+    # de insertar porque los triggers suman la reserva del pedido en seguida
+    "DROP TABLE IF EXISTS temp.faltantes",
+    '''
+    CREATE TEMP TABLE faltantes AS
+    SELECT p.material, COALESCE(d.disponible, 0) AS stock, p.cantidad AS pedido
+    FROM (
+        SELECT json_extract(value, '$.material') AS material, SUM(json_extract(value, '$.cantidad')) AS cantidad
+        FROM json_each(%(materiales)s) GROUP BY 1
+    ) p
+    LEFT JOIN inventario_disponible d ON d.material = p.material
+    WHERE p.cantidad > COALESCE(d.disponible, 0)
+    ''',
+    '''
+    INSERT INTO pedidos (fecha, cliente, detalle, cantidad, precio_unidad, total, estado, materiales_usados, pagado, inventario_descontado)
+    VALUES (%(fecha)s, %(cliente)s, %(detalle)s, %(cantidad)s, %(precio_unidad)s, %(total)s, %(estado)s, %(materiales)s, FALSE, FALSE)
+    ''',
+    # Dentro de la transacción el pedido recién creado es el de id más alto
+    '''
+    INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+    SELECT (SELECT MAX(id) FROM pedidos), json_extract(m.value, '$.material'),
+           json_extract(m.value, '$.cantidad'), json_extract(m.value, '$.precio')
+    FROM json_each(%(materiales)s) m
+    ''',
+    '''
+    SELECT json_group_array(json_array(material, stock, pedido)) FROM (
+        SELECT * FROM faltantes ORDER BY material)
+    ''',
+]}
+
+def lista_json(valor):
+    # json_agg llega de psycopg2 ya como lista; json_group_array de SQLite, como texto
+    return json.loads(valor) if isinstance(valor, str) else list(valor)
+
+class StockInsuficiente(Exception):
+    def __init__(self, faltantes):
+        # faltantes: [(material, stock, pedido), ...]
+        self.faltantes = faltantes
+        super().__init__("Stock insuficiente: " + ", ".join(
+            f"{material} (hay {stock}, se necesitan {pedido})" for material, stock, pedido in faltantes))
+
+def _movimiento(query, params):
+    # Devuelve {"pedidos", "ajustados", "stock"} o None si no se hizo (el error
+    # ya se mostró); "stock" es la lista [(material, cantidad_nueva), ...] ya actualizada
+    query = sql_del_motor(query)
+    try:
+        with transaccion() as conn:
+            with conn.cursor() as cur:
+                pedidos, ajustados, stock, faltantes = ejecutar_sentencias(cur, query, params)[0]
+                faltantes = [tuple(f) for f in lista_json(faltantes)]
+                if faltantes:
+                    # Salir con la excepción deshace los cambios de estado ya hechos
+                    raise StockInsuficiente(faltantes)
+    except StockInsuficiente as e:
+        mostrar_feedback("error", f"No se cambió ningún pedido. {e}")
+        return None
+    except Exception as e:
+        mostrar_feedback("error", f"Ocurrió un error en la base de datos: {e}")
+        return None
+    get_versiones().subir(*tablas_escritas(query))
+    return {"pedidos": pedidos, "ajustados": ajustados, "stock": [tuple(s) for s in lista_json(stock)]}
+
+def crear_pedido(params):
+    # True si se guardó; si no, el error ya se mostró y no quedó nada escrito
+    query = sql_del_motor(SQL_CREAR_PEDIDO)
+    try:
+        with transaccion() as conn:
+            with conn.cursor() as cur:
+                faltantes = [tuple(f) for f in lista_json(ejecutar_sentencias(cur, query, params)[0][0])]
+                if faltantes:
+                    raise StockInsuficiente(faltantes)
+    except StockInsuficiente as e:
+        mostrar_feedback("error", f"No se guardó el pedido. {e}")
+        return False
+    except Exception as e:
+        mostrar_feedback("error", f"Ocurrió un error en la base de datos: {e}")
+        return False
+    get_versiones().subir(*tablas_escritas(query))
+    return True
+
+def cambiar_estado_pedidos(ids, nuevo_estado):
+    # Los pedidos que entran a un estado con descuento descuentan su material;
+    # los que salen de ellos lo reponen. El resto solo cambia de estado.
+    return _movimiento(SQL_CAMBIAR_ESTADO, {
+        "ids": [int(i) for i in ids],
+        "estado": nuevo_estado,
+        "descuenta": nuevo_estado in ESTADOS_CON_DESCUENTO,
+    })
+
+def eliminar_pedidos(ids):
+    # Repone el material de los pedidos que ya lo tenían descontado
+    return _movimiento(SQL_ELIMINAR_PEDIDOS, {"ids": [int(i) for i in ids]})
+
+# --- BAJAS Y EDICIONES CONCURRENTES ---
+# Dos operadores pueden trabajar sobre la misma fila a la vez. La baja descuenta
+# solo si todavía alcanza el stock (la condición va en el mismo UPDATE) y las
+# ediciones de inventario y pedidos llevan la versión de fila que se mostró:
+# si otro la cambió entretanto, el UPDATE no encuentra la fila y se recarga.
+def registrar_baja(material, cantidad, motivo, costo_unitario, fecha):
+    # Devuelve el stock que queda, o None si no se registró (el error ya se mostró)
+    try:
+        with transaccion() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE inventario SET cantidad = cantidad - %s WHERE material = %s AND cantidad >= %s RETURNING cantidad",
+                    (cantidad, material, cantidad))
+                fila = cur.fetchone()
+                if fila is None:
+                    cur.execute("SELECT cantidad FROM inventario WHERE material = %s", (material,))
+                    actual = cur.fetchone()
+                    raise StockInsuficiente([(material, actual[0] if actual else 0, cantidad)])
+                cur.execute(
+                    "INSERT INTO bajas_material (material, cantidad, fecha, motivo, costo_unitario, costo_total) VALUES (%s, %s, %s, %s, %s, %s)",
+                    (material, cantidad, fecha, motivo, costo_unitario, costo_unitario * cantidad))
+    except StockInsuficiente as e:
+        # El stock que se mostró ya no vale: se vuelve a leer
+        get_versiones().subir("inventario")
+        mostrar_feedback("error", f"No se registró la baja. {e}")
+        return None
+    except Exception as e:
+        mostrar_feedback("error", f"Ocurrió un error en la base de datos: {e}")
+        return None
+    get_versiones().subir("inventario", "bajas_material", *TABLAS_CASCADA["inventario"], *TABLAS_CASCADA["bajas_material"])
+    return fila[0]
+
+def conflicto_edicion(tabla, descripcion):
+    # La fila cambió desde que se mostró: se fuerza a releerla y el rerun
+    # muestra los valores actuales; lo que se escribió en el formulario se conserva
+    get_versiones().subir(tabla)
+    mostrar_feedback("advertencia", f"{descripcion} cambió mientras lo editabas. Se cargaron los valores "
+                                    "actuales: revísalos y vuelve a guardar.")
+
+# --- FILTROS Y PAGINACIÓN DE PEDIDOS ---
+# Los filtros se aplican en la base de datos y las tablas se recorren por
+# páginas con llave sobre id (keyset): cada página cuesta lo mismo sin importar
+# cuántos pedidos haya en el historial.
+TAMANO_PAGINA = int(st.secrets.get("PAGE_SIZE", 50))
+OPCIONES_PAGO = {"Todos": None, "✅ Pagados": True, "❌ Sin pagar": False}
+
+def condiciones_pedidos(estado=None, pagado=None, desde=None, hasta=None):
+    condiciones, params = [], []
+    if estado:
+        condiciones.append("estado = %s")
+        params.append(estado)
+    if pagado is True:
+        condiciones.append("pagado IS TRUE")
+    elif pagado is False:
+        condiciones.append("pagado IS NOT TRUE")
+    if desde:
+        condiciones.append("fecha >= %s")
+        params.append(desde)
+    if hasta:
+        condiciones.append("fecha <= %s")
+        params.append(hasta)
+    return condiciones, params
+
+def _donde(condiciones):
+    return (" WHERE " + " AND ".join(condiciones)) if condiciones else ""
+
+def pagina_pedidos(filtros, despues_de=None, tamano=TAMANO_PAGINA):
+    # Trae una fila de más para saber si existe una página siguiente
+    condiciones, params = condiciones_pedidos(**filtros)
+    if despues_de is not None:
+        condiciones.append("id > %s")
+        params.append(int(despues_de))
+    params.append(tamano + 1)
+    return read_df("SELECT * FROM pedidos" + _donde(condiciones) + " ORDER BY id LIMIT %s", tuple(params))
+
+def conteo_por_estado():
+    # Pedidos y pagados por estado en una sola consulta
+    df = read_df('''
+        SELECT estado, COUNT(*) AS pedidos, COUNT(*) FILTER (WHERE pagado IS TRUE) AS pagados
+        FROM pedidos GROUP BY estado
+    ''')
+    if df.empty:
+        return {}
+    return {str(f.estado): {"pedidos": int(f.pedidos), "pagados": int(f.pagados)} for f in df.itertuples()}
+
+def filtros_pedidos(clave, estado=None):
+    # Filtros de pago y fechas que se mandan a la consulta
+    with st.expander("🔎 Filtros", expanded=False):
+        col1, col2 = st.columns(2)
+        with col1:
+            pago = st.radio("Pago", list(OPCIONES_PAGO), horizontal=True, key=f"filtro_pago_{clave}")
+        with col2:
+            rango = st.date_input("Rango de fechas", value=(), key=f"filtro_fechas_{clave}")
+    desde = rango[0] if len(rango) > 0 else None
+    hasta = rango[1] if len(rango) > 1 else None
+    return {"estado": estado, "pagado": OPCIONES_PAGO[pago], "desde": desde, "hasta": hasta}
+
+def tabla_paginada(clave, filtros):
+    # Guarda en la sesión el id donde empieza cada página visitada; si cambian
+    # los filtros se vuelve a la primera página
+    firma = repr(sorted(filtros.items()))
+    pag = st.session_state.get(f"paginas_{clave}")
+    if pag is None or pag["firma"] != firma:
+        pag = {"firma": firma, "cursores": [None]}
+        st.session_state[f"paginas_{clave}"] = pag
+    df = pagina_pedidos(filtros, pag["cursores"][-1])
+    hay_siguiente = len(df) > TAMANO_PAGINA
+    df = df.iloc[:TAMANO_PAGINA].copy()
+
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("◀ Anterior", key=f"btn_ant_{clave}", disabled=len(pag["cursores"]) == 1):
+            pag["cursores"].pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Página {len(pag['cursores'])} · {TAMANO_PAGINA} pedidos por página")
+    with col3:
+        if st.button("Siguiente ▶", key=f"btn_sig_{clave}", disabled=not hay_siguiente):
+            pag["cursores"].append(int(df['id'].iloc[-1]))
+            st.rerun()
+    return df
+
+def selector_pedido(etiqueta, clave, filtros, pagina):
+    # Sin búsqueda ofrece los pedidos de la página actual; con búsqueda (ID o
+    # cliente) consulta la base de datos, limitado a 20 resultados
+    busqueda = st.text_input("Buscar por ID o cliente", key=f"buscar_{clave}",
+                             placeholder="Deja vacío para elegir de la página actual").strip()
+    if busqueda:
+        condiciones, params = condiciones_pedidos(**filtros)
+        if busqueda.isdigit():
+            condiciones.append("id = %s")
+            params.append(int(busqueda))
+        else:
+            condiciones.append("cliente ILIKE %s")
+            params.append(f"%{busqueda}%")
+        candidatos = read_df("SELECT * FROM pedidos" + _donde(condiciones) + " ORDER BY id DESC LIMIT 20",
+                             tuple(params))
+    else:
+        candidatos = pagina
+    if candidatos.empty:
+        st.caption("Sin resultados")
+        return None
+    opciones = ["-- Selecciona ID --"] + [str(x) for x in candidatos['id'].tolist()]
+    clientes = dict(zip(candidatos['id'].astype(str), candidatos['cliente']))
+    seleccion = st.selectbox(etiqueta, opciones, key=clave,
+                             format_func=lambda x: x if x not in clientes else f"{x} · {clientes[x]}")
+    if seleccion == "-- Selecciona ID --":
+        return None
+    return candidatos[candidatos['id'] == int(seleccion)].iloc[0]
+
+# --- ACCIONES EN LOTE ---
+# Pago, cambio de estado y eliminación sobre varios pedidos a la vez: cada
+# acción es una sola sentencia con WHERE id = ANY(%s) (los ajustes de
+# inventario van en la misma transacción) y un solo rerun al terminar.
+def marcar_pago_pedidos(ids, pagado):
+    return safe_query("UPDATE pedidos SET pagado = %s WHERE id = ANY(%s)",
+                      (bool(pagado), [int(i) for i in ids]))
+
+def acciones_en_lote(clave, pagina, estados_destino):
+    with st.expander("📦 Acciones en lote"):
+        ids_pagina = [int(i) for i in pagina['id'].tolist()]
+        clientes = dict(zip(ids_pagina, pagina['cliente']))
+        if st.checkbox(f"Seleccionar toda la página ({len(ids_pagina)} pedidos)", key=f"lote_todos_{clave}"):
+            ids = ids_pagina
+        else:
+            ids = st.multiselect("Pedidos:", ids_pagina, key=f"lote_ids_{clave}",
+                                 format_func=lambda x: f"{x} · {clientes.get(x, '')}")
+        if not ids:
+            st.caption("Selecciona uno o más pedidos de la página actual")
+            return
+        st.caption(f"{len(ids)} pedido(s) seleccionado(s)")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("✅ Marcar como PAGADOS", key=f"lote_pagado_{clave}", use_container_width=True):
+                if marcar_pago_pedidos(ids, True):
+                    mostrar_feedback("exito", f"{len(ids)} pedido(s) marcados como PAGADOS")
+        with col2:
+            if st.button("❌ Marcar como SIN PAGAR", key=f"lote_no_pagado_{clave}", use_container_width=True):
+                if marcar_pago_pedidos(ids, False):
+                    mostrar_feedback("advertencia", f"{len(ids)} pedido(s) marcados como SIN PAGAR")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            nuevo_estado = st.selectbox("Nuevo estado:", estados_destino, key=f"lote_estado_{clave}")
+        with col2:
+            st.write("")
+            if st.button("Cambiar estado", key=f"lote_cambiar_{clave}", use_container_width=True):
+                resultado = cambiar_estado_pedidos(ids, nuevo_estado)
+                if resultado is not None:
+                    mensaje = f"{resultado['pedidos']} pedido(s) cambiados a '{nuevo_estado}'"
+                    if resultado["ajustados"]:
+                        accion = "descontado" if nuevo_estado in ESTADOS_CON_DESCUENTO else "repuesto"
+                        mensaje += f"; inventario {accion} para {resultado['ajustados']}"
+                    mostrar_feedback("exito", mensaje + ".")
+
+        confirmar = st.checkbox("Confirmo que quiero eliminar los pedidos seleccionados", key=f"lote_confirmar_{clave}")
+        if st.button("🗑️ Eliminar seleccionados", key=f"lote_eliminar_{clave}", disabled=not confirmar):
+            resultado = eliminar_pedidos(ids)
+            if resultado is not None:
+                mensaje = f"{resultado['pedidos']} pedido(s) eliminados"
+                if resultado["ajustados"]:
+                    mensaje += f"; inventario repuesto para {resultado['ajustados']}"
+                mostrar_feedback("advertencia", mensaje + ".")
+
+# --- EXPORTACIÓN DE PEDIDOS ---
+# El archivo se arma solo cuando se pide: el almacén escribe el CSV por partes
+# (en PostgreSQL con COPY (SELECT ...) TO STDOUT) a un archivo temporal que
+# pasa a disco si crece, sin cargar los pedidos en un DataFrame. El Parquet se
+# arma leyendo ese CSV por bloques con pyarrow.
+SQL_EXPORTAR_PEDIDOS = {"postgresql": '''
+    SELECT p.id, p.fecha, p.cliente, p.detalle, p.estado, p.cantidad,
+           p.precio_unidad::float8 AS precio_unidad, p.total::float8 AS total,
+           COALESCE(m.costo, 0)::float8 AS costo_materiales,
+           COALESCE(p.pagado, FALSE)::text AS pagado,
+           COALESCE(m.articulos, '') AS articulos
+    FROM pedidos p
+    LEFT JOIN LATERAL (
+        SELECT string_agg(pm.material || '(' || pm.cantidad || ')', ', ' ORDER BY pm.material) AS articulos,
+               SUM(pm.cantidad * COALESCE(i.precio_compra, 0)) AS costo
+        FROM pedido_materiales pm
+        LEFT JOIN inventario i ON i.material = pm.material
+        WHERE pm.pedido_id = p.id
+    ) m ON TRUE
+''', "sqlite": '''
+    SELECT p.id, p.fecha, p.cliente, p.detalle, p.estado, p.cantidad,
+           CAST(p.precio_unidad AS REAL) AS precio_unidad, CAST(p.total AS REAL) AS total,
+           CAST(COALESCE((SELECT SUM(pm.cantidad * COALESCE(i.precio_compra, 0))
+                          FROM pedido_materiales pm
+                          LEFT JOIN inventario i ON i.material = pm.material
+                          WHERE pm.pedido_id = p.id), 0) AS REAL) AS costo_materiales,
+           CASE WHEN p.pagado THEN 'true' ELSE 'false' END AS pagado,
+           COALESCE((SELECT group_concat(a.material || '(' || a.cantidad || ')', ', ')
+                     FROM (SELECT material, cantidad FROM pedido_materiales
+                           WHERE pedido_id = p.id ORDER BY material) a), '') AS articulos
+    FROM pedidos p
+'''}
+COLUMNAS_EXPORTACION = {
+    "id": pa.int64(), "fecha": pa.date32(), "cliente": pa.string(), "detalle": pa.string(),
+    "estado": pa.string(), "cantidad": pa.int64(), "precio_unidad": pa.float64(),
+    "total": pa.float64(), "costo_materiales": pa.float64(), "pagado": pa.bool_(),
+    "articulos": pa.string(),
+}
+FORMATOS_EXPORTACION = {"CSV": ("csv", "text/csv"), "Parquet": ("parquet", "application/octet-stream")}
+# Tamaño hasta el que el archivo temporal se queda en memoria
+EXPORTACION_EN_MEMORIA = 8 * 1024 * 1024
+
+def _copiar_csv(filtros, destino):
+    condiciones, params = condiciones_pedidos(**filtros)
+    get_almacen().copiar_csv(sql_del_motor(SQL_EXPORTAR_PEDIDOS) + _donde(condiciones) + " ORDER BY p.id",
+                             tuple(params), destino)
+    destino.seek(0)
+
+def exportar_pedidos(filtros, formato):
+    # Devuelve un archivo temporal listo para leer desde el inicio
+    contenido_csv = tempfile.SpooledTemporaryFile(max_size=EXPORTACION_EN_MEMORIA)
+    _copiar_csv(filtros, contenido_csv)
+    if formato == "CSV":
+        return contenido_csv
+    salida = tempfile.SpooledTemporaryFile(max_size=EXPORTACION_EN_MEMORIA)
+    with contenido_csv:
+        lector = pa_csv.open_csv(contenido_csv, convert_options=pa_csv.ConvertOptions(column_types=COLUMNAS_EXPORTACION))
+        with pq.ParquetWriter(salida, lector.schema) as escritor:
+            for lote in lector:
+                escritor.write_batch(lote)
+    salida.seek(0)
+    return salida
+
+def _descartar_exportacion(clave):
+    st.session_state.pop(f"exportacion_{clave}", None)
+
+def panel_exportacion(clave, filtros, nombre):
+    # El archivo preparado se lee una sola vez y queda en la sesión hasta que
+    # se descarga o cambian los filtros o el formato; las recargas normales de
+    # la página no consultan ni vuelven a leer nada
+    with st.expander("⬇️ Exportar"):
+        st.caption("Incluye todos los pedidos que cumplen los filtros, no solo la página actual")
+        formato = st.radio("Formato", list(FORMATOS_EXPORTACION), horizontal=True, key=f"exp_formato_{clave}")
+        firma = (repr(sorted(filtros.items())), formato)
+        preparado = st.session_state.get(f"exportacion_{clave}")
+        if preparado is not None and preparado["firma"] != firma:
+            _descartar_exportacion(clave)
+            preparado = None
+        if st.button("📦 Preparar archivo", key=f"btn_exportar_{clave}"):
+            try:
+                with exportar_pedidos(filtros, formato) as archivo:
+                    preparado = {"firma": firma, "datos": archivo.read()}
+                st.session_state[f"exportacion_{clave}"] = preparado
+            except Exception as e:
+                st.error(f"No se pudo exportar: {e}")
+        if preparado is not None:
+            extension, mime = FORMATOS_EXPORTACION[formato]
+            # Al descargar se suelta el archivo: las recargas siguientes ya no lo mandan
+            st.download_button(label=f"⬇️ Descargar {formato}", data=preparado["datos"],
+                               file_name=f"{nombre}.{extension}", mime=mime, key=f"btn_descargar_{clave}",
+                               on_click=_descartar_exportacion, args=(clave,))
+
+# --- IMPORTACIÓN MASIVA ---
+# Carga de muchos registros desde un CSV: las validaciones se hacen por
+# columna con pandas, las filas válidas se copian a una tabla temporal (en
+# PostgreSQL con COPY FROM STDIN) y de ahí pasan a la tabla real con una sola sentencia, todo
+# en una transacción. Las filas rechazadas vuelven con su número y el motivo.
+VALORES_SI = {"si", "sí", "true", "t", "1", "x", "pagado"}
+VALORES_NO = {"", "no", "false", "f", "0"}
+
+SQL_FUSION_INVENTARIO = {"postgresql": '''
+    WITH fusion AS (
+        INSERT INTO inventario (material, cantidad, detalle, precio_compra, precio_venta)
+        SELECT COALESCE(i.material, s.material), s.cantidad, COALESCE(s.detalle, i.detalle, ''),
+               COALESCE(s.precio_compra, i.precio_compra, 0), COALESCE(s.precio_venta, i.precio_venta, 0)
+        FROM importacion s
+        LEFT JOIN LATERAL (
+            SELECT material, detalle, precio_compra, precio_venta FROM inventario
+            WHERE UPPER(material) = UPPER(s.material)
+            ORDER BY material LIMIT 1
+        ) i ON TRUE
+        ON CONFLICT (material) DO UPDATE SET
+            cantidad = EXCLUDED.cantidad, detalle = EXCLUDED.detalle,
+            precio_compra = EXCLUDED.precio_compra, precio_venta = EXCLUDED.precio_venta
+        RETURNING (xmax = 0) AS insertado
+    )
+    SELECT COUNT(*) FILTER (WHERE insertado), COUNT(*) FILTER (WHERE NOT insertado), ARRAY[]::integer[]
+    FROM fusion
+''', "sqlite": [
+    # Los nuevos y actualizados se cuentan antes de escribir
+    '''
+    SELECT COUNT(*) FILTER (WHERE i.material IS NULL), COUNT(*) FILTER (WHERE i.material IS NOT NULL), '[]'
+    FROM importacion s
+    LEFT JOIN inventario i ON i.material = (
+        SELECT material FROM inventario WHERE UPPER(material) = UPPER(s.material) ORDER BY material LIMIT 1)
+    ''',
+    '''
+    INSERT INTO inventario (material, cantidad, detalle, precio_compra, precio_venta)
+    SELECT COALESCE(i.material, s.material), s.cantidad, COALESCE(s.detalle, i.detalle, ''),
+           COALESCE(s.precio_compra, i.precio_compra, 0), COALESCE(s.precio_venta, i.precio_venta, 0)
+    FROM importacion s
+    LEFT JOIN inventario i ON i.material = (
+        SELECT material FROM inventario WHERE UPPER(material) = UPPER(s.material) ORDER BY material LIMIT 1)
+    WHERE TRUE
+    ON CONFLICT (material) DO UPDATE SET
+        cantidad = excluded.cantidad, detalle = excluded.detalle,
+        precio_compra = excluded.precio_compra, precio_venta = excluded.precio_venta
+    ''',
+]}
+
+SQL_FUSION_SUPLIDORES = {"postgresql": '''
+    WITH nuevos AS (
+        INSERT INTO suplidores (nombre, whatsapp, sitio, producto)
+        SELECT s.nombre, COALESCE(s.whatsapp, ''), COALESCE(s.sitio, ''), COALESCE(s.producto, '')
+        FROM importacion s
+        WHERE NOT EXISTS (SELECT 1 FROM suplidores x WHERE UPPER(x.nombre) = UPPER(s.nombre))
+        ORDER BY s.fila
+        RETURNING id
+    )
+    SELECT (SELECT COUNT(*) FROM nuevos), 0,
+           ARRAY(SELECT s.fila FROM importacion s
+                 WHERE EXISTS (SELECT 1 FROM suplidores x WHERE UPPER(x.nombre) = UPPER(s.nombre))
+                 ORDER BY s.fila)
+''', "sqlite": [
+    '''
+    SELECT (SELECT COUNT(*) FROM importacion s
+            WHERE NOT EXISTS (SELECT 1 FROM suplidores x WHERE UPPER(x.nombre) = UPPER(s.nombre))),
+           0,
+           (SELECT json_group_array(fila) FROM (
+                SELECT s.fila FROM importacion s
+                WHERE EXISTS (SELECT 1 FROM suplidores x WHERE UPPER(x.nombre) = UPPER(s.nombre))
+                ORDER BY s.fila))
+    ''',
+    '''
+    INSERT INTO suplidores (nombre, whatsapp, sitio, producto)
+    SELECT s.nombre, COALESCE(s.whatsapp, ''), COALESCE(s.sitio, ''), COALESCE(s.producto, '')
+    FROM importacion s
+    WHERE NOT EXISTS (SELECT 1 FROM suplidores x WHERE UPPER(x.nombre) = UPPER(s.nombre))
+    ORDER BY s.fila
+    ''',
+]}
+
+# Pedidos históricos: entran con inventario_descontado = FALSE, así que
+# importarlos no mueve el stock
+SQL_FUSION_PEDIDOS = {"postgresql": '''
+    WITH nuevos AS (
+        INSERT INTO pedidos (fecha, cliente, detalle, cantidad, precio_unidad, total, estado,
+                             materiales_usados, pagado, inventario_descontado)
+        SELECT s.fecha, s.cliente, COALESCE(s.detalle, ''), s.cantidad,
+               CASE WHEN s.cantidad > 0 THEN ROUND(s.total * 1.0 / s.cantidad, 2) ELSE 0 END, s.total, s.estado,
+               s.materiales, s.pagado, FALSE
+        FROM importacion s
+        ORDER BY s.fila
+        RETURNING id, materiales_usados
+    ),
+    lineas AS (
+        INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+        SELECT n.id, COALESCE(i.material, m.material), SUM(m.cantidad), COALESCE(MAX(i.precio_venta), 0)
+        FROM nuevos n
+        CROSS JOIN jsonb_to_recordset(n.materiales_usados::jsonb) AS m(material TEXT, cantidad INTEGER)
+        LEFT JOIN LATERAL (
+            SELECT material, precio_venta FROM inventario
+            WHERE UPPER(material) = UPPER(m.material)
+            ORDER BY material LIMIT 1
+        ) i ON TRUE
+        GROUP BY n.id, COALESCE(i.material, m.material)
+        RETURNING pedido_id
+    )
+    SELECT (SELECT COUNT(*) FROM nuevos), 0, ARRAY[]::integer[]
+''', "sqlite": [
+    # Los pedidos nuevos son los de id mayor al último que había antes de insertar
+    "DROP TABLE IF EXISTS temp.corte",
+    "CREATE TEMP TABLE corte AS SELECT COALESCE(MAX(id), 0) AS ultimo FROM pedidos",
+    '''
+    INSERT INTO pedidos (fecha, cliente, detalle, cantidad, precio_unidad, total, estado,
+                         materiales_usados, pagado, inventario_descontado)
+    SELECT s.fecha, s.cliente, COALESCE(s.detalle, ''), s.cantidad,
+           CASE WHEN s.cantidad > 0 THEN ROUND(s.total * 1.0 / s.cantidad, 2) ELSE 0 END, s.total, s.estado,
+           s.materiales, s.pagado, FALSE
+    FROM importacion s
+    ORDER BY s.fila
+    ''',
+    '''
+    INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio)
+    SELECT n.id, COALESCE(i.material, json_extract(m.value, '$.material')),
+           SUM(json_extract(m.value, '$.cantidad')), COALESCE(MAX(i.precio_venta), 0)
+    FROM pedidos n
+    JOIN json_each(n.materiales_usados) m
+    LEFT JOIN inventario i ON i.material = (
+        SELECT material FROM inventario
+        WHERE UPPER(material) = UPPER(json_extract(m.value, '$.material'))
+        ORDER BY material LIMIT 1)
+    WHERE n.id > (SELECT ultimo FROM corte)
+    GROUP BY n.id, COALESCE(i.material, json_extract(m.value, '$.material'))
+    ''',
+    "SELECT COUNT(*), 0, '[]' FROM pedidos WHERE id > (SELECT ultimo FROM corte)",
+]}
+
+def _marcar(motivos, mascara, texto):
+    motivos[mascara] = motivos[mascara] + texto + "; "
+
+def _texto(df, columna):
+    return df[columna].str.strip() if columna in df.columns else pd.Series("", index=df.index)
+
+def _numero(df, columna, motivos, obligatorio=False, entero=False):
+    texto = _texto(df, columna)
+    valores = pd.to_numeric(texto, errors="coerce")
+    vacio = texto == ""
+    if obligatorio:
+        _marcar(motivos, vacio, f"{columna} obligatorio")
+    invalido = ~vacio & (valores.isna() | (valores < 0))
+    if entero:
+        invalido |= ~vacio & valores.notna() & (valores % 1 != 0)
+    _marcar(motivos, invalido, f"{columna} debe ser un número{' entero' if entero else ''} mayor o igual a 0")
+    return valores.where(~vacio & ~invalido)
+
+def _validar_inventario(df, motivos):
+    material = _texto(df, "material")
+    _marcar(motivos, material == "", "material obligatorio")
+    repetido = material.str.upper().duplicated() & (material != "")
+    _marcar(motivos, repetido, "material repetido en el archivo")
+    datos = pd.DataFrame({
+        "material": material,
+        "cantidad": _numero(df, "cantidad", motivos, obligatorio=True, entero=True).astype("Int64"),
+        # Vacío queda NULL: al actualizar se conserva el detalle que ya tenía
+        "detalle": _texto(df, "detalle").where(lambda s: s != ""),
+        "precio_compra": _numero(df, "precio_compra", motivos),
+        "precio_venta": _numero(df, "precio_venta", motivos),
+    })
+    return datos
+
+def _validar_suplidores(df, motivos):
+    nombre = _texto(df, "nombre")
+    whatsapp = _texto(df, "whatsapp")
+    _marcar(motivos, nombre == "", "nombre obligatorio")
+    _marcar(motivos, nombre.str.upper().duplicated() & (nombre != ""), "nombre repetido en el archivo")
+    _marcar(motivos, (whatsapp != "") & ~whatsapp.str.isdigit(), "whatsapp solo debe tener números")
+    return pd.DataFrame({"nombre": nombre, "whatsapp": whatsapp,
+                         "sitio": _texto(df, "sitio"), "producto": _texto(df, "producto")})
+
+def _validar_pedidos(df, motivos):
+    fecha_texto = _texto(df, "fecha")
+    fecha = pd.to_datetime(fecha_texto, errors="coerce", format="%Y-%m-%d")
+    _marcar(motivos, fecha_texto == "", "fecha obligatoria")
+    _marcar(motivos, (fecha_texto != "") & fecha.isna(), "fecha debe tener formato AAAA-MM-DD")
+    cliente = _texto(df, "cliente")
+    _marcar(motivos, cliente == "", "cliente obligatorio")
+    total = _numero(df, "total", motivos, obligatorio=True)
+    estado = _texto(df, "estado").replace("", "Entregado")
+    _marcar(motivos, ~estado.isin(lista_estados_todos), "estado desconocido")
+    pago = _texto(df, "pagado").str.lower()
+    _marcar(motivos, ~pago.isin(VALORES_SI | VALORES_NO), "pagado debe ser sí o no")
+
+    # "Vinil:2; Taza:1" -> una fila por material, agrupada por fila del archivo
+    partes = _texto(df, "materiales").str.split(";").explode().str.strip()
+    partes = partes[partes.notna() & (partes != "")]
+    # rpartition siempre devuelve texto (una parte sin ":" queda con material
+    # vacío y se rechaza); sin materiales en ninguna fila no hay nada que separar
+    separadas = partes.str.rpartition(":") if not partes.empty else pd.DataFrame(columns=[0, 1, 2], dtype="object")
+    lineas = pd.DataFrame({
+        "material": separadas[0].str.strip(),
+        "cantidad": pd.to_numeric(separadas[2].str.strip(), errors="coerce"),
+    }, index=partes.index)
+    mala = lineas["cantidad"].isna() | (lineas["cantidad"] <= 0) | (lineas["cantidad"] % 1 != 0) | (lineas["material"] == "")
+    _marcar(motivos, df.index.isin(lineas.index[mala]), "materiales debe tener el formato Material:cantidad; ...")
+    lineas = lineas[~mala]
+    lineas = lineas.assign(cantidad=lineas["cantidad"].astype(int)).groupby([lineas.index, "material"])["cantidad"].sum()
+    lineas = lineas.reset_index(level="material")
+    materiales = pd.Series({fila: json.dumps(g.to_dict("records"), ensure_ascii=False)
+                            for fila, g in lineas.groupby(level=0)}, dtype="object")
+
+    cantidad = _numero(df, "cantidad", motivos, entero=True)
+    cantidad = cantidad.fillna(lineas["cantidad"].groupby(level=0).sum())
+    _marcar(motivos, cantidad.isna() | (cantidad <= 0), "cantidad o materiales obligatorios")
+    return pd.DataFrame({
+        "fecha": fecha.dt.date, "cliente": cliente, "detalle": _texto(df, "detalle"),
+        "cantidad": cantidad.astype("Int64"), "total": total, "estado": estado,
+        "pagado": pago.isin(VALORES_SI), "materiales": materiales.reindex(df.index).fillna("[]"),
+    })
+
+IMPORTACIONES = {
+    "inventario": {
+        "columnas": "material, cantidad, detalle, precio_compra, precio_venta",
+        "staging": "material TEXT, cantidad INTEGER, detalle TEXT, precio_compra NUMERIC, precio_venta NUMERIC",
+        "validar": _validar_inventario,
+        "fusion": SQL_FUSION_INVENTARIO,
+        "ayuda": "Columnas: material y cantidad (obligatorias), detalle, precio_compra, precio_venta. "
+                 "Los materiales que ya existen se actualizan con los valores del archivo.",
+    },
+    "suplidores": {
+        "columnas": "nombre, whatsapp, sitio, producto",
+        "staging": "nombre TEXT, whatsapp TEXT, sitio TEXT, producto TEXT",
+        "validar": _validar_suplidores,
+        "fusion": SQL_FUSION_SUPLIDORES,
+        "ayuda": "Columnas: nombre (obligatoria), whatsapp, sitio, producto. "
+                 "Los suplidores que ya existen se rechazan.",
+    },
+    "pedidos": {
+        "columnas": "fecha, cliente, detalle, cantidad, total, estado, pagado, materiales",
+        "staging": "fecha DATE, cliente TEXT, detalle TEXT, cantidad INTEGER, total NUMERIC, "
+                   "estado TEXT, pagado BOOLEAN, materiales TEXT",
+        "validar": _validar_pedidos,
+        "fusion": SQL_FUSION_PEDIDOS,
+        "ayuda": "Columnas: fecha (AAAA-MM-DD), cliente y total (obligatorias), detalle, cantidad, "
+                 "estado (por defecto Entregado), pagado (sí/no), materiales (Vinil:2; Taza:1). "
+                 "No se descuenta inventario.",
+    },
+}
+
+def validar_importacion(tabla, df):
+    # Devuelve (filas válidas listas para COPY, rechazos con número de fila y motivo)
+    df = df.rename(columns=lambda c: str(c).strip().lower()).fillna("").astype(str)
+    df.index = pd.RangeIndex(2, len(df) + 2, name="fila")  # la fila 1 es el encabezado
+    motivos = pd.Series("", index=df.index)
+    datos = IMPORTACIONES[tabla]["validar"](df, motivos)
+    datos.insert(0, "fila", df.index)
+    malas = motivos != ""
+    rechazos = df[malas].assign(motivo=motivos[malas].str.rstrip("; ")).reset_index()
+    return datos[~malas], rechazos
+
+def importar(tabla, validos):
+    # Devuelve (insertados, actualizados, filas rechazadas por la base de datos)
+    config = IMPORTACIONES[tabla]
+    almacen = get_almacen()
+    fusion = sql_del_motor(config["fusion"])
+    with transaccion() as conn:
+        with conn.cursor() as cur:
+            almacen.crear_temporal(cur, "importacion", f"fila INTEGER, {config['staging']}")
+            almacen.cargar_filas(cur, "importacion", f"fila, {config['columnas']}", validos)
+            insertados, actualizados, rechazadas = ejecutar_sentencias(cur, fusion)[0]
+    get_versiones().subir(*tablas_escritas(fusion))
+    return insertados, actualizados, lista_json(rechazadas)
+
+def panel_importacion(tabla, titulo):
+    with st.expander(titulo):
+        st.caption(IMPORTACIONES[tabla]["ayuda"])
+        archivo = st.file_uploader("Archivo CSV", type=["csv"], key=f"imp_archivo_{tabla}")
+        carpeta = st.secrets.get("IMPORT_DIR")
+        ruta = ""
+        if carpeta:
+            ruta = st.text_input(f"O nombre de un archivo en {carpeta}", key=f"imp_ruta_{tabla}").strip()
+        if st.button("📥 Validar e importar", key=f"btn_importar_{tabla}", disabled=not (archivo or ruta)):
+            try:
+                if archivo is not None:
+                    origen = archivo
+                else:
+                    origen = os.path.join(carpeta, os.path.basename(ruta))
+                df = pd.read_csv(origen, dtype=str, keep_default_na=False)
+                validos, rechazos = validar_importacion(tabla, df)
+                insertados = actualizados = 0
+                if not validos.empty:
+                    insertados, actualizados, rechazadas = importar(tabla, validos)
+                    if rechazadas:
+                        extra = df.set_axis(pd.RangeIndex(2, len(df) + 2, name="fila")).loc[rechazadas]
+                        rechazos = pd.concat([rechazos, extra.assign(motivo="ya existe").reset_index()],
+                                             ignore_index=True).sort_values("fila")
+                st.session_state[f"importacion_{tabla}"] = (insertados, actualizados, rechazos)
+            except Exception as e:
+                st.error(f"No se pudo importar: {e}")
+        resultado = st.session_state.get(f"importacion_{tabla}")
+        if resultado is not None:
+            insertados, actualizados, rechazos = resultado
+            st.success(f"Importación: {insertados} nuevos, {actualizados} actualizados, {len(rechazos)} rechazados")
+            if not rechazos.empty:
+                st.dataframe(rechazos, use_container_width=True, hide_index=True)
+                st.download_button("⬇️ Descargar rechazos", rechazos.to_csv(index=False).encode("utf-8"),
+                                   file_name=f"rechazos_{tabla}.csv", mime="text/csv", key=f"btn_rechazos_{tabla}")
+
 # --- ESTADOS ---
 lista_estados = ["Por confirmar", "Sin diseñar", "Diseños listos", "Listos para entregar"]
 lista_estados_nuevo_pedido = ["Por confirmar", "Sin diseñar"]  # Solo para crear pedidos
@@ -274,39 +3589,168 @@ menu = st.sidebar.radio("Navegación", [
     "Nuevo pedido",
     "Inventario",
     "Suplidores",
-    "Estados"
-])
+    "Estados",
+    "Reportes"
+], key="menu")
+
+# --- DATOS POR PÁGINA ---
+# Cada página declara qué conjuntos de datos usa. Un conjunto se consulta la
+# primera vez que la página lo pide, solo con sus columnas, y se reutiliza en
+# el resto del rerun; las páginas que no lo declaran no lo cargan nunca.
+CONJUNTOS_DATOS = {
+    # nombre: (tabla, columnas, orden)
+    "bajas": ("bajas_material", ["id", "material", "cantidad", "fecha", "motivo", "costo_unitario", "costo_total"], "id"),
+    "suplidores": ("suplidores", ["id", "nombre", "whatsapp", "sitio", "producto"], "id"),
+}
+DATOS_POR_PAGINA = {
+    "Entregas": ["bajas"],
+    "Nuevo pedido": [],  # usa el catálogo de materiales
+    "Inventario": ["bajas"],  # el inventario sale de valoracion_inventario
+    "Suplidores": ["suplidores"],
+    "Estados": [],
+    "Reportes": [],  # lee solo los resúmenes
+}
+
+class DatosPagina:
+    def __init__(self, nombres):
+        self.nombres = set(nombres)
+        self._cargados = {}
+
+    def __getitem__(self, nombre):
+        if nombre not in self.nombres:
+            raise KeyError(f"La página no declaró el conjunto de datos '{nombre}'")
+        if nombre not in self._cargados:
+            tabla, columnas, orden = CONJUNTOS_DATOS[nombre]
+            query = f"SELECT {', '.join(columnas)} FROM {tabla}" + (f" ORDER BY {orden}" if orden else "")
+            self._cargados[nombre] = read_df(query)
+        return self._cargados[nombre]
+
+datos = DatosPagina(DATOS_POR_PAGINA[menu])
+
+# --- REFRESCO AUTOMÁTICO ---
+# Con LIVE_REFRESH_SECONDS > 0, un fragmento revisa cada tantos segundos las
+# versiones de las tablas que muestra la página (no consulta la base de datos)
+# y vuelve a dibujarla si otra sesión u otro servidor las cambió. Se llama antes
+# de dibujar la página: un cambio que llegue durante el dibujo se ve en la
+# siguiente revisión.
+TABLAS_POR_PAGINA = {
+    "Entregas": ("pedidos", "pedido_materiales", "bajas_material"),
+    "Nuevo pedido": ("inventario", "reservas"),
+    "Inventario": ("inventario", "bajas_material", "bajas_por_material"),
+    "Suplidores": ("suplidores",),
+    "Estados": ("pedidos", "pedido_materiales"),
+    "Reportes": TABLAS_RESUMEN + ("inventario",),
+}
+SEGUNDOS_REFRESCO = float(st.secrets.get("LIVE_REFRESH_SECONDS", 0))
+
+def version_pagina():
+    return (menu, get_versiones().version(*TABLAS_POR_PAGINA[menu]))
+
+@st.fragment(run_every=SEGUNDOS_REFRESCO or None)
+def vigilar_cambios():
+    if version_pagina() != st.session_state.get("version_vista"):
+        st.rerun()
+
+if SEGUNDOS_REFRESCO > 0:
+    st.session_state["version_vista"] = version_pagina()
+    vigilar_cambios()
 
 # --- RESUMEN FINANCIERO PEQUEÑO EN SIDEBAR ---
-df_entregas = read_df("SELECT * FROM pedidos WHERE estado = 'Entregado'")
-inventario_df = read_df("SELECT * FROM inventario")
-bajas_df = read_df("SELECT * FROM bajas_material")
-
-# Asegurar que la columna pagado existe
-if not df_entregas.empty and 'pagado' not in df_entregas.columns:
-    df_entregas['pagado'] = False
-
-# FILTRAR SOLO PEDIDOS PAGADOS para calcular finanzas
-df_entregas_pagados = df_entregas[df_entregas['pagado'] == True] if not df_entregas.empty else df_entregas
-
-ingresos_totales = df_entregas_pagados['total'].sum() if not df_entregas_pagados.empty else 0
-cantidad_pedidos = len(df_entregas)  # Total de entregas (pagadas y no pagadas)
-cantidad_pagados = len(df_entregas_pagados)  # Solo pagadas
-
-costos_totales = 0
-if not df_entregas_pagados.empty and not inventario_df.empty:
-    for _, row in df_entregas_pagados.iterrows():
-        materiales = json.loads(row['materiales_usados']) if row['materiales_usados'] else []
-        for material in materiales:
-            mat_name = material['material']
-            mat_cant = material['cantidad']
-            mat_precio_compra = inventario_df[inventario_df['material'] == mat_name]['precio_compra'].values
-            if len(mat_precio_compra) > 0:
-                costos_totales += mat_precio_compra[0] * mat_cant
-
-gastos_baja = bajas_df['costo_total'].sum() if not bajas_df.empty else 0
-ganancia_neta = ingresos_totales - costos_totales
-margen_ganancia = (ganancia_neta / ingresos_totales * 100) if ingresos_totales > 0 else 0
+# Solo los pedidos entregados y PAGADOS cuentan para ingresos y costos; el costo
+# de cada material sale del precio de compra actual en inventario. Los totales
+# vienen de la fila del libro de finanzas que mantienen los triggers, así que
+# leerlos no depende de cuántos pedidos haya.
+SQL_LIBRO_FINANZAS = """
+    SELECT ingresos AS ingresos_totales, costos AS costos_totales, gastos_baja,
+           entregas AS cantidad_pedidos, pagados AS cantidad_pagados
+    FROM finanzas
+"""
+CAMPOS_FINANZAS = ["ingresos_totales", "costos_totales", "gastos_baja", "cantidad_pedidos", "cantidad_pagados"]
+
+def resumen_financiero():
+    df = read_df(SQL_LIBRO_FINANZAS)
+    fila = df.iloc[0] if not df.empty else {}
+    ingresos = float(fila.get('ingresos_totales', 0) or 0)
+    costos = float(fila.get('costos_totales', 0) or 0)
+    ganancia = ingresos - costos
+    return {
+        'ingresos_totales': ingresos,
+        'costos_totales': costos,
+        'gastos_baja': float(fila.get('gastos_baja', 0) or 0),
+        'ganancia_neta': ganancia,
+        'margen_ganancia': (ganancia / ingresos * 100) if ingresos > 0 else 0,
+        'cantidad_pedidos': int(fila.get('cantidad_pedidos', 0) or 0),  # Total de entregas (pagadas y no pagadas)
+        'cantidad_pagados': int(fila.get('cantidad_pagados', 0) or 0),  # Solo pagadas
+    }
+
+def conciliar_finanzas():
+    # Recalcula el libro desde cero y devuelve {campo: (libro, recalculado)}
+    # para los totales que no coincidían
+    with transaccion() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SQL_LIBRO_FINANZAS + get_almacen().bloqueo_filas)
+            antes = cur.fetchone() or (0,) * len(CAMPOS_FINANZAS)
+            ejecutar_sentencias(cur, sql_del_motor(SQL_RECALCULAR_FINANZAS))
+            cur.execute(SQL_LIBRO_FINANZAS)
+            despues = cur.fetchone()
+            # El stock reservado y las bajas por material también los llevan
+            # triggers: se rehacen en la misma pasada
+            ejecutar_sentencias(cur, SENTENCIAS_RECALCULAR_RESERVAS)
+            ejecutar_sentencias(cur, SENTENCIAS_RECALCULAR_BAJAS_POR_MATERIAL)
+    get_versiones().subir("finanzas", "reservas", "bajas_por_material")
+    return {campo: (a or 0, d or 0) for campo, a, d in zip(CAMPOS_FINANZAS, antes, despues)
+            if abs((a or 0) - (d or 0)) > 0.005}
+
+def reconstruir_resumenes():
+    with transaccion() as conn:
+        with conn.cursor() as cur:
+            ejecutar_sentencias(cur, sql_del_motor(SQL_RECALCULAR_RESUMENES))
+    get_versiones().subir(*TABLAS_RESUMEN)
+
+# --- REPORTES ---
+# Los reportes leen solo los resúmenes: una fila por día o por mes del rango,
+# sin importar cuántos pedidos haya. El costo de los materiales se valoriza con
+# el precio de compra actual, igual que el libro de finanzas.
+GRANULARIDADES = {
+    # nombre: (resumen, resumen de materiales, columna)
+    "Día": ("resumen_diario", "resumen_materiales_diario", "dia"),
+    "Mes": ("resumen_mensual", "resumen_materiales_mensual", "mes"),
+}
+
+def reporte_periodos(desde, hasta, granularidad):
+    tabla, tabla_materiales, llave = GRANULARIDADES[granularidad]
+    if granularidad == "Mes":
+        desde = desde.replace(day=1)
+    df = read_df(f'''
+        SELECT r.{llave} AS periodo, r.pedidos, r.entregas, r.pagados,
+               r.ventas_pagadas, r.ventas_sin_pagar, r.gastos_baja, COALESCE(c.costos, 0) AS costos
+        FROM {tabla} r
+        LEFT JOIN (
+            SELECT m.{llave} AS periodo, SUM(m.cantidad_pagada * COALESCE(i.precio_compra, 0)) AS costos
+            FROM {tabla_materiales} m
+            JOIN inventario i ON i.material = m.material
+            WHERE m.{llave} BETWEEN %s AND %s
+            GROUP BY m.{llave}
+        ) c ON c.periodo = r.{llave}
+        WHERE r.{llave} BETWEEN %s AND %s
+        ORDER BY r.{llave}
+    ''', (desde, hasta, desde, hasta))
+    if df.empty:
+        return df
+    df['periodo'] = pd.to_datetime(df['periodo'])
+    for columna in ['ventas_pagadas', 'ventas_sin_pagar', 'gastos_baja', 'costos']:
+        df[columna] = df[columna].astype(float)
+    df['ganancia'] = df['ventas_pagadas'] - df['costos'] - df['gastos_baja']
+    return df
+
+finanzas = resumen_financiero()
+ingresos_totales = finanzas['ingresos_totales']
+costos_totales = finanzas['costos_totales']
+gastos_baja = finanzas['gastos_baja']
+ganancia_neta = finanzas['ganancia_neta']
+margen_ganancia = finanzas['margen_ganancia']
+cantidad_pedidos = finanzas['cantidad_pedidos']
+cantidad_pagados = finanzas['cantidad_pagados']
 
 st.sidebar.markdown("#### 📊 Finanza (entregas)")
 st.sidebar.caption(f"💰 Ingresos: ${ingresos_totales:,.0f}")
@@ -370,58 +3814,115 @@ with col_ajustes2:
             st.session_state.fondo_url = ""
             st.rerun()
 
+        st.divider()
+        st.markdown("#### 🔌 Conexiones")
+        almacen = get_almacen()
+        estado_pool = almacen.estado()
+        st.caption(f"Base de datos: {almacen.nombre}")
+        if almacen.dialecto == "postgresql":
+            st.caption(f"En uso: {estado_pool['en_uso']} de {estado_pool['abiertas']} abiertas (máx. {estado_pool['maximo']})")
+            st.caption(f"Espera promedio: {estado_pool['espera_promedio'] * 1000:.1f} ms · "
+                       f"máx: {estado_pool['espera_max'] * 1000:.1f} ms")
+            st.caption(f"Préstamos: {estado_pool['prestamos']} · Reemplazadas: {estado_pool['reemplazadas']} · "
+                       f"Sin conexión libre: {estado_pool['timeouts']}")
+            oyente = get_oyente_cambios()
+            if oyente is None:
+                st.caption("Avisos de otros servidores: apagados (pooler en modo transacción; "
+                           "configura LISTEN_DATABASE_URL)")
+            else:
+                estado_oyente = oyente.estado()
+                st.caption(f"Avisos de otros servidores: {'escuchando' if estado_oyente['escuchando'] else 'sin conexión'} · "
+                           f"Recibidos: {estado_oyente['avisos']} · "
+                           f"Reconexiones: {estado_oyente['reconexiones']}")
+        else:
+            st.caption(f"Archivo: {almacen.ruta} · En uso: {estado_pool['en_uso']} de {estado_pool['abiertas']} abiertas")
+            st.caption(f"Préstamos: {estado_pool['prestamos']}")
+
+        st.markdown("#### 🗄️ Caché de consultas")
+        estado_cache = get_cache_consultas().estado()
+        st.caption(f"Entradas: {estado_cache['entradas']} de {get_cache_consultas().max_entradas} · "
+                   f"Aciertos: {estado_cache['aciertos']} ({estado_cache['tasa_aciertos']:.0f}%) · "
+                   f"Fallos: {estado_cache['fallos']} · Expulsadas: {estado_cache['expulsiones']}")
+        if st.button("🧹 Vaciar caché", key="btn_vaciar_cache", use_container_width=True):
+            get_cache_consultas().limpiar()
+            st.cache_data.clear()
+            st.rerun()
+
+        st.markdown("#### 📒 Libro de finanzas")
+        st.caption("Recalcula los totales, el stock reservado y las bajas por material desde el historial y corrige cualquier diferencia")
+        if st.button("🧮 Conciliar totales", key="btn_conciliar", use_container_width=True):
+            try:
+                st.session_state["conciliacion"] = conciliar_finanzas()
+                st.rerun()
+            except Exception as e:
+                st.error(f"No se pudo conciliar: {e}")
+        if "conciliacion" in st.session_state:
+            diferencias = st.session_state["conciliacion"]
+            if not diferencias:
+                st.caption("✅ Sin diferencias")
+            for campo, (libro, recalculado) in diferencias.items():
+                st.caption(f"⚠️ {campo}: {libro:,.2f} → {recalculado:,.2f} (corregido)")
+        st.caption("Los reportes leen resúmenes por día y por mes; reconstrúyelos si se editó la base a mano")
+        if st.button("📆 Reconstruir resúmenes", key="btn_resumenes", use_container_width=True):
+            try:
+                reconstruir_resumenes()
+                mostrar_feedback("exito", "Resúmenes reconstruidos")
+            except Exception as e:
+                st.error(f"No se pudieron reconstruir los resúmenes: {e}")
+
 # ---------------------------------------------------------
 # ENTREGAS
 # ---------------------------------------------------------
 if menu == "Entregas":
     st.title("📋 Entregas Completadas")
-    df = read_df("SELECT * FROM pedidos WHERE estado = 'Entregado'")
-    inventario_df = read_df("SELECT * FROM inventario")
-    bajas_df = read_df("SELECT * FROM bajas_material")
+    bajas_df = datos["bajas"]
+    filtros_entregas = filtros_pedidos("entregas", estado="Entregado")
+    df = tabla_paginada("entregas", filtros_entregas) if cantidad_pedidos > 0 else pd.DataFrame()
     if not df.empty:
-        df['materiales_mostrados'] = df['materiales_usados'].apply(
-            lambda x: ', '.join([f"{i['material']}({i['cantidad']})" for i in json.loads(x)]) if x else "")
+        df['materiales_mostrados'] = df['id'].map(articulos_por_pedido(df['id'])).fillna('')
+        df['costo_materiales'] = df['id'].map(costo_por_pedido(df['id'])).fillna(0)
         # Asegurar que la columna pagado existe
         if 'pagado' not in df.columns:
             df['pagado'] = False
         df['pagado_texto'] = df['pagado'].apply(lambda x: '✅ Pagado' if x else '❌ Sin pagar')
-        df_orden = df[['id', 'estado', 'cantidad', 'precio_unidad', 'total', 'cliente', 'detalle', 'fecha', 'pagado_texto', 'materiales_mostrados']]
+        df_orden = df[['id', 'estado', 'cantidad', 'precio_unidad', 'total', 'costo_materiales', 'cliente', 'detalle', 'fecha', 'pagado_texto', 'materiales_mostrados']]
         df_orden = df_orden.rename(columns={
             'id': 'ID', 'estado': 'Estado', 'cantidad': 'Cantidad',
             'precio_unidad': 'Precio x unidad', 'total': 'Precio total',
+            'costo_materiales': 'Costo materiales',
             'pagado_texto': 'Pago',
             'materiales_mostrados': 'Artículos usados'
         })
         df_orden['Precio x unidad'] = df_orden['Precio x unidad'].astype(int)
         df_orden['Precio total'] = df_orden['Precio total'].astype(int)
+        df_orden['Costo materiales'] = df_orden['Costo materiales'].astype(int)
         st.dataframe(df_orden, use_container_width=True, hide_index=True)
-        st.download_button(label="⬇️ Descargar CSV entregas",
-                           data=df_orden.to_csv(index=False).encode('utf-8'),
-                           file_name='entregas.csv', mime='text/csv')
+        panel_exportacion("entregas", filtros_entregas, "entregas")
         
+        acciones_en_lote("entregas", df, lista_estados)
+
         st.divider()
         st.subheader("💳 Marcar pago de pedido")
         
-        # Selectbox con placeholder
-        ids_opciones_pago = ["-- Selecciona ID --"] + [str(x) for x in df['id'].tolist()]
-        id_pago_selec = st.selectbox("Selecciona ID de pedido:", ids_opciones_pago, key="id_pago")
+        pedido_selec = selector_pedido("Selecciona ID de pedido:", "id_pago", filtros_entregas, df)
         
-        if id_pago_selec != "-- Selecciona ID --":
-            id_pago = int(id_pago_selec)
-            pedido_selec = df[df['id'] == id_pago].iloc[0]
+        if pedido_selec is not None:
+            id_pago = int(pedido_selec['id'])
             estado_actual = '✅ Pagado' if pedido_selec.get('pagado', False) else '❌ Sin pagar'
             st.caption(f"Estado actual: {estado_actual}")
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("✅ Marcar como PAGADO"):
-                    _ = safe_query("UPDATE pedidos SET pagado = TRUE WHERE id = %s", (id_pago,))
+                    _ = marcar_pago_pedidos([id_pago], True)
                     mostrar_feedback("exito", f"Pedido {id_pago} marcado como PAGADO")
             with col2:
                 if st.button("❌ Marcar como SIN PAGAR"):
-                    _ = safe_query("UPDATE pedidos SET pagado = FALSE WHERE id = %s", (id_pago,))
+                    _ = marcar_pago_pedidos([id_pago], False)
                     mostrar_feedback("advertencia", f"Pedido {id_pago} marcado como SIN PAGAR")
         else:
             st.info("👆 Selecciona un pedido para marcar su pago")
+    elif cantidad_pedidos > 0:
+        st.info("No hay entregas que coincidan con los filtros.")
     else:
         st.info("No hay entregas completadas aún.")
 
@@ -442,31 +3943,18 @@ if menu == "Entregas":
     if not df.empty:
         st.divider()
         
-        # Selectbox con placeholder
-        ids_opciones_del = ["-- Selecciona ID --"] + [str(x) for x in df['id'].tolist()]
-        id_eliminar_selec = st.selectbox("Selecciona pedido entregado a eliminar:", ids_opciones_del, key="del_ped_ent")
+        pedido_a_eliminar = selector_pedido("Selecciona pedido entregado a eliminar:", "del_ped_ent",
+                                            filtros_entregas, df)
         
-        if id_eliminar_selec != "-- Selecciona ID --":
-            id_eliminar = int(id_eliminar_selec)
+        if pedido_a_eliminar is not None:
+            id_eliminar = int(pedido_a_eliminar['id'])
             if st.button("🗑️ Eliminar pedido seleccionado", key="btn_del_ped_ent"):
-                # Obtener el pedido antes de eliminarlo
-                pedido_a_eliminar = df[df['id'] == id_eliminar].iloc[0]
-                inventario_descontado = pedido_a_eliminar.get('inventario_descontado', False)
-                
-                # Si el inventario fue descontado, devolverlo
-                if inventario_descontado:
-                    materiales = json.loads(pedido_a_eliminar['materiales_usados']) if pedido_a_eliminar['materiales_usados'] else []
-                    for m in materiales:
-                        _ = safe_query("UPDATE inventario SET cantidad = cantidad + %s WHERE material = %s",
-                                   (int(m['cantidad']), m['material']))
-                
-                # Eliminar el pedido
-                _ = safe_query("DELETE FROM pedidos WHERE id = %s", (int(id_eliminar),))
-                
-                if inventario_descontado:
-                    mostrar_feedback("advertencia", f"Pedido {id_eliminar} eliminado e inventario repuesto.")
-                else:
-                    mostrar_feedback("advertencia", f"Pedido {id_eliminar} eliminado.")
+                resultado = eliminar_pedidos([id_eliminar])
+                if resultado is not None:
+                    if resultado["ajustados"]:
+                        mostrar_feedback("advertencia", f"Pedido {id_eliminar} eliminado e inventario repuesto.")
+                    else:
+                        mostrar_feedback("advertencia", f"Pedido {id_eliminar} eliminado.")
         else:
             st.info("👆 Selecciona un pedido para eliminar")
 
@@ -475,10 +3963,9 @@ if menu == "Entregas":
 # ---------------------------------------------------------
 elif menu == "Nuevo pedido":
     st.title("📝 Registrar nuevo pedido")
-    inventario_df = read_df("SELECT * FROM inventario")
-    # Filtrar solo materiales con stock disponible
-    inventario_con_stock = inventario_df[inventario_df['cantidad'] > 0] if not inventario_df.empty else inventario_df
-    inventario_list = inventario_con_stock['material'].tolist() if not inventario_con_stock.empty else []
+    panel_importacion("pedidos", "📥 Importar pedidos históricos desde CSV")
+    # Solo materiales con stock disponible (sin lo reservado por pedidos abiertos)
+    catalogo = catalogo_materiales()
     
     # Inicializar session_state
     if "material_rows_v2" not in st.session_state:
@@ -526,10 +4013,7 @@ elif menu == "Nuevo pedido":
     cantidad_total_materiales = 0
     
     for ix in st.session_state.material_rows_v2:
-        # Filtrar materiales disponibles
-        opciones_disp = [m for m in inventario_list if m not in usados_ya]
-        
-        if not opciones_disp:
+        if len(usados_ya) >= len(catalogo):
             st.info("No hay más materiales con stock disponible")
             break
         
@@ -540,36 +4024,33 @@ elif menu == "Nuevo pedido":
         cant_key = f"cant_sel_{ix}_v2"
         precio_key = f"precio_sel_{ix}_v2"
         
-        if mat_key not in st.session_state:
-            st.session_state[mat_key] = opciones_disp[0]
+        # Asegurar que el material actual tiene stock y no lo usa otra fila
+        if st.session_state.get(mat_key) not in catalogo or st.session_state[mat_key] in usados_ya:
+            st.session_state[mat_key] = catalogo.primero_libre(usados_ya)
         if cant_key not in st.session_state:
             st.session_state[cant_key] = 1
         if precio_key not in st.session_state:
             # Obtener precio por defecto del material
-            mat_row = inventario_con_stock[inventario_con_stock['material'] == opciones_disp[0]]
-            st.session_state[precio_key] = int(mat_row['precio_venta'].iloc[0]) if not mat_row.empty else 0
-        
-        # Asegurar que el material actual está en opciones disponibles
-        if st.session_state[mat_key] not in opciones_disp:
-            st.session_state[mat_key] = opciones_disp[0]
+            st.session_state[precio_key] = catalogo.precio[st.session_state[mat_key]]
         
         with cols_mat[0]:
+            # Sin búsqueda se ofrecen los primeros materiales libres; con búsqueda, los que empiezan así
+            busqueda = st.text_input(f"Buscar material {ix+1}", key=f"buscar_{mat_key}",
+                                     placeholder="Escribe el inicio del nombre")
+            opciones_disp = catalogo.buscar(busqueda, excluir=usados_ya)
+            if st.session_state[mat_key] not in opciones_disp:
+                opciones_disp.insert(0, st.session_state[mat_key])
             mat = st.selectbox(
                 f"Material {ix+1}:", 
                 opciones_disp, 
-                index=opciones_disp.index(st.session_state[mat_key]) if st.session_state[mat_key] in opciones_disp else 0,
+                index=opciones_disp.index(st.session_state[mat_key]),
                 key=f"select_{mat_key}"
             )
             st.session_state[mat_key] = mat
         
         # Obtener info del material seleccionado
-        mat_row = inventario_con_stock[inventario_con_stock['material'] == mat]
-        if not mat_row.empty:
-            max_disp = int(mat_row['cantidad'].iloc[0])
-            precio_venta_default = int(mat_row['precio_venta'].iloc[0])
-        else:
-            max_disp = 0
-            precio_venta_default = 0
+        max_disp = catalogo.stock.get(mat, 0)
+        precio_venta_default = catalogo.precio.get(mat, 0)
         
         # Ajustar cantidad si supera el máximo disponible
         if st.session_state[cant_key] > max_disp:
@@ -584,7 +4065,8 @@ elif menu == "Nuevo pedido":
                     value=st.session_state[cant_key],
                     step=1, 
                     format="%d", 
-                    key=f"input_{cant_key}"
+                    key=f"input_{cant_key}",
+                    help=f"Disponible: {max_disp} (stock menos lo reservado por pedidos abiertos)"
                 )
                 st.session_state[cant_key] = cant
             else:
@@ -637,26 +4119,21 @@ elif menu == "Nuevo pedido":
         if precio_total_calculado <= 0:
             errores.append("- El precio total debe ser mayor a 0")
         
-        for m in materiales_usados:
-            mat_stock = inventario_df[inventario_df['material'] == m['material']]
-            if not mat_stock.empty:
-                stock_actual = int(mat_stock['cantidad'].iloc[0])
-                if m['cantidad'] > stock_actual:
-                    errores.append(f"- Stock insuficiente de {m['material']} (disponible: {stock_actual})")
-        
         if errores:
-            mostrar_feedback("error", "Corrige los siguientes errores:\n" + "\n".join(errores), tiempo=3)
+            mostrar_feedback("error", "Corrige los siguientes errores:\n" + "\n".join(errores))
         else:
             mat_json = json.dumps(materiales_usados, ensure_ascii=False)
             precio_promedio = precio_total_calculado // cantidad_total_materiales if cantidad_total_materiales > 0 else 0
             
-            # Guardar pedido SIN descontar inventario (se descontará al cambiar a "Listos para entregar")
-            query_ok = safe_query(
-                "INSERT INTO pedidos (fecha, cliente, detalle, cantidad, precio_unidad, total, estado, materiales_usados, pagado, inventario_descontado) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (str(st.session_state.pedido_fecha), st.session_state.pedido_cliente.strip(), 
-                 st.session_state.pedido_detalle.strip(), cantidad_total_materiales,
-                 precio_promedio, precio_total_calculado, st.session_state.pedido_estado, mat_json, False, False)
-            )
+            # Guardar pedido SIN descontar inventario (se descontará al cambiar a "Listos para entregar").
+            # El pedido y sus líneas se insertan en una sola transacción, que
+            # revisa el stock disponible en la base y no en el catálogo en caché.
+            query_ok = crear_pedido({
+                "fecha": st.session_state.pedido_fecha, "cliente": st.session_state.pedido_cliente.strip(),
+                "detalle": st.session_state.pedido_detalle.strip(), "cantidad": cantidad_total_materiales,
+                "precio_unidad": precio_promedio, "total": precio_total_calculado,
+                "estado": st.session_state.pedido_estado, "materiales": mat_json,
+            })
             
             if query_ok:
                 # NO descontamos inventario aquí - se hará al cambiar estado a "Listos para entregar"
@@ -674,7 +4151,6 @@ elif menu == "Nuevo pedido":
                     del st.session_state[k]
                 
                 mostrar_feedback("exito", f"¡Pedido guardado con éxito! Total: ${precio_total_calculado:,.0f}")
-                st.rerun()
     
     # Mensaje si el botón está deshabilitado
     if not puede_guardar:
@@ -691,7 +4167,8 @@ elif menu == "Nuevo pedido":
 # ---------------------------------------------------------
 elif menu == "Inventario":
     st.title("📦 Inventario de materiales")
-    inventario_df = read_df("SELECT * FROM inventario")
+    # Una sola lectura para la baja, la tabla y la edición
+    inventario_df = valoracion_inventario()
     with st.expander("➕ Agregar material", expanded=False):
         with st.form("frm_inventario", clear_on_submit=True):
             material = st.text_input("Nombre del material *")
@@ -718,6 +4195,7 @@ elif menu == "Inventario":
                         )
                         if query_ok:
                             mostrar_feedback("exito", f"Material '{material}' guardado correctamente")
+    panel_importacion("inventario", "📥 Importar materiales desde CSV")
 
     # --- REGISTRAR BAJA ---
     st.subheader("🗑️ Registrar baja de material")
@@ -736,19 +4214,15 @@ elif menu == "Inventario":
                                         value=1, step=1, key='cant_baja')
             motivo = st.text_input("Motivo (Ej: Daño, vencimiento, uso interno)", value="", placeholder="Ingresa el motivo", key='motivo_baja')
             costo_unit = float(inventario_con_stock_baja[inventario_con_stock_baja['material'] == mat_baja]['precio_compra'].iloc[0])
-            fecha_baja = date.today().isoformat()
+            fecha_baja = date.today()
             
             # Validar que haya motivo
             puede_registrar = motivo.strip() != "" and cant_baja > 0
             
             if st.button("Registrar baja de material", disabled=not puede_registrar):
-                _ = safe_query("UPDATE inventario SET cantidad = cantidad - %s WHERE material = %s", (cant_baja, mat_baja))
-                costo_total = costo_unit * cant_baja
-                _ = safe_query(
-                    "INSERT INTO bajas_material (material, cantidad, fecha, motivo, costo_unitario, costo_total) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (mat_baja, cant_baja, fecha_baja, motivo.strip(), costo_unit, costo_total)
-                )
-                mostrar_feedback("exito", f"Baja registrada: {cant_baja} de {mat_baja} por '{motivo.strip()}'")
+                # El descuento y la baja van juntos y solo si todavía alcanza el stock
+                if registrar_baja(mat_baja, cant_baja, motivo.strip(), costo_unit, fecha_baja) is not None:
+                    mostrar_feedback("exito", f"Baja registrada: {cant_baja} de {mat_baja} por '{motivo.strip()}'")
             
             if not puede_registrar:
                 st.caption("⚠️ Completa el motivo para habilitar el botón")
@@ -759,7 +4233,7 @@ elif menu == "Inventario":
     
     # --- EDITAR/ELIMINAR BAJAS ---
     st.divider()
-    bajas_df_edit = read_df("SELECT * FROM bajas_material")
+    bajas_df_edit = datos["bajas"]
     if not bajas_df_edit.empty:
         with st.expander("✏️ Editar o eliminar bajas registradas"):
             st.dataframe(bajas_df_edit[['id', 'material', 'cantidad', 'fecha', 'motivo', 'costo_total']], 
@@ -821,39 +4295,12 @@ elif menu == "Inventario":
                 st.info("👆 Selecciona un ID de baja para editar o eliminar")
 
     # --- VISUALIZACIÓN INVENTARIO ---
-    inventario_df = read_df("SELECT * FROM inventario")
-    bajas_df = read_df("SELECT * FROM bajas_material")
-    
     # Checkbox para filtrar materiales con stock
     mostrar_solo_con_stock = st.checkbox("📦 Mostrar solo materiales con stock disponible", value=False, key="filtro_stock")
+    if mostrar_solo_con_stock:
+        inventario_df = inventario_df[inventario_df['cantidad'] > 0]
     
     if not inventario_df.empty:
-        inventario_df['cantidad'] = inventario_df['cantidad'].astype(int)
-        inventario_df['precio_compra'] = inventario_df['precio_compra'].astype(int)
-        inventario_df['precio_venta'] = inventario_df['precio_venta'].astype(int)
-        inventario_df['ganancia_unitaria'] = inventario_df['precio_venta'] - inventario_df['precio_compra']
-        inventario_df['inversion_total'] = inventario_df['cantidad'] * inventario_df['precio_compra']
-        inventario_df['ganancia_total'] = inventario_df['cantidad'] * inventario_df['ganancia_unitaria']
-        
-        # Calcular bajas por material
-        if not bajas_df.empty:
-            bajas_agrupadas = bajas_df.groupby('material').agg({
-                'cantidad': 'sum',
-                'costo_total': 'sum'
-            }).reset_index()
-            bajas_agrupadas.columns = ['material', 'cantidad_baja', 'costo_baja']
-            inventario_df = inventario_df.merge(bajas_agrupadas, on='material', how='left')
-        else:
-            inventario_df['cantidad_baja'] = 0
-            inventario_df['costo_baja'] = 0
-        
-        inventario_df['cantidad_baja'] = inventario_df['cantidad_baja'].fillna(0).astype(int)
-        inventario_df['costo_baja'] = inventario_df['costo_baja'].fillna(0).astype(int)
-        
-        # Aplicar filtro si está activado
-        if mostrar_solo_con_stock:
-            inventario_df = inventario_df[inventario_df['cantidad'] > 0]
-        
         df_vista = inventario_df[['material', 'cantidad', 'detalle', 'precio_compra', 'precio_venta',
                                    'ganancia_unitaria', 'cantidad_baja', 'costo_baja', 
                                    'inversion_total', 'ganancia_total']].copy()
@@ -883,10 +4330,13 @@ elif menu == "Inventario":
         if mat_editar_selec != "-- Selecciona un material --":
             mat_editar = mat_editar_selec
             mat_data = inventario_df[inventario_df['material'] == mat_editar].iloc[0]
+            uso_material = uso_por_material()
+            usado_en_pedidos = int(uso_material['cantidad_usada'].get(mat_editar, 0)) if not uso_material.empty else 0
             
             # Mostrar valores actuales
             st.info(f"📊 **Valores actuales de '{mat_editar}':**\n\n"
                     f"• Cantidad: {int(mat_data['cantidad'])}\n\n"
+                    f"• Usado en pedidos: {usado_en_pedidos}\n\n"
                     f"• Detalle: {mat_data['detalle'] if mat_data['detalle'] else 'Sin detalle'}\n\n"
                     f"• Precio compra: ${int(mat_data['precio_compra'])}\n\n"
                     f"• Precio venta: ${int(mat_data['precio_venta'])}")
@@ -905,11 +4355,16 @@ elif menu == "Inventario":
                     precio_c_final = nuevo_precio_compra if nuevo_precio_compra > 0 else int(mat_data['precio_compra'])
                     precio_v_final = nuevo_precio_venta if nuevo_precio_venta > 0 else int(mat_data['precio_venta'])
                     
-                    _ = safe_query(
-                        "UPDATE inventario SET cantidad = %s, detalle = %s, precio_compra = %s, precio_venta = %s WHERE material = %s",
-                        (cantidad_final, detalle_final, precio_c_final, precio_v_final, mat_editar)
+                    # Solo se guarda si nadie cambió el material desde que se mostró
+                    filas = safe_query_filas(
+                        "UPDATE inventario SET cantidad = %s, detalle = %s, precio_compra = %s, precio_venta = %s "
+                        "WHERE material = %s AND version = %s RETURNING version",
+                        (cantidad_final, detalle_final, precio_c_final, precio_v_final, mat_editar, int(mat_data['version']))
                     )
-                    mostrar_feedback("exito", f"Material '{mat_editar}' actualizado correctamente.")
+                    if filas == []:
+                        conflicto_edicion("inventario", f"El material '{mat_editar}'")
+                    elif filas:
+                        mostrar_feedback("exito", f"Material '{mat_editar}' actualizado correctamente.")
         else:
             st.info("👆 Selecciona un material para editar")
         st.divider()
@@ -925,6 +4380,8 @@ elif menu == "Inventario":
                     mostrar_feedback("advertencia", f"Material '{mat_eliminar_selec}' eliminado.")
         else:
             st.info("👆 Selecciona un material para eliminar")
+    elif mostrar_solo_con_stock:
+        st.info("No hay materiales con stock disponible.")
     else:
         st.info("No hay materiales registrados.")
 
@@ -957,7 +4414,8 @@ elif menu == "Suplidores":
                         )
                         if query_ok:
                             mostrar_feedback("exito", "Suplidor guardado correctamente.")
-    suplidores_df = read_df("SELECT * FROM suplidores")
+    panel_importacion("suplidores", "📥 Importar suplidores desde CSV")
+    suplidores_df = datos["suplidores"]
     if not suplidores_df.empty:
         st.dataframe(suplidores_df.rename(
             columns={'nombre': 'Nombre', 'whatsapp': 'WhatsApp', 'sitio': 'Web', 'producto': 'Compra'}),
@@ -983,14 +4441,15 @@ elif menu == "Suplidores":
 # ---------------------------------------------------------
 elif menu == "Estados":
     st.title("📋 Consultar estados de pedidos")
-    df = read_df("SELECT * FROM pedidos")
-    if df.empty:
+    conteos = conteo_por_estado()
+    if not conteos:
         st.info("No hay pedidos registrados aún.")
     else:
-        estado_sel = st.selectbox("Selecciona estado:", lista_estados_todos)
-        df_est = df[df['estado'] == estado_sel].copy()
-        df_est['materiales_mostrados'] = df_est['materiales_usados'].apply(
-            lambda x: ', '.join([f"{i['material']}({i['cantidad']})" for i in json.loads(x)]) if x else "")
+        estado_sel = st.selectbox("Selecciona estado:", lista_estados_todos,
+                                  format_func=lambda e: f"{e} ({conteos.get(e, {}).get('pedidos', 0)})")
+        filtros_estado = filtros_pedidos("estados", estado=estado_sel)
+        df_est = tabla_paginada("estados", filtros_estado)
+        df_est['materiales_mostrados'] = df_est['id'].map(articulos_por_pedido(df_est['id'])).fillna('')
         df_estado_view = df_est[["id", "estado", "cantidad", "precio_unidad", "total", "cliente", "detalle", "fecha", "materiales_mostrados"]]\
             .rename(columns={
                 "id": "ID", "estado": "Estado", "cantidad": "Cantidad",
@@ -998,30 +4457,31 @@ elif menu == "Estados":
                 "materiales_mostrados": "Artículos usados"
             })
         st.dataframe(df_estado_view, use_container_width=True, hide_index=True)
-        if not df_est.empty:
+        if df_est.empty:
+            st.info("No hay pedidos en este estado con los filtros elegidos.")
+        else:
+            acciones_en_lote("estados", df_est, [e for e in lista_estados_todos if e != estado_sel])
+
             st.divider()
             st.subheader("💳 Marcar pago de pedido")
             # Asegurar que columna pagado existe
             if 'pagado' not in df_est.columns:
                 df_est['pagado'] = False
             
-            # Selectbox con placeholder
-            ids_opciones_pago = ["-- Selecciona ID --"] + [str(x) for x in df_est['id'].tolist()]
-            id_pago_selec = st.selectbox("Selecciona ID de pedido:", ids_opciones_pago, key="id_pago_estados")
+            pedido_pago = selector_pedido("Selecciona ID de pedido:", "id_pago_estados", filtros_estado, df_est)
             
-            if id_pago_selec != "-- Selecciona ID --":
-                id_pago_estados = int(id_pago_selec)
-                pedido_pago = df_est[df_est['id'] == id_pago_estados].iloc[0]
+            if pedido_pago is not None:
+                id_pago_estados = int(pedido_pago['id'])
                 estado_pago_actual = '✅ Pagado' if pedido_pago.get('pagado', False) else '❌ Sin pagar'
                 st.caption(f"Estado actual: {estado_pago_actual}")
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("✅ Marcar como PAGADO", key="btn_pago_estados"):
-                        _ = safe_query("UPDATE pedidos SET pagado = TRUE WHERE id = %s", (id_pago_estados,))
+                        _ = marcar_pago_pedidos([id_pago_estados], True)
                         mostrar_feedback("exito", f"Pedido {id_pago_estados} marcado como PAGADO")
                 with col2:
                     if st.button("❌ Marcar como SIN PAGAR", key="btn_no_pago_estados"):
-                        _ = safe_query("UPDATE pedidos SET pagado = FALSE WHERE id = %s", (id_pago_estados,))
+                        _ = marcar_pago_pedidos([id_pago_estados], False)
                         mostrar_feedback("advertencia", f"Pedido {id_pago_estados} marcado como SIN PAGAR")
             else:
                 st.info("👆 Selecciona un pedido para marcar su pago")
@@ -1029,65 +4489,34 @@ elif menu == "Estados":
             st.divider()
             st.subheader("Cambiar estado de un pedido")
             
-            # Selectbox con placeholder
-            ids_opciones_cambio = ["-- Selecciona ID --"] + [str(x) for x in df_est["id"].tolist()]
-            id_cambiar_selec = st.selectbox("Selecciona ID de pedido para cambiar estado:", ids_opciones_cambio, key="estado_change")
+            pedido_actual = selector_pedido("Selecciona ID de pedido para cambiar estado:", "estado_change",
+                                            filtros_estado, df_est)
             
-            if id_cambiar_selec != "-- Selecciona ID --":
-                id_cambiar = int(id_cambiar_selec)
+            if pedido_actual is not None:
+                id_cambiar = int(pedido_actual['id'])
                 nuevo_estado = st.selectbox(
                     "Nuevo estado:", [e for e in lista_estados_todos if e != estado_sel], key="estado_nuevo"
                 )
                 if st.button("Cambiar estado de este pedido", key="btn_estado_cambio"):
-                    # Obtener el pedido actual
-                    pedido_actual = df_est[df_est["id"] == id_cambiar].iloc[0]
-                    inventario_ya_descontado = pedido_actual.get('inventario_descontado', False)
-                    
-                    # Estados que requieren inventario descontado
-                    estados_con_descuento = ["Listos para entregar", "Entregado"]
-                    
-                    # CASO 1: Mover A un estado que requiere descuento (y aún no está descontado)
-                    if nuevo_estado in estados_con_descuento and not inventario_ya_descontado:
-                        # Descontar inventario
-                        materiales = json.loads(pedido_actual['materiales_usados']) if pedido_actual['materiales_usados'] else []
-                        for m in materiales:
-                            _ = safe_query("UPDATE inventario SET cantidad = cantidad - %s WHERE material = %s",
-                                       (int(m['cantidad']), m['material']))
-                        # Marcar como descontado
-                        _ = safe_query("UPDATE pedidos SET estado = %s, inventario_descontado = TRUE WHERE id = %s", 
-                                   (nuevo_estado, int(id_cambiar)))
-                        mostrar_feedback("exito", f"Pedido {id_cambiar} cambiado a '{nuevo_estado}' e inventario descontado.")
-                    
-                    # CASO 2: Mover DESDE un estado con descuento HACIA uno sin descuento (devolver inventario)
-                    elif nuevo_estado not in estados_con_descuento and inventario_ya_descontado:
-                        # Devolver inventario
-                        materiales = json.loads(pedido_actual['materiales_usados']) if pedido_actual['materiales_usados'] else []
-                        for m in materiales:
-                            _ = safe_query("UPDATE inventario SET cantidad = cantidad + %s WHERE material = %s",
-                                       (int(m['cantidad']), m['material']))
-                        # Marcar como NO descontado
-                        _ = safe_query("UPDATE pedidos SET estado = %s, inventario_descontado = FALSE WHERE id = %s", 
-                                   (nuevo_estado, int(id_cambiar)))
-                        mostrar_feedback("exito", f"Pedido {id_cambiar} cambiado a '{nuevo_estado}' e inventario repuesto.")
-                    
-                    # CASO 3: Cambio de estado sin afectar inventario
-                    else:
-                        # Solo cambiar el estado
-                        _ = safe_query("UPDATE pedidos SET estado = %s WHERE id = %s", (nuevo_estado, int(id_cambiar)))
-                        mostrar_feedback("exito", f"Pedido {id_cambiar} cambiado a '{nuevo_estado}'.")
+                    resultado = cambiar_estado_pedidos([id_cambiar], nuevo_estado)
+                    if resultado is not None:
+                        if not resultado["ajustados"]:
+                            mostrar_feedback("exito", f"Pedido {id_cambiar} cambiado a '{nuevo_estado}'.")
+                        elif nuevo_estado in ESTADOS_CON_DESCUENTO:
+                            mostrar_feedback("exito", f"Pedido {id_cambiar} cambiado a '{nuevo_estado}' e inventario descontado.")
+                        else:
+                            mostrar_feedback("exito", f"Pedido {id_cambiar} cambiado a '{nuevo_estado}' e inventario repuesto.")
             else:
                 st.info("👆 Selecciona un pedido para cambiar su estado")
             
             st.divider()
             st.subheader("✏️ Editar pedido")
             
-            # Selectbox con placeholder
-            ids_opciones_edit = ["-- Selecciona ID --"] + [str(x) for x in df_est["id"].tolist()]
-            id_editar_selec = st.selectbox("Selecciona ID de pedido para editar:", ids_opciones_edit, key="estado_edit")
+            pedido_editar = selector_pedido("Selecciona ID de pedido para editar:", "estado_edit",
+                                            filtros_estado, df_est)
             
-            if id_editar_selec != "-- Selecciona ID --":
-                id_editar = int(id_editar_selec)
-                pedido_editar = df_est[df_est["id"] == id_editar].iloc[0]
+            if pedido_editar is not None:
+                id_editar = int(pedido_editar['id'])
                 
                 # Mostrar valores actuales
                 st.info(f"📊 **Valores actuales del pedido #{id_editar}:**\n\n"
@@ -1113,40 +4542,115 @@ elif menu == "Estados":
                         total_final = nuevo_precio_total if nuevo_precio_total > 0 else int(pedido_editar['total'])
                         precio_promedio_final = total_final // int(pedido_editar['cantidad']) if int(pedido_editar['cantidad']) > 0 else 0
                         
-                        _ = safe_query(
-                            "UPDATE pedidos SET cliente = %s, detalle = %s, precio_unidad = %s, total = %s WHERE id = %s",
-                            (cliente_final, detalle_final, precio_promedio_final, total_final, int(id_editar))
+                        filas = safe_query_filas(
+                            "UPDATE pedidos SET cliente = %s, detalle = %s, precio_unidad = %s, total = %s "
+                            "WHERE id = %s AND version = %s RETURNING version",
+                            (cliente_final, detalle_final, precio_promedio_final, total_final, int(id_editar),
+                             int(pedido_editar['version']))
                         )
-                        mostrar_feedback("exito", f"Pedido {id_editar} actualizado correctamente.")
+                        if filas == []:
+                            conflicto_edicion("pedidos", f"El pedido {id_editar}")
+                        elif filas:
+                            mostrar_feedback("exito", f"Pedido {id_editar} actualizado correctamente.")
             else:
                 st.info("👆 Selecciona un pedido para editar")
             
             st.divider()
             
-            # Selectbox para eliminar con placeholder
-            ids_opciones_del = ["-- Selecciona ID --"] + [str(x) for x in df_est["id"].tolist()]
-            id_eliminar_selec = st.selectbox("Selecciona pedido a eliminar en este estado:", ids_opciones_del, key="del_estado")
+            pedido_a_eliminar = selector_pedido("Selecciona pedido a eliminar en este estado:", "del_estado",
+                                                filtros_estado, df_est)
             
-            if id_eliminar_selec != "-- Selecciona ID --":
-                id_eliminar_estado = int(id_eliminar_selec)
+            if pedido_a_eliminar is not None:
+                id_eliminar_estado = int(pedido_a_eliminar['id'])
                 if st.button("🗑️ Eliminar pedido de este estado"):
-                    # Obtener el pedido antes de eliminarlo
-                    pedido_a_eliminar = df_est[df_est['id'] == id_eliminar_estado].iloc[0]
-                    inventario_descontado = pedido_a_eliminar.get('inventario_descontado', False)
-                    
-                    # Si el inventario fue descontado, devolverlo
-                    if inventario_descontado:
-                        materiales = json.loads(pedido_a_eliminar['materiales_usados']) if pedido_a_eliminar['materiales_usados'] else []
-                        for m in materiales:
-                            _ = safe_query("UPDATE inventario SET cantidad = cantidad + %s WHERE material = %s",
-                                       (int(m['cantidad']), m['material']))
-                    
-                    # Eliminar el pedido
-                    _ = safe_query("DELETE FROM pedidos WHERE id = %s", (int(id_eliminar_estado),))
-                    
-                    if inventario_descontado:
-                        mostrar_feedback("advertencia", f"Pedido {id_eliminar_estado} eliminado e inventario repuesto.")
-                    else:
-                        mostrar_feedback("advertencia", f"Pedido {id_eliminar_estado} eliminado.")
+                    resultado = eliminar_pedidos([id_eliminar_estado])
+                    if resultado is not None:
+                        if resultado["ajustados"]:
+                            mostrar_feedback("advertencia", f"Pedido {id_eliminar_estado} eliminado e inventario repuesto.")
+                        else:
+                            mostrar_feedback("advertencia", f"Pedido {id_eliminar_estado} eliminado.")
             else:
                 st.info("👆 Selecciona un pedido para eliminar")
+
+# ---------------------------------------------------------
+# REPORTES
+# ---------------------------------------------------------
+elif menu == "Reportes":
+    st.title("📈 Reportes de ventas")
+    hoy = date.today()
+    rango = st.date_input("Rango de fechas", value=((hoy - timedelta(days=365)).replace(day=1), hoy),
+                          key="reporte_rango")
+    if len(rango) < 2:
+        st.info("👆 Elige la fecha final del rango")
+    else:
+        desde, hasta = rango
+        # Por día hasta unos tres meses; más allá, por mes
+        granularidad = st.radio("Agrupar por", list(GRANULARIDADES), horizontal=True,
+                                index=0 if (hasta - desde).days <= 92 else 1)
+        df_rep = reporte_periodos(desde, hasta, granularidad)
+        if df_rep.empty:
+            st.info("No hay pedidos ni bajas en este rango.")
+        else:
+            col1, col2, col3, col4, col5, col6 = st.columns(6)
+            with col1: st.metric("Ventas pagadas", f"${df_rep['ventas_pagadas'].sum():,.0f}")
+            with col2: st.metric("Sin pagar", f"${df_rep['ventas_sin_pagar'].sum():,.0f}")
+            with col3: st.metric("Costos", f"${df_rep['costos'].sum():,.0f}")
+            with col4: st.metric("Baja", f"${df_rep['gastos_baja'].sum():,.0f}")
+            with col5: st.metric("Ganancia", f"${df_rep['ganancia'].sum():,.0f}")
+            with col6: st.metric("Pedidos", f"{int(df_rep['pedidos'].sum())}")
+
+            por_periodo = df_rep.set_index('periodo')
+            st.subheader("💰 Ventas entregadas")
+            st.bar_chart(por_periodo[['ventas_pagadas', 'ventas_sin_pagar']]
+                         .rename(columns={'ventas_pagadas': 'Pagadas', 'ventas_sin_pagar': 'Sin pagar'}))
+            st.subheader("🔹 Ganancia")
+            st.line_chart(por_periodo[['ventas_pagadas', 'costos', 'ganancia']]
+                          .rename(columns={'ventas_pagadas': 'Ventas pagadas', 'costos': 'Costos', 'ganancia': 'Ganancia'}))
+            st.subheader("📦 Pedidos y entregas")
+            st.bar_chart(por_periodo[['pedidos', 'entregas', 'pagados']]
+                         .rename(columns={'pedidos': 'Pedidos', 'entregas': 'Entregas', 'pagados': 'Pagadas'}))
+            with st.expander("📋 Detalle por periodo"):
+                st.dataframe(df_rep, use_container_width=True, hide_index=True)
+
+    st.divider()
+    st.subheader("📆 Tendencia de dos años")
+    tendencia = reporte_periodos(hoy - timedelta(days=730), hoy, "Mes")
+    if tendencia.empty:
+        st.info("Aún no hay meses con movimientos.")
+    else:
+        st.line_chart(tendencia.set_index('periodo')[['ventas_pagadas', 'ganancia']]
+                      .rename(columns={'ventas_pagadas': 'Ventas pagadas', 'ganancia': 'Ganancia'}))
+
+# ---------------------------------------------------------
+# DIAGNÓSTICO (solo administradores)
+# ---------------------------------------------------------
+if st.session_state.get("usuario_actual") in ADMINISTRADORES:
+    with st.sidebar.expander("🩺 Diagnóstico de consultas"):
+        consultas = pd.DataFrame(st.session_state.get("consultas_rerun", []))
+        if consultas.empty:
+            st.caption("Este rerun no consultó la base de datos")
+        else:
+            st.caption(f"Este rerun: {len(consultas)} consultas · "
+                       f"{consultas['segundos'].sum() * 1000:.1f} ms en base de datos · "
+                       f"{consultas['espera'].sum() * 1000:.1f} ms esperando conexión · "
+                       f"{int(consultas['filas'].sum())} filas")
+            por_huella = consultas.groupby(['huella', 'sql']).agg(
+                veces=('segundos', 'size'), ms=('segundos', 'sum'), filas=('filas', 'sum'),
+                parametros=('parametros', 'max'), espera_ms=('espera', 'sum'),
+            ).reset_index().sort_values('ms', ascending=False)
+            por_huella['ms'] = (por_huella['ms'] * 1000).round(1)
+            por_huella['espera_ms'] = (por_huella['espera_ms'] * 1000).round(1)
+            st.dataframe(por_huella[['huella', 'veces', 'ms', 'filas', 'parametros', 'espera_ms', 'sql']],
+                         use_container_width=True, hide_index=True)
+        registro = get_registro_consultas()
+        st.markdown(f"**Más lentas del proceso (top {registro.top})**")
+        lentas = pd.DataFrame(registro.mas_lentas())
+        if not lentas.empty:
+            lentas['ms'] = (lentas['segundos'] * 1000).round(1)
+            lentas['momento'] = pd.to_datetime(lentas['momento'], unit='s')
+            st.dataframe(lentas[['ms', 'filas', 'parametros', 'huella', 'momento', 'sql']],
+                         use_container_width=True, hide_index=True)
+        if registro.archivo_lento:
+            st.caption(f"Consultas de más de {registro.umbral_lento * 1000:.0f} ms se anotan en {registro.archivo_lento}")
+        if st.button("🧹 Reiniciar top de lentas", key="btn_limpiar_lentas"):
+            registro.limpiar()
@@ -0,0 +1,153 @@
+import ast
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+# printhart_supabase.py es un script de Streamlit: importarlo dibuja la app y
+# se conecta a la base configurada. Aquí solo se ejecutan sus imports, sus
+# funciones, sus clases y sus constantes, hasta antes de preparar la base.
+APP = Path(__file__).resolve().parent.parent / "printhart_supabase.py"
+
+
+def _cargar_definiciones():
+    fuente = APP.read_text(encoding="utf-8")
+    arbol = ast.parse(fuente)
+    nodos = []
+    for nodo in arbol.body:
+        if isinstance(nodo, ast.Try):
+            # El primer try de nivel superior prepara la base de datos: ahí termina lo que se necesita
+            break
+        if isinstance(nodo, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            nodos.append(nodo)
+        elif isinstance(nodo, ast.Assign) and all(isinstance(t, ast.Name) and t.id.isupper() for t in nodo.targets):
+            # Las constantes que leen st.secrets o la base configurada no hacen falta
+            texto = ast.get_source_segment(fuente, nodo)
+            if "st.secrets" not in texto and "get_almacen()" not in texto:
+                nodos.append(nodo)
+        elif isinstance(nodo, ast.Expr) and "register_" in ast.get_source_segment(fuente, nodo):
+            # Adaptadores de fechas y booleanos de sqlite3
+            nodos.append(nodo)
+    espacio = {"__name__": "printhart_supabase"}
+    exec(compile(ast.Module(body=nodos, type_ignores=[]), str(APP), "exec"), espacio)
+    # Sin secrets.toml: el registro de consultas usa sus valores por defecto
+    registro = espacio["RegistroConsultas"]()
+    espacio["get_registro_consultas"] = lambda: registro
+    return espacio
+
+
+@pytest.fixture(scope="module")
+def app():
+    return _cargar_definiciones()
+
+
+@pytest.fixture
+def almacen(app):
+    # :memory: da una base por conexión; el almacén reutiliza la única que abre
+    almacen = app["AlmacenSQLite"](":memory:")
+    with almacen.transaccion() as conn:
+        with conn.cursor() as cur:
+            for _, _, sentencias in app["MIGRACIONES_SQLITE"]:
+                for sentencia in sentencias:
+                    cur.execute(sentencia)
+    return almacen
+
+
+# --- TRADUCCIÓN DE SQL ---
+def test_traducir_marcadores(app):
+    traducir = app["traducir_sqlite"]
+    assert traducir("SELECT * FROM pedidos WHERE id = %s AND cliente = %s") == \
+        "SELECT * FROM pedidos WHERE id = ? AND cliente = ?"
+    assert traducir("UPDATE pedidos SET estado = %(estado)s WHERE id = %(id)s") == \
+        "UPDATE pedidos SET estado = :estado WHERE id = :id"
+    assert traducir("SELECT '100%%'") == "SELECT '100%'"
+
+
+def test_traducir_any(app):
+    traducir = app["traducir_sqlite"]
+    assert traducir("SELECT * FROM pedidos WHERE id = ANY(%s)") == \
+        "SELECT * FROM pedidos WHERE id IN (SELECT value FROM json_each(?))"
+    assert traducir("DELETE FROM pedidos WHERE id = any ( %(ids)s )") == \
+        "DELETE FROM pedidos WHERE id IN (SELECT value FROM json_each(:ids))"
+
+
+def test_traducir_ilike(app):
+    traducir = app["traducir_sqlite"]
+    assert traducir("SELECT * FROM pedidos WHERE cliente ILIKE %s") == \
+        "SELECT * FROM pedidos WHERE cliente LIKE ?"
+    # Solo la palabra completa
+    assert traducir("SELECT milikes FROM x") == "SELECT milikes FROM x"
+
+
+def test_any_con_lista_en_sqlite(almacen):
+    with almacen.conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO pedidos (cliente, cantidad) VALUES ('Ana', 1), ('Beto', 2), ('Caro', 3)")
+            cur.execute("SELECT cliente FROM pedidos WHERE id = ANY(%s) ORDER BY id", ([1, 3],))
+            assert cur.fetchall() == [("Ana",), ("Caro",)]
+            cur.execute("SELECT COUNT(*) FROM pedidos WHERE cliente ILIKE %s", ("b%",))
+            assert cur.fetchone() == (1,)
+
+
+# --- ERRORES DE ESQUEMA ---
+def test_es_tabla_inexistente(app, tmp_path):
+    almacen = app["AlmacenSQLite"](str(tmp_path / "vacia.db"))
+    with almacen.conexion() as conn:
+        with conn.cursor() as cur:
+            with pytest.raises(sqlite3.OperationalError) as sin_tabla:
+                cur.execute("SELECT huella FROM schema_huella")
+            with pytest.raises(sqlite3.OperationalError) as sintaxis:
+                cur.execute("SELEC 1")
+    assert almacen.es_tabla_inexistente(sin_tabla.value)
+    assert not almacen.es_tabla_inexistente(sintaxis.value)
+    assert not almacen.es_tabla_inexistente(sqlite3.OperationalError("database is locked"))
+    assert not almacen.es_tabla_inexistente(ValueError("no such table: x"))
+
+
+# --- MIGRACIONES Y TRIGGERS ---
+def test_migraciones_con_mismas_versiones(app):
+    versiones_pg = [version for version, _, _ in app["MIGRACIONES"]]
+    versiones_sqlite = [version for version, _, _ in app["MIGRACIONES_SQLITE"]]
+    assert versiones_sqlite == sorted(set(versiones_sqlite))
+    assert versiones_sqlite[-1] == versiones_pg[-1]
+    assert set(versiones_sqlite) <= set(versiones_pg)
+
+
+def _foto(cur, tablas):
+    # Los triggers dejan en cero las filas que se vacían y recalcular no las crea:
+    # solo se comparan las filas con algún valor
+    foto = {}
+    for tabla in tablas:
+        cur.execute(f"SELECT * FROM {tabla} ORDER BY 1, 2")
+        foto[tabla] = [tuple(round(v, 2) if isinstance(v, float) else v for v in fila) for fila in cur.fetchall()
+                       if any(isinstance(v, (int, float)) and not isinstance(v, bool) and v for v in fila)]
+    return foto
+
+
+def test_triggers_igual_que_recalcular(app, almacen):
+    # Lo que llevan los triggers paso a paso debe ser lo mismo que recalcular desde cero
+    tablas = ("finanzas", "finanzas_materiales", "reservas", "bajas_por_material") + app["TABLAS_RESUMEN"]
+    recalcular = (app["SENTENCIAS_RECALCULAR_FINANZAS"] + app["SENTENCIAS_RECALCULAR_RESERVAS"]
+                  + app["SENTENCIAS_RECALCULAR_BAJAS_POR_MATERIAL"] + app["sentencias_recalcular_resumenes"]("sqlite"))
+    with almacen.transaccion() as conn:
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO inventario (material, cantidad, precio_compra, precio_venta) "
+                        "VALUES ('Vinil', 50, 3, 8), ('Taza', 20, 10, 25)")
+            cur.execute("INSERT INTO pedidos (fecha, cliente, cantidad, total, estado, pagado) VALUES "
+                        "('2024-01-31', 'Ana', 3, 30, 'Entregado', TRUE), "
+                        "('2024-02-01', 'Beto', 2, 20, 'Por confirmar', FALSE), "
+                        "('2024-02-01', 'Caro', 1, 15, 'Entregado', FALSE)")
+            cur.execute("INSERT INTO pedido_materiales (pedido_id, material, cantidad, precio) VALUES "
+                        "(1, 'Vinil', 2, 8), (1, 'Taza', 1, 25), (2, 'Vinil', 2, 8), (3, 'Taza', 1, 25)")
+            cur.execute("INSERT INTO bajas_material (material, cantidad, costo_unitario, costo_total, fecha) "
+                        "VALUES ('Vinil', 1, 3, 3, '2024-01-15'), ('Taza', 2, 10, 20, '2024-02-10')")
+            cur.execute("UPDATE pedidos SET pagado = TRUE WHERE id = 3")
+            cur.execute("UPDATE pedidos SET estado = 'Entregado', fecha = '2024-03-01' WHERE id = 2")
+            cur.execute("UPDATE pedidos SET fecha = '2024-02-29' WHERE id = 1")
+            cur.execute("UPDATE pedido_materiales SET cantidad = 4 WHERE pedido_id = 3")
+            cur.execute("DELETE FROM bajas_material WHERE id = 1")
+            cur.execute("DELETE FROM pedidos WHERE id = 1")
+            incremental = _foto(cur, tablas)
+            for sentencia in recalcular:
+                cur.execute(sentencia)
+            assert incremental == _foto(cur, tablas)